@@ -6,10 +6,199 @@
 #       - Coumes Quentin <coumes.quentin@gmail.com>
 #
 
-from django.contrib import admin
+import io
+from functools import reduce
+from operator import or_
+from typing import Any, Callable, Optional, Tuple, Type
+
+import requests
+import wimsapi
+from django import forms
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth.models import Group
+from django.core.paginator import Paginator
+from django.db.models import Q, QuerySet
+from django.http import HttpRequest, StreamingHttpResponse
+from django.template.response import TemplateResponse
+from django.utils.functional import cached_property
+
+from lti_app import export, models, roster, surge
+from lti_app.db import estimated_count
+
+
+# Query string parameter holding the primary key of the last row of the previous page.
+CURSOR_VAR = "cursor"
+
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator estimating the number of rows of an unfiltered queryset from the statistics of the
+    database once the table contains more than settings.ADMIN_ESTIMATED_COUNT_THRESHOLD rows,
+    instead of running a COUNT(*) over the whole table.
+    
+    As estimations can be far off (e.g. the greatest primary key after rows were deleted), rows
+    are counted exactly as long as there are fewer than the threshold, which only scans up to
+    this number of rows."""
+    
+    estimated = False
+    
+    
+    @cached_property
+    def count(self) -> int:
+        threshold = settings.ADMIN_ESTIMATED_COUNT_THRESHOLD
+        if not self.object_list.query.where:
+            estimate = estimated_count(self.object_list.model)
+            if estimate is not None and estimate >= threshold:
+                counted = self.object_list.order_by()[:threshold].count()
+                if counted < threshold:
+                    return counted
+                self.estimated = True
+                return max(estimate, counted)
+        return super().count
+
+
+
+class CursorChangeList(ChangeList):
+    """Change list paginated by primary key, each page starting after the last row of the previous
+    one (given by the parameter CURSOR_VAR) instead of an OFFSET scanning every preceding row."""
+    
+    def get_filters_params(self, params: Optional[dict] = None) -> dict:
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+    
+    
+    def get_results(self, request: HttpRequest) -> None:
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        
+        queryset = self.queryset.order_by("-pk")
+        self.cursor = self.params.get(CURSOR_VAR)
+        if self.cursor:
+            try:
+                queryset = queryset.filter(pk__lt=int(self.cursor))
+            except ValueError:
+                raise IncorrectLookupParameters
+        rows = list(queryset[:self.list_per_page + 1])
+        
+        self.result_list = rows[:self.list_per_page]
+        self.next_cursor = self.result_list[-1].pk if len(rows) > self.list_per_page else None
+        self.first_page_url = self.get_query_string(remove=[CURSOR_VAR])
+        self.next_page_url = self.get_query_string({CURSOR_VAR: self.next_cursor})
+        
+        self.result_count = paginator.count
+        self.result_count_estimated = paginator.estimated
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.can_show_all = False
+        self.multi_page = bool(self.cursor or self.next_cursor)
+        self.paginator = paginator
+
+
+
+def export_action(fmt: str) -> Callable[[admin.ModelAdmin, HttpRequest, QuerySet],
+                                        StreamingHttpResponse]:
+    """Returns an admin action streaming the export of the selected rows in the format <fmt>, see
+    lti_app.export."""
+    
+    def action(modeladmin: admin.ModelAdmin, request: HttpRequest,
+               queryset: QuerySet) -> StreamingHttpResponse:
+        return export.response(queryset, fmt)
+    
+    action.__name__ = "export_" + fmt
+    action.short_description = "Export selected rows as %s" % fmt.upper()
+    return action
+
+
+
+class RosterForm(forms.Form):
+    roster = forms.FileField(help_text="CSV file with the columns %s." % ", ".join(roster.COLUMNS))
+
+
+
+def provision_roster(modeladmin: admin.ModelAdmin, request: HttpRequest,
+                     queryset: QuerySet) -> Optional[TemplateResponse]:
+    """Ask for a roster, then create in advance the accounts of its students in the selected class,
+    see lti_app.roster."""
+    selected = list(queryset.select_related("wims")[:2])
+    if len(selected) != 1:
+        modeladmin.message_user(request, "Select exactly one class to provision.", messages.ERROR)
+        return None
+    wclass_db = selected[0]
+    
+    form = RosterForm(request.POST if "apply" in request.POST else None, request.FILES or None)
+    if form.is_valid():
+        try:
+            rows = roster.read(io.TextIOWrapper(form.cleaned_data["roster"], encoding="utf-8-sig"))
+            report = roster.provision(wclass_db, rows)
+        except (UnicodeDecodeError, ValueError) as e:
+            form.add_error("roster", str(e))
+        except (wimsapi.WimsAPIError, requests.RequestException) as e:
+            modeladmin.message_user(request, "Could not join the class on its WIMS server: %s"
+                                    % str(e), messages.ERROR)
+            return None
+        else:
+            modeladmin.message_user(
+                request, "%d students provisioned in class %s (%d already existing, %d failed: %s)"
+                % (report["created"], wclass_db.qclass, report["existing"], len(report["failed"]),
+                   ", ".join(user_id for user_id, _ in report["failed"]) or "none"),
+                messages.WARNING if report["failed"] else messages.SUCCESS
+            )
+            if report["orphaned"]:
+                modeladmin.message_user(
+                    request, "Orphaned WIMS users to delete manually from class %s: %s"
+                    % (wclass_db.qclass, ", ".join(report["orphaned"])), messages.WARNING
+                )
+            return None
+    
+    return TemplateResponse(request, "admin/lti_app/provision_roster.html", {
+        **modeladmin.admin_site.each_context(request),
+        "title":                "Provision a roster",
+        "opts":                 modeladmin.model._meta,
+        "wclass":               wclass_db,
+        "form":                 form,
+        "action_checkbox_name": helpers.ACTION_CHECKBOX_NAME,
+    })
 
-from lti_app import models
+
+provision_roster.short_description = "Provision a roster in the selected class"
+
+
+
+class ScalableAdmin(admin.ModelAdmin):
+    """Admin of the tables growing with the number of users.
+    
+    Counts are estimated (see EstimatedCountPaginator), pages are delimited by primary keys (see
+    CursorChangeList) and searches only use exact matches on <search_fields>, through their digest
+    when the model has one (see lti_app.models.lookup()), so that every query uses an index."""
+    
+    paginator = EstimatedCountPaginator
+    change_list_template = "admin/lti_app/cursor_change_list.html"
+    show_full_result_count = False
+    ordering = ('-pk',)
+    sortable_by: Tuple[str, ...] = ()
+    
+    
+    def get_changelist(self, request: HttpRequest, **kwargs: Any) -> Type[ChangeList]:
+        return CursorChangeList
+    
+    
+    def get_search_results(self, request: HttpRequest, queryset: QuerySet,
+                           search_term: str) -> Tuple[QuerySet, bool]:
+        term = search_term.strip()
+        if not term or not self.search_fields:
+            return queryset, False
+        
+        fields = {f.name for f in self.model._meta.fields}
+        conditions = [
+            Q(**models.lookup(field, term)) if field + "_hash" in fields else Q(**{field: term})
+            for field in self.search_fields
+        ]
+        return queryset.filter(reduce(or_, conditions)), False
 
 
 
@@ -26,32 +215,91 @@ class WIMSAdmin(admin.ModelAdmin):
 
 
 @admin.register(models.WimsClass)
-class WIMSClassAdmin(admin.ModelAdmin):
+class WIMSClassAdmin(ScalableAdmin):
     list_display = ('id', 'wims', 'lms_guid', 'qclass')
+    list_select_related = ('wims',)
+    search_fields = ('qclass', 'lms_guid')
+    actions = (export_action("csv"), export_action("ndjson"), provision_roster)
 
 
 
 @admin.register(models.WimsUser)
-class WIMSUserAdmin(admin.ModelAdmin):
+class WIMSUserAdmin(ScalableAdmin):
     list_display = ('id', 'lms_guid', 'wclass', 'quser')
+    list_select_related = ('wclass',)
+    search_fields = ('quser', 'lms_guid')
+    raw_id_fields = ('wclass',)
+    actions = (export_action("csv"), export_action("ndjson"))
 
 
 
 @admin.register(models.WimsSheet)
-class ActivityAdmin(admin.ModelAdmin):
+class ActivityAdmin(ScalableAdmin):
     list_display = ('id', 'lms_guid', 'wclass', 'qsheet')
+    list_select_related = ('wclass',)
+    search_fields = ('qsheet', 'lms_guid')
+    raw_id_fields = ('wclass',)
 
 
 
 @admin.register(models.GradeLinkSheet)
-class GradeLinkSheetAdmin(admin.ModelAdmin):
-    list_display = ('id', 'user', 'activity', 'sourcedid', 'url')
+class GradeLinkSheetAdmin(ScalableAdmin):
+    list_display = ('id', 'user', 'activity', 'sourcedid', 'service')
+    list_select_related = ('user', 'activity', 'service')
+    search_fields = ('user__quser',)
+    raw_id_fields = ('user', 'activity', 'service')
+    actions = (export_action("csv"), export_action("ndjson"))
 
 
 
 @admin.register(models.GradeLinkExam)
-class GradeLinkSheetExam(admin.ModelAdmin):
-    list_display = ('id', 'user', 'activity', 'sourcedid', 'url')
+class GradeLinkSheetExam(ScalableAdmin):
+    list_display = ('id', 'user', 'activity', 'sourcedid', 'service')
+    list_select_related = ('user', 'activity', 'service')
+    search_fields = ('user__quser',)
+    raw_id_fields = ('user', 'activity', 'service')
+    actions = (export_action("csv"), export_action("ndjson"))
+
+
+
+def warm_up(modeladmin: admin.ModelAdmin, request: HttpRequest, queryset: QuerySet) -> None:
+    """Warm up the selected exam surges now, see lti_app.surge."""
+    warmed = 0
+    for exam_surge in queryset.select_related("exam__wclass__wims"):
+        try:
+            surge.warm_up(exam_surge)
+            warmed += 1
+        except (wimsapi.WimsAPIError, requests.RequestException) as e:
+            modeladmin.message_user(request, "Could not warm up %s: %s" % (exam_surge, str(e)),
+                                    messages.ERROR)
+    modeladmin.message_user(request, "%d exam surge(s) warmed up." % warmed)
+
+
+warm_up.short_description = "Warm up the selected exam surges now"
+
+
+
+@admin.register(models.ExamSurge)
+class ExamSurgeAdmin(admin.ModelAdmin):
+    list_display = ('id', 'exam', 'start', 'end', 'warmed')
+    list_select_related = ('exam',)
+    raw_id_fields = ('exam',)
+    readonly_fields = ('warmed',)
+    actions = (warm_up,)
+
+
+
+@admin.register(models.OutcomeService)
+class OutcomeServiceAdmin(admin.ModelAdmin):
+    list_display = ('id', 'lms', 'url')
+    list_select_related = ('lms',)
+
+
+
+@admin.register(models.WimsCapability)
+class WimsCapabilityAdmin(admin.ModelAdmin):
+    list_display = ('id', 'wims', 'version', 'score_format', 'bulk_listing', 'checked', 'failed')
+    list_select_related = ('wims',)
 
 
 
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+#  api.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+"""Read-only JSON API exposing the LMS, the WIMS servers which allowed them, their classes and the
+sheets and exams of these classes, with their LTI URLs.
+
+Lists are paginated by primary key: each page contains at most 'limit' rows (at most
+settings.API_PAGE_SIZE) and the URL of the next page ('next'), which starts after the last row of
+the page ('cursor'). The parameter 'fields' restricts the fields of each row to a comma-separated
+list. Sheets and exams are read from the catalog of the class (see lti_app.catalog), so that
+browsing the API does not send requests to the WIMS server for every page.
+
+Every response has an ETag (and a Last-Modified when known) and is served as 304 Not Modified to
+conditional requests matching it."""
+
+import hashlib
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import requests
+import wimsapi
+from django.conf import settings
+from django.db.models import Model, QuerySet
+from django.http import HttpRequest, HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag, urlencode
+from django.views.decorators.http import require_GET
+
+from lti_app import catalog
+from lti_app.exceptions import BadRequestException
+from lti_app.models import LMS, WIMS, WimsClass
+
+
+# Fields of the rows of each list, every field being returned if the parameter 'fields' is absent.
+FIELDS = {
+    "lms":     ("pk", "name", "url", "api_url"),
+    "wims":    ("pk", "name", "url", "lti_url", "api_url"),
+    "classes": ("pk", "name", "qclass", "lms_guid", "modified", "lti_url", "api_url"),
+    "items":   ("id", "title", "description", "mode", "lti_url"),
+}
+
+
+
+def error(message: str, status: int) -> JsonResponse:
+    """Returns a JSON response containing the error <message>."""
+    return JsonResponse({"error": message}, status=status)
+
+
+
+def fields(request: HttpRequest, kind: str) -> Tuple[str, ...]:
+    """Returns the fields of the rows of <kind> requested through the parameter 'fields'.
+
+    Raises BadRequestException if a requested field does not exist."""
+    if not request.GET.get("fields"):
+        return FIELDS[kind]
+    
+    requested = tuple(f.strip() for f in request.GET["fields"].split(",") if f.strip())
+    unknown = [f for f in requested if f not in FIELDS[kind]]
+    if unknown:
+        raise BadRequestException("Unknown field(s) '%s', available fields are: %s"
+                                  % ("', '".join(unknown), ", ".join(FIELDS[kind])))
+    return requested
+
+
+
+def select(request: HttpRequest, kind: str, rows: Iterable[Dict[str, Any]]
+           ) -> List[Dict[str, Any]]:
+    """Returns <rows> restricted to the fields requested through the parameter 'fields'."""
+    selected = fields(request, kind)
+    return [{f: row[f] for f in selected} for row in rows]
+
+
+
+def paginate(request: HttpRequest, queryset: QuerySet,
+             serialize: Callable[[Model], Dict[str, Any]], kind: str) -> Dict[str, Any]:
+    """Returns the page of <queryset> starting after the primary key given by the parameter
+    'cursor', each row serialized by <serialize>, and the URL of the next page.
+
+    Raises BadRequestException if 'cursor' or 'limit' are not valid."""
+    try:
+        cursor = int(request.GET.get("cursor", 0))
+        limit = min(int(request.GET.get("limit", settings.API_PAGE_SIZE)), settings.API_PAGE_SIZE)
+    except ValueError:
+        raise BadRequestException("Parameters 'cursor' and 'limit' must be integers")
+    if limit < 1:
+        raise BadRequestException("Parameter 'limit' must be positive")
+    
+    rows = list(queryset.filter(pk__gt=cursor).order_by("pk")[:limit + 1])
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        params = {**request.GET.dict(), "cursor": rows[-1].pk}
+        next_url = request.build_absolute_uri(request.path + "?" + urlencode(params))
+    
+    return {"results": select(request, kind, map(serialize, rows)), "next": next_url}
+
+
+
+def respond(request: HttpRequest, data: Dict[str, Any],
+            last_modified: Optional[datetime] = None) -> HttpResponse:
+    """Returns <data> as JSON, with an ETag computed from the content and <last_modified> as
+    Last-Modified. Returns 304 Not Modified if the request's conditions match."""
+    response = JsonResponse(data)
+    etag = quote_etag(hashlib.md5(response.content).hexdigest())
+    response["ETag"] = etag
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified.timestamp())
+    patch_cache_control(response, private=True, max_age=settings.API_MAX_AGE)
+    
+    return get_conditional_response(
+        request, etag=etag,
+        last_modified=int(last_modified.timestamp()) if last_modified is not None else None,
+        response=response,
+    )
+
+
+
+def api_view(view: Callable[..., HttpResponse]) -> Callable[..., HttpResponse]:
+    """Restrict <view> to GET requests, turning BadRequestException into 400 Bad Request."""
+    
+    @require_GET
+    def wrapper(request: HttpRequest, *args: Any, **kwargs: Any) -> HttpResponse:
+        try:
+            return view(request, *args, **kwargs)
+        except BadRequestException as e:
+            return error(str(e), 400)
+    
+    wrapper.__name__ = view.__name__
+    wrapper.__doc__ = view.__doc__
+    return wrapper
+
+
+
+@api_view
+def lms(request: HttpRequest) -> HttpResponse:
+    """List the LMS."""
+    return respond(request, paginate(request, LMS.objects.only("pk", "name", "url"), lambda m: {
+        "pk":      m.pk,
+        "name":    m.name,
+        "url":     m.url,
+        "api_url": request.build_absolute_uri(reverse("lti:api_wims", args=[m.pk])),
+    }, "lms"))
+
+
+
+@api_view
+def wims(request: HttpRequest, lms_pk: int) -> HttpResponse:
+    """List the WIMS servers which allowed the LMS <lms_pk>."""
+    get_object_or_404(LMS.objects.only("pk"), pk=lms_pk)
+    queryset = WIMS.objects.filter(allowed_lms__pk=lms_pk).only("pk", "name", "url")
+    return respond(request, paginate(request, queryset, lambda w: {
+        "pk":      w.pk,
+        "name":    w.name,
+        "url":     w.url,
+        "lti_url": request.build_absolute_uri(reverse("lti:wims_class", args=[w.pk])),
+        "api_url": request.build_absolute_uri(
+            reverse("lti:api_classes", args=[lms_pk, w.pk])
+        ),
+    }, "wims"))
+
+
+
+@api_view
+def classes(request: HttpRequest, lms_pk: int, wims_pk: int) -> HttpResponse:
+    """List the classes of the LMS <lms_pk> on the WIMS server <wims_pk>."""
+    get_object_or_404(WIMS.objects.only("pk"), pk=wims_pk, allowed_lms__pk=lms_pk)
+    queryset = (WimsClass.objects.filter(lms_id=lms_pk, wims_id=wims_pk)
+                .only("pk", "name", "qclass", "lms_guid", "modified"))
+    return respond(request, paginate(request, queryset, lambda c: {
+        "pk":       c.pk,
+        "name":     c.name,
+        "qclass":   c.qclass,
+        "lms_guid": c.lms_guid,
+        "modified": c.modified,
+        "lti_url":  request.build_absolute_uri(reverse("lti:wims_class", args=[wims_pk])),
+        "api_url":  request.build_absolute_uri(
+            reverse("lti:api_activities", args=[lms_pk, wims_pk, c.pk])
+        ),
+    }, "classes"))
+
+
+
+@api_view
+def activities(request: HttpRequest, lms_pk: int, wims_pk: int, wclass_pk: int) -> HttpResponse:
+    """List the sheets and exams of the class <wclass_pk>, as cached in its catalog."""
+    wclass = get_object_or_404(WimsClass.objects.select_related("wims"), pk=wclass_pk,
+                               lms_id=lms_pk, wims_id=wims_pk)
+    try:
+        activities = catalog.get(wclass.wims, wclass.qclass)
+    except wimsapi.WimsAPIError as e:
+        return error("The WIMS server returned an error: " + str(e), 502)
+    except requests.RequestException:
+        return error("Could not join the WIMS server", 504)
+    
+    def items(kind: str) -> List[Dict[str, Any]]:
+        return select(request, "items", ({
+            "id":          i["q" + kind],
+            "title":       i["title"],
+            "description": i["description"],
+            "mode":        i[kind + "mode"],
+            "lti_url":     request.build_absolute_uri(i["url"]),
+        } for i in activities[kind + "s"]))
+    
+    return respond(request, {"sheets": items("sheet"), "exams": items("exam")},
+                   datetime.fromtimestamp(activities["fetched"], timezone.utc))
@@ -6,13 +6,18 @@
 #       - Coumes Quentin <coumes.quentin@gmail.com>
 #
 
+import atexit
+import threading
 import warnings
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from django.apps import AppConfig
 from django.conf import settings
+from django.core.signals import request_started
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
 
-from lti_app import tasks
+from lti_app import db, metrics, scheduling, tasks, tracing
 
 
 
@@ -60,19 +65,53 @@ class LtiAppConfig(AppConfig):
     
     
     def ready(self):
-        """Display warning for missing settings and set up scheduled tasks."""
+        """Display warning for missing settings, set up scheduled tasks, fill the lookup digests,
+        class name keys, class slots and outcome services after migrations, tune database
+        connections and trace the calls to WIMS servers. Running jobs are cancelled when the
+        process exits."""
         
         display_warnings()
+        tracing.instrument()
+        atexit.register(metrics.flush)
+        post_migrate.connect(tasks.fill_lookup_hashes, sender=self)
+        post_migrate.connect(tasks.fill_class_name_keys, sender=self)
+        post_migrate.connect(tasks.fill_class_slots, sender=self)
+        post_migrate.connect(tasks.fill_outcome_services, sender=self)
+        connection_created.connect(db.configure_sqlite)
+        request_started.connect(db.check_connections)
         
         scheduler = BackgroundScheduler(job_defaults={
             'coalesce':           True,
             'max_instances':      1,
             'misfire_grace_time': 60 * 10,
         })
+        kwargs = {
+            'window':        settings.SCHEDULED_JOBS_WINDOW,
+            'budget':        settings.SCHEDULED_JOBS_TIME_BUDGET,
+            'server_budget': settings.SCHEDULED_JOBS_SERVER_TIME_BUDGET,
+        }
         scheduler.add_job(tasks.send_back_all_sheets_grades,
-                          trigger=settings.SEND_GRADE_BACK_CRON_TRIGGER)
+                          trigger=settings.SEND_GRADE_BACK_CRON_TRIGGER, kwargs=kwargs)
         scheduler.add_job(tasks.send_back_all_exams_grades,
-                          trigger=settings.SEND_GRADE_BACK_CRON_TRIGGER)
+                          trigger=settings.SEND_GRADE_BACK_CRON_TRIGGER, kwargs=kwargs)
         scheduler.add_job(tasks.check_classes_exists,
-                          trigger=settings.CHECK_CLASSES_EXISTS_CRON_TRIGGER)
+                          trigger=settings.CHECK_CLASSES_EXISTS_CRON_TRIGGER, kwargs=kwargs)
+        scheduler.add_job(tasks.refresh_capabilities,
+                          trigger=settings.REFRESH_CAPABILITIES_CRON_TRIGGER)
+        scheduler.add_job(tasks.archive_expired_classes,
+                          trigger=settings.ARCHIVE_EXPIRED_CLASSES_CRON_TRIGGER)
+        scheduler.add_job(tasks.warm_up_exams, trigger=settings.WARM_UP_EXAMS_CRON_TRIGGER)
         scheduler.start()
+        
+        # Running jobs must be cancelled before the threads of the scheduler are joined. Since
+        # Python 3.9, concurrent.futures joins the workers of the ThreadPoolExecutor of
+        # APScheduler through threading._register_atexit(), whose callbacks are run by
+        # threading._shutdown() before any atexit handler. A handler registered with
+        # atexit.register() would thus only run once every running job is done, however long it
+        # takes, so shutdown() is registered through the same private hook to run first. Before
+        # Python 3.9, the workers are joined by an atexit handler registered when
+        # concurrent.futures is imported, so atexit.register() runs shutdown() before it.
+        if hasattr(threading, "_register_atexit"):
+            threading._register_atexit(scheduling.shutdown, scheduler)
+        else:
+            atexit.register(scheduling.shutdown, scheduler)
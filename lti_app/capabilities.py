@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+#  capabilities.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+"""Detect and cache what each WIMS server supports.
+
+The version of a WIMS server and the adm/raw jobs it supports are probed once and stored in a
+WimsCapability, refreshed once older than settings.WIMS_CAPABILITIES_TTL. Launch and sync paths
+use it to choose the cheapest available calls and to interpret scores, instead of guessing.
+
+Failed probes are recorded as well, the server not being probed again before
+settings.WIMS_CAPABILITIES_RETRY."""
+
+import logging
+import re
+from typing import Any, Dict, Optional, Tuple
+
+import requests
+import wimsapi
+from django.apps import apps
+from django.conf import settings
+from django.db.models import Model
+from django.utils import timezone
+from wimsapi.api import parse_response, random_code
+
+
+logger = logging.getLogger(__name__)
+
+# adm/raw jobs whose support is probed. Probes are sent with dummy parameters, a job is
+# considered supported as long as the server does not reject the job itself.
+PROBED_JOBS = [
+    "checkclass",
+    "checkuser",
+    "getsheetscores",
+    "getexamscores",
+    "listclasses",
+]
+
+# Matches the error messages of WIMS servers not recognizing a job.
+UNKNOWN_JOB = re.compile(r"(unknown|bad|invalid|unsupported|not supported).*job|job.*(unknown|"
+                         r"not (supported|allowed|defined))", re.IGNORECASE)
+
+# First version of WIMS computing the score of sheets according to the formula chosen by the
+# teacher (sent as 'sheet_formula' by getsheetscores).
+FORMULA_VERSION = (4, 18)
+
+
+
+def parse_version(version: str) -> Optional[Tuple[int, int]]:
+    """Returns the tuple (major, minor) of a WIMS version string, None if it cannot be parsed."""
+    match = re.search(r"(\d+)\.(\d+)", version or "")
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+
+def probe_job(wims: Model, job: str) -> bool:
+    """Returns whether the WIMS server <wims> supports the adm/raw job <job>."""
+    params = {
+        'module': 'adm/raw',
+        'ident':  wims.ident,
+        'passwd': wims.passwd,
+        'job':    job,
+        'code':   random_code(),
+        'rclass': wims.rclass,
+        'qclass': "0",
+        'quser':  "supervisor",
+        'qsheet': "0",
+        'qexam':  "0",
+    }
+    url = wims.url if wims.url.endswith("/") else wims.url + "/"
+    # Looked up at each call so that the tracing of lti_app.tracing and the mocks of tests apply
+    response = parse_response(wimsapi.api.post(url, data=params, timeout=settings.WIMSAPI_TIMEOUT))
+    return response["status"] == "OK" or not UNKNOWN_JOB.search(response["message"])
+
+
+
+def compute_grade(formula: str, i: Any, quality: float, cumul: float, best: float,
+                  acquired: float) -> float:
+    """Returns the grade (in [0, 10]) given by the <formula> of a sheet, <i> choosing the level of
+    success used as I (0 for <cumul>, 1 for <best>, <acquired> otherwise) and <quality> being Q.
+
+    Same computation as WIMS and wimsapi, <formula> being evaluated without builtins."""
+    i = int(i)
+    if i == 0:
+        level = cumul
+    elif i == 1:
+        level = best
+    else:
+        level = acquired
+    
+    names = {"__builtins__": {}, "I": level / 100, "Q": quality / 10, "max": max, "min": min}
+    return round(eval("10 * (%s)" % formula.replace("^", "**"), names), 2)
+
+
+
+def probe(wims: Model) -> Model:
+    """Probe the WIMS server <wims>, saving and returning its up to date WimsCapability.
+
+    If the probe fails, the time of the failure is saved before raising.
+
+    Raises:
+        - wimsapi.WimsAPIError if the WIMS' server denied a request.
+        - requests.RequestException if the WIMS server could not be joined."""
+    WimsCapability = apps.get_model("lti_app", "WimsCapability")
+    
+    try:
+        api = wimsapi.WimsAPI(wims.url, wims.ident, wims.passwd,
+                              timeout=settings.WIMSAPI_TIMEOUT)
+        status, response = api.getinfoserver(verbose=True)
+        if not status:
+            raise wimsapi.AdmRawError(response["message"])
+        version = next((str(v) for k, v in response.items() if "version" in k.lower()), "")
+        jobs = [job for job in PROBED_JOBS if probe_job(wims, job)]
+    except (wimsapi.WimsAPIError, requests.RequestException):
+        wims.capability, _ = WimsCapability.objects.update_or_create(
+            wims=wims, defaults={"failed": timezone.now()}
+        )
+        raise
+    
+    parsed = parse_version(version)
+    if parsed is None:
+        score_format = WimsCapability.SCORE_AUTO
+    elif parsed >= FORMULA_VERSION:
+        score_format = WimsCapability.SCORE_FORMULA
+    else:
+        score_format = WimsCapability.SCORE_BEST
+    
+    capability, _ = WimsCapability.objects.update_or_create(wims=wims, defaults={
+        "version":      version[:64],
+        "jobs":         " ".join(jobs),
+        "score_format": score_format,
+        "bulk_listing": "listclasses" in jobs,
+        "checked":      timezone.now(),
+        "failed":       None,
+    })
+    wims.capability = capability
+    logger.info("Capabilities of WIMS server '%s' detected (version '%s', jobs: %s)"
+                % (wims.url, version, ", ".join(jobs)))
+    return capability
+
+
+
+def get_capability(wims: Model) -> Model:
+    """Returns the WimsCapability of <wims>, probing the server if it has never been.
+
+    If the probe fails, the saved WimsCapability records the failure and assumes the most
+    conservative behaviours. Stale and failed capabilities are refreshed by the task
+    lti_app.tasks.refresh_capabilities."""
+    WimsCapability = apps.get_model("lti_app", "WimsCapability")
+    
+    try:
+        return wims.capability
+    except WimsCapability.DoesNotExist:
+        pass
+    
+    try:
+        return probe(wims)
+    except (wimsapi.WimsAPIError, requests.RequestException):
+        logger.info("Could not detect the capabilities of WIMS server '%s'" % wims.url)
+        return wims.capability
+
+
+
+def sheet_score(capability: Model, response: Dict[str, Any], data: Dict[str, Any]) -> float:
+    """Returns the score (in [0, 1]) of a user in a sheet, <response> being the response of
+    getsheetscores and <data> the entry of the user in its 'data_scores'.
+
+    The score is the one computed from the formula chosen by the teacher for WIMS >= 4.18, the
+    level of success of the user otherwise."""
+    if capability.score_format != capability.SCORE_BEST and "sheet_formula" in response:
+        try:
+            formula = response["sheet_formula"]
+            return compute_grade(
+                formula["formula"], formula["I"], data["user_quality"], data["user_percent"],
+                data["user_best"], data["user_level"]
+            ) / 10
+        except Exception:  # pragma: no cover
+            pass
+    return data["user_best"] / 100
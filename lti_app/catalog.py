@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+#  catalog.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+"""Cached catalog of the sheets and exams of the WIMS classes.
+
+The catalog of a class lists its sheets and exams with their mode and the path of their LTI
+launch. Both listings, then every item, are fetched concurrently directly through the adm/raw
+jobs, without downloading the class itself. Catalogs are cached for settings.CATALOG_CACHE_TTL
+seconds; once older than settings.CATALOG_STALE_AFTER seconds, the cached catalog is still served
+while a fresh one is fetched in the background."""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+import requests
+import wimsapi
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Model
+from django.urls import reverse
+
+from lti_app.utils import MODE
+
+
+logger = logging.getLogger(__name__)
+
+# Executor of the background refreshes of stale catalogs.
+EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="catalog")
+
+
+
+def _key(wims_pk: int, qclass: str, *parts: str) -> str:
+    """Returns the cache key of the catalog of the class <qclass> of the WIMS server <wims_pk>."""
+    return "lti_app:catalog:%d:%s" % (wims_pk, ":".join(str(p) for p in (qclass, *parts)))
+
+
+
+def fetch(wims: Model, qclass: str) -> Dict[str, Any]:
+    """Fetch the catalog of the class <qclass> of <wims> and cache it.
+
+    Raises:
+        - wimsapi.AdmRawError if the WIMS server returned an error (e.g. the class does not
+            exist anymore).
+        - requests.RequestException if the WIMS server could not be joined.
+
+    Returns a dictionary containing the list of sheets ('sheets'), the list of exams ('exams')
+    and the timestamp of the fetch ('fetched')."""
+    api = wimsapi.WimsAPI(wims.url, wims.ident, wims.passwd, timeout=settings.WIMSAPI_TIMEOUT)
+    
+    def listing(kind: str) -> List[Tuple[str, str]]:
+        status, response = getattr(api, "list%ss" % kind)(qclass, wims.rclass, verbose=True)
+        if not status:
+            raise wimsapi.AdmRawError(response['message'])
+        return [(kind, q) for q in response["%slist" % kind] if q != '']
+    
+    def item(args: Tuple[str, str]) -> Dict[str, Any]:
+        kind, identifier = args
+        status, response = getattr(api, "get" + kind)(qclass, wims.rclass, identifier,
+                                                      verbose=True)
+        if not status:
+            raise wimsapi.AdmRawError(response['message'])
+        identifier = response["query_" + kind]
+        return {
+            "q" + kind:    identifier,
+            "title":       response.get(kind + "_title", ""),
+            "description": response.get(kind + "_description", ""),
+            kind + "mode": MODE[int(response[kind + "_status"])],
+            "url":         reverse("lti:wims_" + kind, args=[wims.pk, identifier]),
+        }
+    
+    with ThreadPoolExecutor(max_workers=settings.CATALOG_CONCURRENCY) as executor:
+        listings = [executor.submit(listing, "sheet"), executor.submit(listing, "exam")]
+        items = list(executor.map(item, [i for f in listings for i in f.result()]))
+    
+    catalog = {
+        "sheets":  [i for i in items if "qsheet" in i],
+        "exams":   [i for i in items if "qexam" in i],
+        "fetched": time.time(),
+    }
+    cache.set(_key(wims.pk, qclass), catalog, settings.CATALOG_CACHE_TTL)
+    return catalog
+
+
+
+def refresh(wims: Model, qclass: str) -> None:
+    """Fetch the catalog of the class <qclass> of <wims>, dropping the cached one if the WIMS
+    server returned an error so that the next request fetches (and reports) it itself."""
+    try:
+        fetch(wims, qclass)
+    except wimsapi.WimsAPIError as e:
+        logger.info("Could not refresh the catalog of class '%s' of WIMS server '%s': %s"
+                    % (qclass, wims.url, str(e)))
+        cache.delete(_key(wims.pk, qclass))
+    except requests.RequestException:
+        logger.exception("Could not join the WIMS server '%s'" % wims.url)
+    finally:
+        cache.delete(_key(wims.pk, qclass, "refreshing"))
+
+
+
+def get(wims: Model, qclass: str) -> Dict[str, Any]:
+    """Returns the catalog of the class <qclass> of <wims> (see fetch()), from the cache if
+    available. A stale catalog triggers at most one background refresh at a time.
+
+    Raises the same exceptions as fetch() if the catalog is not cached."""
+    catalog = cache.get(_key(wims.pk, qclass))
+    if catalog is None:
+        return fetch(wims, qclass)
+    
+    stale = time.time() - catalog["fetched"] > settings.CATALOG_STALE_AFTER
+    lock = _key(wims.pk, qclass, "refreshing")
+    if stale and cache.add(lock, True, settings.CATALOG_STALE_AFTER):
+        EXECUTOR.submit(refresh, wims, qclass)
+    return catalog
+
+
+
+def invalidate(wims: Model, qclass: str) -> None:
+    """Drop the cached catalog of the class <qclass> of <wims>."""
+    cache.delete(_key(wims.pk, qclass))
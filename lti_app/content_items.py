@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#
+#  content_items.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+"""LTI 1.1 Content-Item selection of the sheets and exams of a class.
+
+A ContentItemSelectionRequest sent to the launch URL of a WIMS server displays the catalog of the
+class of the LMS' context (see lti_app.catalog), the teacher selecting sheets and exams. The
+selection is then returned to the LMS as LTI links in a single signed ContentItemSelection
+message.
+
+The parameters of the request needed to answer the LMS are kept in a signed token embedded in the
+selection form, valid for settings.CONTENT_ITEM_SELECTION_MAX_AGE seconds."""
+
+import json
+from typing import Any, Dict, List
+
+from django.conf import settings
+from django.core import signing
+from lti import ContentItemResponse
+
+from lti_app.exceptions import BadRequestException
+from lti_app.models import LMS
+
+
+# Message type of the Content-Item selection requests.
+SELECTION_REQUEST = "ContentItemSelectionRequest"
+
+# Media type of the LTI links, and media types matching it in 'accept_media_types'.
+LTI_LINK = "application/vnd.ims.lti.v1.ltilink"
+ACCEPTED = {LTI_LINK, "application/*", "*/*"}
+
+# Salt of the signed selection tokens.
+SALT = "lti_app.content_items"
+
+
+
+def check_request(parameters: Dict[str, Any]) -> None:
+    """Check that the LMS accepts LTI links in return of the selection request <parameters>.
+
+    Raises BadRequestException if this is not the case."""
+    media_types = {t.strip() for t in (parameters["accept_media_types"] or "").split(",")}
+    if media_types.isdisjoint(ACCEPTED):
+        raise BadRequestException("LTI request is invalid, parameter 'accept_media_types' must "
+                                  "accept '%s'" % LTI_LINK)
+
+
+
+def dumps(wclass_pk: int, parameters: Dict[str, Any]) -> str:
+    """Returns the token signing the parameters of the selection request <parameters> made from
+    the class <wclass_pk>."""
+    return signing.dumps({
+        "wclass":     wclass_pk,
+        "return_url": parameters["content_item_return_url"],
+        "data":       parameters["data"],
+        "multiple":   parameters["accept_multiple"] != "false",
+        "target":     target(parameters["accept_presentation_document_targets"]),
+    }, salt=SALT)
+
+
+
+def loads(token: str) -> Dict[str, Any]:
+    """Returns the content of the <token> returned by dumps().
+
+    Raises BadRequestException if the token is invalid or expired."""
+    try:
+        return signing.loads(token, salt=SALT, max_age=settings.CONTENT_ITEM_SELECTION_MAX_AGE)
+    except signing.BadSignature:
+        raise BadRequestException("The selection is invalid or expired, please start again from "
+                                  "your LMS.")
+
+
+
+def target(accepted: str) -> str:
+    """Returns the presentation document target to advise among the <accepted> ones, WIMS
+    preferably opening in a new window."""
+    targets = [t.strip() for t in (accepted or "").split(",") if t.strip()]
+    for preferred in ("window", "iframe", "frame"):
+        if preferred in targets:
+            return preferred
+    return targets[0] if targets else "window"
+
+
+
+def graph(items: List[Dict[str, Any]], document_target: str) -> str:
+    """Returns the JSON-LD 'content_items' parameter describing <items>, each being a dictionary
+    containing the title, the description and the absolute LTI URL of the item, to be presented
+    in <document_target>."""
+    return json.dumps({
+        "@context": "http://purl.imsglobal.org/ctx/lti/v1/ContentItem",
+        "@graph":   [
+            {
+                "@type":           "LtiLinkItem",
+                "mediaType":       LTI_LINK,
+                "url":             item["lti_url"],
+                "title":           item["title"],
+                "text":            item["description"],
+                "placementAdvice": {"presentationDocumentTarget": document_target},
+            } for item in items
+        ],
+    })
+
+
+
+def response(lms: LMS, selection: Dict[str, Any], items: List[Dict[str, Any]]
+             ) -> Dict[str, str]:
+    """Returns the parameters of the ContentItemSelection message returning <items> to <lms>,
+    signed with its key and secret."""
+    params = {
+        "lti_message_type": "ContentItemSelection",
+        "lti_version":      "LTI-1p0",
+        "content_items":    graph(items, selection["target"]),
+    }
+    if selection["data"] is not None:
+        params["data"] = selection["data"]
+    
+    message = ContentItemResponse(lms.key, lms.secret, params=params,
+                                  launch_url=selection["return_url"])
+    return message.generate_launch_data()
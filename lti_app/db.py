@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+#  db.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+"""Tuning of the database connections.
+
+Connected by lti_app.apps.LtiAppConfig.ready():
+
+    - configure_sqlite() applies settings.SQLITE_PRAGMAS to every new SQLite connection, WAL
+        journaling allowing launches to read while another one writes.
+    - check_connections() drops, at the start of each request, persistent connections (see
+        CONN_MAX_AGE) that can no longer be used, e.g. after a restart of the database server,
+        instead of failing the request. Enabled by settings.DATABASE_HEALTH_CHECKS.
+
+estimated_count() gives the approximate number of rows of a table without scanning it."""
+
+import logging
+from typing import Any, Optional, Type
+
+from django.conf import settings
+from django.db import connections, models
+from django.db.backends.base.base import BaseDatabaseWrapper
+
+
+logger = logging.getLogger(__name__)
+
+
+
+def configure_sqlite(sender: Any, connection: BaseDatabaseWrapper, **kwargs: Any) -> None:
+    """Apply settings.SQLITE_PRAGMAS to a newly created SQLite connection."""
+    if connection.vendor != "sqlite":
+        return
+    
+    with connection.cursor() as cursor:
+        for pragma, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute("PRAGMA %s = %s" % (pragma, value))
+
+
+
+def check_connections(**kwargs: Any) -> None:
+    """Close the persistent connections which are not usable anymore, a new one being opened by
+    the next query."""
+    if not settings.DATABASE_HEALTH_CHECKS:
+        return
+    
+    for connection in connections.all():
+        if connection.connection is not None and not connection.is_usable():
+            logger.info("Closing unusable connection to database '%s'" % connection.alias)
+            connection.close()
+
+
+
+def estimated_count(model: Type[models.Model]) -> Optional[int]:
+    """Returns an estimation of the number of rows of <model>'s table, read from the statistics of
+    the database (PostgreSQL, MySQL) or from the greatest primary key (other databases), the
+    latter overstating the number of rows once some have been deleted.
+    
+    Returns None if no estimation is available, e.g. if the table has never been analyzed."""
+    connection = connections[model.objects.db]
+    table = model._meta.db_table
+    
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                           [connection.ops.quote_name(table)])
+        elif connection.vendor == "mysql":
+            cursor.execute("SELECT table_rows FROM information_schema.tables "
+                           "WHERE table_schema = DATABASE() AND table_name = %s", [table])
+        else:
+            cursor.execute("SELECT MAX(%s) FROM %s" % (
+                connection.ops.quote_name(model._meta.pk.column), connection.ops.quote_name(table)
+            ))
+        row = cursor.fetchone()
+    
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
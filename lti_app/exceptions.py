@@ -8,5 +8,5 @@
 
 
 class BadRequestException(Exception):
-    """Raised if the LTI request is not valid."""
+    """Raised if the LTI request, or the parameters of a request to the API, are not valid."""
     pass
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#
+#  export.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+"""Streaming export of classes, users and grade links as CSV or NDJSON.
+
+Rows are read through QuerySet.iterator() (a server-side cursor on PostgreSQL), by chunks of
+settings.SCHEDULED_JOBS_CHUNK_SIZE, and written one line at a time, so that memory usage does not
+depend on the number of exported rows. Used by the 'export' management command and the admin
+actions of lti_app.admin."""
+
+import csv
+import json
+from typing import Any, Dict, Iterator, List, Tuple
+
+from django.apps import apps
+from django.conf import settings
+from django.db.models import QuerySet
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+
+# Exported tables: name -> (model, exported fields, joined with the names of the LMS and WIMS).
+EXPORTS: Dict[str, Tuple[str, List[str]]] = {
+    "classes":           ("WimsClass", [
+        "id", "lms__name", "lms__guid", "wims__name", "wims__url", "lms_guid", "qclass", "name",
+        "expiration",
+    ]),
+    "users":             ("WimsUser", [
+        "id", "wclass__lms__name", "wclass__wims__name", "wclass__qclass", "lms_guid", "quser",
+    ]),
+    "grade_links_sheet": ("GradeLinkSheet", [
+        "id", "service__lms__name", "activity__wclass__wims__name", "activity__wclass__qclass",
+        "activity__qsheet", "user__lms_guid", "user__quser", "sourcedid", "service__url",
+    ]),
+    "grade_links_exam":  ("GradeLinkExam", [
+        "id", "service__lms__name", "activity__wclass__wims__name", "activity__wclass__qclass",
+        "activity__qexam", "user__lms_guid", "user__quser", "sourcedid", "service__url",
+    ]),
+}
+
+# Export formats: name -> content type.
+FORMATS = {
+    "csv":    "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+
+
+class Echo:
+    """File-like object returning what is written to it, allowing csv.writer to produce lines
+    one at a time."""
+    
+    
+    def write(self, value: str) -> str:
+        return value
+
+
+
+def queryset(name: str) -> QuerySet:
+    """Returns every row of the exported table <name>."""
+    return apps.get_model("lti_app", EXPORTS[name][0]).objects.all()
+
+
+
+def table(queryset: QuerySet) -> str:
+    """Returns the name of the exported table of <queryset>'s model."""
+    model = queryset.model.__name__
+    return next(name for name, (m, _) in EXPORTS.items() if m == model)
+
+
+
+def rows(queryset: QuerySet, fields: List[str]) -> Iterator[Tuple[Any, ...]]:
+    """Yields the <fields> of each row of <queryset>, ordered by primary key."""
+    return queryset.order_by("pk").values_list(*fields).iterator(
+        chunk_size=settings.SCHEDULED_JOBS_CHUNK_SIZE
+    )
+
+
+
+def csv_lines(queryset: QuerySet, fields: List[str]) -> Iterator[str]:
+    """Yields the header then each row of <queryset> as CSV lines."""
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows(queryset, fields):
+        yield writer.writerow(row)
+
+
+
+def ndjson_lines(queryset: QuerySet, fields: List[str]) -> Iterator[str]:
+    """Yields each row of <queryset> as a JSON object per line."""
+    for row in rows(queryset, fields):
+        yield json.dumps(dict(zip(fields, row)), default=str) + "\n"
+
+
+
+def lines(queryset: QuerySet, fmt: str) -> Iterator[str]:
+    """Yields the lines of the export of <queryset> in the format <fmt>."""
+    fields = EXPORTS[table(queryset)][1]
+    return csv_lines(queryset, fields) if fmt == "csv" else ndjson_lines(queryset, fields)
+
+
+
+def response(queryset: QuerySet, fmt: str) -> StreamingHttpResponse:
+    """Returns a response streaming the export of <queryset> in the format <fmt> as an
+    attachment."""
+    name = "%s-%s.%s" % (table(queryset), timezone.now().strftime("%Y%m%d-%H%M%S"), fmt)
+    response = StreamingHttpResponse(lines(queryset, fmt), content_type=FORMATS[fmt])
+    response["Content-Disposition"] = 'attachment; filename="%s"' % name
+    return response
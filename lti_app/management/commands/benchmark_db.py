@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+#  benchmark_db.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import OperationalError, close_old_connections, connection
+from django.test.utils import override_settings
+
+from lti_app.models import (GradeLinkSheet, LMS, OutcomeService, WIMS, WimsClass, WimsSheet,
+                            WimsUser, lookup, upsert)
+
+
+# PRAGMA of a SQLite database left to its defaults, compared to settings.SQLITE_PRAGMAS.
+SQLITE_DEFAULTS = {
+    'journal_mode': 'DELETE',
+    'busy_timeout': 0,
+    'synchronous':  'FULL',
+}
+
+
+
+class Command(BaseCommand):
+    help = ("Measure the throughput of the database queries of concurrent launches, comparing the "
+            "configured database to non persistent connections (and to SQLite defaults).")
+    
+    
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--launches", type=int, default=500, help="Launches per profile.")
+        parser.add_argument("--concurrency", type=int, default=8,
+                            help="Number of launches running at the same time.")
+        parser.add_argument("--classes", type=int, default=20,
+                            help="Number of classes the launches are spread over.")
+    
+    
+    def handle(self, *args: Any, **options: Any) -> None:
+        prefix = "benchmark-%s" % uuid.uuid4().hex[:8]
+        lms = LMS.objects.create(guid=prefix, url="https://%s.invalid/" % prefix, name=prefix,
+                                 key=prefix, secret=prefix)
+        wims = WIMS.objects.create(url="https://%s.invalid/wims.cgi" % prefix, name=prefix,
+                                   ident=prefix, passwd=prefix, rclass=prefix)
+        try:
+            for i in range(options["classes"]):
+                wclass = WimsClass.objects.create(lms=lms, lms_guid=str(i), wims=wims,
+                                                  qclass="%s-%d" % (prefix, i), name=prefix)
+                WimsUser.objects.create(wclass=wclass, lms_guid=str(i), quser="jdoe")
+            
+            profiles = [("configured", False, None), ("no persistent connections", True, None)]
+            if connection.vendor == "sqlite":
+                profiles.append(("sqlite defaults", True, SQLITE_DEFAULTS))
+            
+            for name, close, pragmas in profiles:
+                self.run(name, lms, wims, options, close, pragmas)
+        finally:
+            close_old_connections()
+            lms.delete()
+            wims.delete()
+    
+    
+    def run(self, name: str, lms: LMS, wims: WIMS, options: Dict[str, Any], close: bool,
+            pragmas: Dict[str, Any]) -> None:
+        """Run the launches of a profile, closing connections after each one if <close> is True,
+        and applying <pragmas> to SQLite connections if given."""
+        launches, classes = options["launches"], options["classes"]
+        connection.close()
+        
+        def worker(indexes: List[int]) -> List[str]:
+            errors = []
+            try:
+                for i in indexes:
+                    try:
+                        launch(lms, wims, i % classes, i)
+                    except OperationalError as e:
+                        errors.append(str(e))
+                    if close:
+                        connection.close()
+                    else:
+                        close_old_connections()
+            finally:
+                connection.close()
+            return errors
+        
+        chunks = [list(range(i, launches, options["concurrency"]))
+                  for i in range(options["concurrency"])]
+        with override_settings(**({"SQLITE_PRAGMAS": pragmas} if pragmas is not None else {})):
+            start = time.perf_counter()
+            with ThreadPoolExecutor(options["concurrency"]) as executor:
+                errors = sum(executor.map(worker, chunks), [])
+            elapsed = time.perf_counter() - start
+        
+        self.stdout.write("%-28s %8.1f launches/s  %5d errors  (%d launches in %.2fs)"
+                          % (name, launches / elapsed, len(errors), launches, elapsed))
+        for error in sorted(set(errors)):
+            self.stdout.write("    %s" % error)
+
+
+
+def launch(lms: LMS, wims: WIMS, cls: int, i: int) -> None:
+    """Execute the queries of the launch of a sheet by a returning student, the outcome sourcedid
+    changing on every launch so that each one writes."""
+    lms = LMS.objects.get(**lookup("guid", lms.guid))
+    wclass = WimsClass.objects.get(wims=wims, lms=lms, **lookup("lms_guid", str(cls)))
+    user = WimsUser.objects.get(wclass=wclass, **lookup("lms_guid", str(cls)))
+    sheet, _ = upsert(WimsSheet, {"wclass": wclass, "qsheet": "1"}, lookup("lms_guid", "1"))
+    service = OutcomeService.get(lms, "https://%s/outcome" % lms.url)
+    upsert(GradeLinkSheet, {"user": user, "activity": sheet}, {
+        "sourcedid":  str(i),
+        "service_id": service.pk,
+    })
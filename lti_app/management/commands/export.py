@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#
+#  export.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from lti_app import export
+
+
+
+class Command(BaseCommand):
+    help = ("Export every row of a table (joined with the names of its LMS and WIMS server) as CSV "
+            "or NDJSON, see lti_app/export.py.")
+    
+    
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("table", choices=sorted(export.EXPORTS), help="Table to export.")
+        parser.add_argument("--format", choices=sorted(export.FORMATS), default="csv",
+                            help="Format of the export (default: csv).")
+        parser.add_argument("--output", default=None,
+                            help="File to write the export to (default: standard output).")
+    
+    
+    def handle(self, *args: Any, **options: Any) -> None:
+        lines = export.lines(export.queryset(options["table"]), options["format"])
+        if options["output"] is None:
+            for line in lines:
+                self.stdout.write(line, ending="")
+            return
+        
+        with open(options["output"], "w", newline="") as f:
+            f.writelines(lines)
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+#
+#  load_test.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import oauth2
+import oauthlib.oauth1.rfc5849.signature as oauth_signature
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import close_old_connections, connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from lti_app.models import LMS, WIMS, WimsClass, WimsUser
+from lti_app.stub import FAULTS, StubLMSServer, StubWims, StubWimsServer
+
+
+# Arrival patterns of the launches, see schedule().
+PATTERNS = ("class", "exam", "trickle")
+
+# Host the launches are sent to, the OAuth signature covering the URL.
+HOST = "testserver"
+
+# Percentiles of the latency included in the report.
+PERCENTILES = (50, 90, 95, 99)
+
+
+
+class Arrival(NamedTuple):
+    """A launch of <view> by the student <student> (None for the teacher) of the class <cls>,
+    <offset> seconds after the start of the run."""
+    offset: float
+    view: str
+    cls: int
+    student: Optional[int]
+
+
+
+def schedule(pattern: str, classes: int, students: int, ramp: float, duration: float,
+             rate: float, rng: random.Random) -> List[Arrival]:
+    """Returns the arrivals of the launches of <pattern>, sorted by offset:
+
+        - 'class': every class starts at the same time, its teacher opening the sheet then its
+          <students> launching the class or the sheet within <ramp> seconds.
+        - 'exam': every class starts an exam at the same time, its teacher opening the exam then
+          its <students> launching it within <ramp> seconds.
+        - 'trickle': launches of any view by any user of the <classes> arrive at random (a
+          Poisson process of <rate> launches per second) during <duration> seconds."""
+    arrivals = []
+    if pattern == "trickle":
+        offset = rng.expovariate(rate)
+        while offset < duration:
+            student = rng.randrange(students + 1)
+            arrivals.append(Arrival(
+                offset, rng.choice(("wims_class", "wims_sheet", "wims_exam")),
+                rng.randrange(classes), student if student < students else None
+            ))
+            offset += rng.expovariate(rate)
+        return arrivals
+    
+    for cls in range(classes):
+        arrivals.append(Arrival(0, "wims_exam" if pattern == "exam" else "wims_sheet", cls, None))
+        for student in range(students):
+            if pattern == "exam":
+                view = "wims_exam"
+            else:
+                view = "wims_sheet" if rng.random() < 0.7 else "wims_class"
+            arrivals.append(Arrival(rng.uniform(0, ramp), view, cls, student))
+    return sorted(arrivals, key=lambda arrival: arrival.offset)
+
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Returns the <p>-th percentile (nearest rank) of the sorted list <values>."""
+    if not values:
+        return 0
+    return values[max(0, min(len(values), round(p / 100 * len(values))) - 1)]
+
+
+
+class Command(BaseCommand):
+    help = ("Send the LTI launches of synthetic classes following an arrival pattern, against "
+            "a stub of WIMS and a fake LMS, and report the throughput, latency, errors and costs "
+            "of the launches. The LMS, WIMS, classes and users of the run are created in the "
+            "configured database and deleted afterwards, do not run it against a production "
+            "database.")
+    
+    
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--pattern", choices=PATTERNS, default="class",
+                            help="Arrival pattern of the launches.")
+        parser.add_argument("--classes", type=int, default=10, help="Number of classes.")
+        parser.add_argument("--students", type=int, default=30,
+                            help="Number of students in each class.")
+        parser.add_argument("--returning", type=float, default=0,
+                            help="Fraction of the students who already launched once.")
+        parser.add_argument("--ramp", type=float, default=5,
+                            help="Seconds over which the students of the 'class' and 'exam' "
+                                 "patterns arrive.")
+        parser.add_argument("--duration", type=float, default=60,
+                            help="Duration of the 'trickle' pattern, in seconds.")
+        parser.add_argument("--rate", type=float, default=5,
+                            help="Launches per second of the 'trickle' pattern.")
+        parser.add_argument("--concurrency", type=int, default=16,
+                            help="Number of launches processed at the same time.")
+        parser.add_argument("--latency", type=float, default=0.02,
+                            help="Seconds waited by the stub of WIMS before each answer.")
+        parser.add_argument("--fault", choices=FAULTS,
+                            help="Fault injected in a fraction of the WIMS calls.")
+        parser.add_argument("--fault-rate", type=float, default=0.01,
+                            help="Fraction of the WIMS calls failing with --fault.")
+        parser.add_argument("--seed", type=int, default=0, help="Seed of the random generators.")
+        parser.add_argument("--json", dest="report", help="Also write the report to this file.")
+        parser.add_argument("--noinput", "--no-input", action="store_false", dest="interactive",
+                            help="Do not ask for confirmation before writing to the database.")
+    
+    
+    def handle(self, *args: Any, **options: Any) -> None:
+        if options["interactive"]:
+            confirm = input("The load test creates then deletes rows in the database '%s'.\n"
+                            "Type 'yes' to continue, or 'no' to cancel: "
+                            % connection.settings_dict["NAME"])
+            if confirm != "yes":
+                raise CommandError("Load test cancelled.")
+        
+        rng = random.Random(options["seed"])
+        stub = StubWims(latency=options["latency"], seed=options["seed"])
+        prefix = "loadtest%s" % uuid.uuid4().hex[:8]  # OAuth keys must be alphanumeric
+        
+        # Injected timeouts hold the calls sent without a timeout twice as long as the others
+        wims_server = StubWimsServer(stub, timeout_delay=settings.WIMSAPI_TIMEOUT * 2)
+        with wims_server, StubLMSServer() as lms_server:
+            lms = LMS.objects.create(guid=prefix, url="https://%s.invalid/" % prefix, name=prefix,
+                                     key=prefix, secret=prefix)
+            wims = WIMS.objects.create(url=wims_server.url, name=prefix, ident=stub.ident,
+                                       passwd=stub.passwd, rclass=prefix)
+            try:
+                self.provision(stub, lms, wims, prefix, rng, options)
+                arrivals = schedule(options["pattern"], options["classes"], options["students"],
+                                    options["ramp"], options["duration"], options["rate"], rng)
+                stub.reset()
+                if options["fault"]:
+                    stub.inject(options["fault"], count=None, rate=options["fault_rate"])
+                
+                # Failed launches are counted in the report, only log them if asked to
+                loggers = [logging.getLogger(name) for name in ("django.request", "lti_app")]
+                levels = [logger.level for logger in loggers]
+                if options["verbosity"] < 2:
+                    for logger in loggers:
+                        logger.setLevel(logging.CRITICAL)
+                try:
+                    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, HOST]):
+                        results, elapsed = self.run(arrivals, lms, wims, lms_server, prefix,
+                                                    options)
+                finally:
+                    for logger, level in zip(loggers, levels):
+                        logger.setLevel(level)
+                report = self.report(results, elapsed, stub, lms_server)
+            finally:
+                close_old_connections()
+                lms.delete()
+                wims.delete()
+        
+        self.write(report)
+        if options["report"]:
+            with open(options["report"], "w") as f:
+                json.dump(report, f, indent=4, sort_keys=True)
+    
+    
+    def provision(self, stub: StubWims, lms: LMS, wims: WIMS, prefix: str, rng: random.Random,
+                  options: Dict[str, Any]) -> None:
+        """Create the classes on the stub and in the database, the returning students having
+        already been created in both."""
+        for cls, qclass in enumerate(stub.populate(options["classes"], 0)):
+            wclass = WimsClass.objects.create(lms=lms, lms_guid="%s-%d" % (prefix, cls),
+                                              wims=wims, qclass=qclass, name=prefix)
+            WimsUser.objects.create(wclass=wclass, quser="supervisor")
+            for student in range(options["students"]):
+                if rng.random() >= options["returning"]:
+                    continue
+                quser = "student%d" % student
+                stub.classes[qclass]["users"][quser] = {
+                    "lastname": "Student", "firstname": str(student), "password": "password",
+                    "email": "",
+                }
+                WimsUser.objects.create(wclass=wclass, lms_guid=str(student), quser=quser)
+    
+    
+    def run(self, arrivals: List[Arrival], lms: LMS, wims: WIMS, lms_server: StubLMSServer,
+            prefix: str, options: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], float]:
+        """Send the launches of <arrivals> on time, returning their results and the duration of
+        the run."""
+        local = threading.local()
+        
+        def launch(arrival: Arrival, scheduled: float) -> Dict[str, Any]:
+            if not hasattr(local, "client"):
+                local.client = Client(HTTP_HOST=HOST, raise_request_exception=False)
+            args = [wims.pk] if arrival.view == "wims_class" else [wims.pk, 1]
+            url = reverse("lti:" + arrival.view, args=args)
+            data = self.params(url, lms, lms_server, prefix, arrival)
+            
+            start = time.perf_counter()
+            try:
+                with CaptureQueriesContext(connection) as captured:
+                    status = local.client.post(url, data, secure=True).status_code
+            finally:
+                close_old_connections()
+            end = time.perf_counter()
+            return {
+                "view":    arrival.view,
+                "status":  status,
+                "latency": end - start,
+                "lag":     start - scheduled,
+                "queries": len(captured.captured_queries),
+            }
+        
+        futures = []
+        with ThreadPoolExecutor(options["concurrency"]) as executor:
+            begin = time.perf_counter()
+            for arrival in arrivals:
+                delay = begin + arrival.offset - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(executor.submit(launch, arrival, begin + arrival.offset))
+            results = [future.result() for future in futures]
+            elapsed = time.perf_counter() - begin
+        return results, elapsed
+    
+    
+    @staticmethod
+    def params(url: str, lms: LMS, lms_server: StubLMSServer, prefix: str, arrival: Arrival
+               ) -> Dict[str, str]:
+        """Returns the signed parameters of the launch <arrival> to <url>."""
+        if arrival.student is None:
+            user, roles, family, given = "teacher", "Instructor", "Teacher", ""
+        else:
+            user, roles = str(arrival.student), "Learner"
+            family, given = "Student", str(arrival.student)
+        
+        params = {
+            'lti_message_type':                   'basic-lti-launch-request',
+            'lti_version':                        'LTI-1p0',
+            'launch_presentation_locale':         'fr-FR',
+            'resource_link_id':                   "%s-%s" % (prefix, arrival.view),
+            'context_id':                         "%s-%d" % (prefix, arrival.cls),
+            'context_title':                      "Class %d" % arrival.cls,
+            'user_id':                            user,
+            'lis_person_contact_email_primary':   '%s@%s.invalid' % (user, prefix),
+            'lis_person_name_family':             family,
+            'lis_person_name_given':              given,
+            'lis_result_sourcedid':               "%d:%s" % (arrival.cls, user),
+            'lis_outcome_service_url':            lms_server.url,
+            'tool_consumer_instance_description': prefix,
+            'tool_consumer_instance_guid':        lms.guid,
+            'oauth_consumer_key':                 lms.key,
+            'oauth_signature_method':             'HMAC-SHA1',
+            'oauth_timestamp':                    str(oauth2.generate_timestamp()),
+            'oauth_nonce':                        oauth2.generate_nonce(),
+            'roles':                              roles,
+        }
+        norm_params = oauth_signature.normalize_parameters([(k, v) for k, v in params.items()])
+        uri = oauth_signature.base_string_uri("https://%s%s" % (HOST, url))
+        base_string = oauth_signature.signature_base_string("POST", uri, norm_params)
+        params['oauth_signature'] = oauth_signature.sign_hmac_sha1(base_string, lms.secret, None)
+        return params
+    
+    
+    @staticmethod
+    def report(results: List[Dict[str, Any]], elapsed: float, stub: StubWims,
+               lms_server: StubLMSServer) -> Dict[str, Any]:
+        """Returns the report of the launches <results>, by view and in total."""
+        groups = defaultdict(list)
+        for result in results:
+            groups[result["view"]].append(result)
+            groups["total"].append(result)
+        
+        report = {
+            "elapsed":   elapsed,
+            "wims_jobs": dict(stub.calls),
+            "grades":    len(lms_server.grades),
+            "views":     {},
+        }
+        for view, group in groups.items():
+            latencies = sorted(r["latency"] for r in group)
+            errors = [r for r in group if r["status"] >= 400]
+            report["views"][view] = {
+                "launches":     len(group),
+                "throughput":   len(group) / elapsed if elapsed else 0,
+                "errors":       len(errors),
+                "error_rate":   len(errors) / len(group),
+                "statuses":     dict(Counter(str(r["status"]) for r in group)),
+                "latency_ms":   {
+                    **{"p%d" % p: percentile(latencies, p) * 1000 for p in PERCENTILES},
+                    "max": latencies[-1] * 1000,
+                },
+                "max_lag_ms":   max(r["lag"] for r in group) * 1000,
+                "queries":      sum(r["queries"] for r in group) / len(group),
+            }
+        report["wims_calls"] = sum(stub.calls.values()) / len(results) if results else 0
+        return report
+    
+    
+    def write(self, report: Dict[str, Any]) -> None:
+        """Write a summary of <report> on stdout."""
+        self.stdout.write("%-12s %8s %9s %7s %8s %8s %8s %8s %9s"
+                          % ("view", "launches", "launch/s", "errors", "p50 ms", "p95 ms",
+                             "p99 ms", "max ms", "queries"))
+        for view, stats in sorted(report["views"].items(), key=lambda i: i[0] == "total"):
+            latency = stats["latency_ms"]
+            self.stdout.write("%-12s %8d %9.1f %6.1f%% %8.1f %8.1f %8.1f %8.1f %9.1f"
+                              % (view, stats["launches"], stats["throughput"],
+                                 stats["error_rate"] * 100, latency["p50"], latency["p95"],
+                                 latency["p99"], latency["max"], stats["queries"]))
+        
+        self.stdout.write("")
+        self.stdout.write("Duration: %.2fs, WIMS calls per launch: %.1f, grades sent back: %d"
+                          % (report["elapsed"], report["wims_calls"],
+                             report["grades"]))
+        self.stdout.write("WIMS calls: %s" % ", ".join(
+            "%s=%d" % (job, count) for job, count in sorted(report["wims_jobs"].items())
+        ))
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+#
+#  provision_roster.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from lti_app import roster
+from lti_app.models import WimsClass
+
+
+
+class Command(BaseCommand):
+    help = ("Create in advance the WIMS accounts of the students of a roster (CSV with the columns "
+            "user_id, firstname, lastname and email) in a class, see lti_app/roster.py.")
+    
+    
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("wclass", type=int, help="Primary key of the WimsClass.")
+        parser.add_argument("roster", help="Path to the CSV roster.")
+        parser.add_argument("--concurrency", type=int, default=None,
+                            help="Accounts created at the same time (default: "
+                                 "settings.ROSTER_CONCURRENCY).")
+        parser.add_argument("--batch-size", type=int, default=None,
+                            help="Accounts created per batch (default: "
+                                 "settings.ROSTER_BATCH_SIZE).")
+    
+    
+    def handle(self, *args: Any, **options: Any) -> None:
+        try:
+            wclass_db = WimsClass.objects.select_related("wims").get(pk=options["wclass"])
+        except WimsClass.DoesNotExist:
+            raise CommandError("No WimsClass with id %d" % options["wclass"])
+        
+        try:
+            with open(options["roster"], newline="") as f:
+                rows = roster.read(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        
+        report = roster.provision(wclass_db, rows, options["concurrency"], options["batch_size"])
+        self.stdout.write("%d created, %d already existing, %d failed"
+                          % (report["created"], report["existing"], len(report["failed"])))
+        for user_id, error in report["failed"]:
+            self.stdout.write("    %s: %s" % (user_id, error))
+        for quser in report["orphaned"]:
+            self.stdout.write("    orphaned WIMS user, to delete manually: %s" % quser)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+#
+#  wims_stub.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from lti_app.stub import FAULTS, StubWims, StubWimsServer
+
+
+
+class Command(BaseCommand):
+    help = ("Serve an in-memory imitation of the adm/raw module of a WIMS server, for benchmarks "
+            "and load tests not to depend on a real WIMS server.")
+    
+    
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+        parser.add_argument("--port", type=int, default=7777, help="Port to listen on.")
+        parser.add_argument("--ident", default="myself", help="Identifier expected by the stub.")
+        parser.add_argument("--passwd", default="toto", help="Password expected by the stub.")
+        parser.add_argument("--latency", type=float, default=0,
+                            help="Seconds waited before answering each request.")
+        parser.add_argument("--classes", type=int, default=0,
+                            help="Number of classes created at start-up.")
+        parser.add_argument("--students", type=int, default=0,
+                            help="Number of students of each class created at start-up.")
+        parser.add_argument("--fault", choices=FAULTS,
+                            help="Fault injected in a fraction of the requests.")
+        parser.add_argument("--fault-rate", type=float, default=0.01,
+                            help="Fraction of the requests failing with --fault.")
+    
+    
+    def handle(self, *args: Any, **options: Any) -> None:
+        stub = StubWims(options["ident"], options["passwd"], latency=options["latency"])
+        qclasses = stub.populate(options["classes"], options["students"])
+        if options["fault"]:
+            stub.inject(options["fault"], count=None, rate=options["fault_rate"])
+        
+        server = StubWimsServer(stub, options["host"], options["port"])
+        self.stdout.write("Serving a stub of WIMS at %s" % server.url)
+        if qclasses:
+            self.stdout.write("Classes: %s" % ", ".join(qclasses))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+#
+#  metrics.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+"""Counters and histograms of the launches (and their stages), WIMS calls, grades sent back and
+scheduled jobs, exposed in the Prometheus text format.
+
+Every process keeps its samples in memory, an observation only costing a lock and a few
+additions. If settings.METRICS_DIR is set, each process writes its samples to its own file of
+this directory at most every settings.METRICS_FLUSH_INTERVAL seconds, the samples of every
+worker being summed when rendered. Files are named after the pid and the start of their process,
+and those of dead workers are folded into DEAD when rendering, so that counters never go
+backwards when a pid is reused::
+
+    metrics.inc("lti_send_back_total", lms="elearning.upem.fr", outcome="ok")
+    with metrics.timer("lti_job_seconds", job="archive_expired_classes"):
+        ...
+    metrics.render()"""
+
+import bisect
+import functools
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of the buckets of the histograms.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Declared metrics: name -> (type, help).
+METRICS = {
+    "lti_launch_seconds":            ("histogram", "Duration of the LTI launches, by view and "
+                                                   "status."),
+    "lti_launch_stage_seconds":      ("histogram", "Duration of the stages of the LTI launches, "
+                                                   "by view and stage."),
+    "lti_wims_call_seconds":         ("histogram", "Duration of the adm/raw calls, by WIMS "
+                                                   "server, job and outcome."),
+    "lti_wims_response_bytes_total": ("counter", "Size of the responses to the adm/raw calls, by "
+                                                 "WIMS server and job."),
+    "lti_send_back_seconds":         ("histogram", "Duration of the grades sent back, by LMS and "
+                                                   "outcome."),
+    "lti_job_seconds":               ("histogram", "Duration of the scheduled jobs, by job and "
+                                                   "outcome."),
+}
+
+# File of METRICS_DIR containing the samples of the dead workers.
+DEAD = "dead.json"
+
+Labels = Tuple[Tuple[str, str], ...]
+Samples = Dict[Tuple[str, Labels], Union[float, List[Any]]]
+
+# Samples of this process: (name, labels) -> counter value, or [bucket counts, sum] for
+# histograms (the last bucket counting observations above every bound).
+SAMPLES: Samples = {}
+
+_lock = threading.Lock()
+_next_flush = 0.0
+# Pid of this process and time of its first flush (in milliseconds), naming its file.
+_identity = (0, 0)
+
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+
+def inc(name: str, value: float = 1, **labels: Any) -> None:
+    """Increment the counter <name> with <labels> by <value>."""
+    key = (name, _labels(labels))
+    with _lock:
+        SAMPLES[key] = SAMPLES.get(key, 0) + value
+    _maybe_flush()
+
+
+
+def observe(name: str, value: float, **labels: Any) -> None:
+    """Add the observation <value> to the histogram <name> with <labels>."""
+    key = (name, _labels(labels))
+    index = bisect.bisect_left(BUCKETS, value)
+    with _lock:
+        sample = SAMPLES.get(key)
+        if sample is None:
+            sample = SAMPLES[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+        sample[0][index] += 1
+        sample[1] += value
+    _maybe_flush()
+
+
+
+@contextmanager
+def timer(name: str, **labels: Any) -> Iterator[Dict[str, Any]]:
+    """Observe the time spent in the block in the histogram <name>.
+
+    The yielded dictionary contains <labels> and can be updated in the block, the 'outcome' label
+    defaulting to 'error' if an exception is raised and to 'ok' otherwise."""
+    labels = dict(labels)
+    start = time.perf_counter()
+    try:
+        yield labels
+    except BaseException:
+        labels.setdefault("outcome", "error")
+        raise
+    finally:
+        labels.setdefault("outcome", "ok")
+        observe(name, time.perf_counter() - start, **labels)
+
+
+
+def timed(name: str, **labels: Any) -> Callable:
+    """Decorator observing the duration of each call of the decorated function in the histogram
+    <name>, see timer()."""
+    
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with timer(name, **labels):
+                return function(*args, **kwargs)
+        
+        return wrapper
+    
+    return decorator
+
+
+
+class Timing:
+    """Split the time spent in a launch into consecutive stages.
+    
+    Each call to lap() ends a stage, which started at the end of the previous one (or at the
+    creation of the instance), so that the stages cover the whole launch."""
+    
+    
+    def __init__(self, clock: Callable[[], float] = time.perf_counter):
+        self.clock = clock
+        self.start = self.last = clock()
+        self.stages: List[Tuple[str, float]] = []
+    
+    
+    def lap(self, stage: str) -> None:
+        """End the stage <stage>."""
+        now = self.clock()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+    
+    
+    def elapsed(self) -> float:
+        """Returns the time elapsed since the creation of the instance."""
+        return self.clock() - self.start
+    
+    
+    def header(self, total: float) -> str:
+        """Returns the value of the Server-Timing header describing the stages and the <total>
+        duration of the launch."""
+        return ", ".join(
+            "%s;dur=%.1f" % (stage, duration * 1000)
+            for stage, duration in self.stages + [("total", total)]
+        )
+
+
+
+def _report(view: str, request: HttpRequest, response: Optional[HttpResponse]) -> None:
+    """Observe the launch <request> made on <view> and its stages, adding the Server-Timing
+    header to <response> (None if the view raised an exception) and logging the launch if it
+    took longer than settings.LAUNCH_SLOW_THRESHOLD seconds."""
+    timing = request.timing
+    total = timing.elapsed()
+    
+    labels = {"view": view, "outcome": "error"}
+    if response is not None:
+        labels.update(outcome="ok", status=response.status_code)
+        if settings.LAUNCH_SERVER_TIMING:
+            response["Server-Timing"] = timing.header(total)
+    observe("lti_launch_seconds", total, **labels)
+    for stage, duration in timing.stages:
+        observe("lti_launch_stage_seconds", duration, view=view, stage=stage)
+    
+    if total >= settings.LAUNCH_SLOW_THRESHOLD:
+        logger.warning("Slow launch: %s" % json.dumps({
+            "view":       view,
+            "path":       request.path,
+            "status":     labels.get("status"),
+            "lms":        request.POST.get("tool_consumer_instance_guid"),
+            "context_id": request.POST.get("context_id"),
+            "total_ms":   round(total * 1000, 1),
+            "stages":     {stage: round(duration * 1000, 1) for stage, duration in timing.stages},
+        }))
+
+
+
+def launch(view: str) -> Callable:
+    """Decorator observing the duration and the status of the responses of the launch view
+    <view> in 'lti_launch_seconds'.
+    
+    The view can split its work into stages with request.timing (see Timing), which are observed
+    in 'lti_launch_stage_seconds' and described in the Server-Timing header of the response."""
+    
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(request: HttpRequest, *args: Any, **kwargs: Any) -> HttpResponse:
+            request.timing = Timing()
+            try:
+                response = function(request, *args, **kwargs)
+            except BaseException:
+                _report(view, request, None)
+                raise
+            _report(view, request, response)
+            return response
+        
+        return wrapper
+    
+    return decorator
+
+
+
+def _path() -> str:
+    """Returns the file of this process, named after its pid and the time of its first flush so
+    that a new process reusing the pid of a dead one does not overwrite its samples."""
+    global _identity
+    
+    if _identity[0] != os.getpid():
+        _identity = (os.getpid(), int(time.time() * 1000))
+    return os.path.join(settings.METRICS_DIR, "%d-%d.json" % _identity)
+
+
+
+def _alive(pid: int) -> bool:
+    """Returns whether the process <pid> is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # pragma: no cover
+        pass
+    return True
+
+
+
+@contextmanager
+def _locked(directory: str) -> Iterator[None]:
+    """Hold the lock of <directory> while merging and reading the files of the workers."""
+    with open(os.path.join(directory, ".lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+
+def _read(path: str) -> List[List[Any]]:
+    """Returns the samples written to <path>, none if it cannot be read."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):  # pragma: no cover
+        logger.warning("Could not read the metrics of '%s'" % path)
+        return []
+
+
+
+def _add(samples: Samples, content: List[List[Any]]) -> None:
+    """Add the samples of <content>, as written to a file, to <samples>."""
+    for name, labels, value in content:
+        key = (name, tuple(tuple(label) for label in labels))
+        if isinstance(value, list):
+            total = samples.setdefault(key, [[0] * (len(BUCKETS) + 1), 0.0])
+            total[0] = [a + b for a, b in zip(total[0], value[0])]
+            total[1] += value[1]
+        else:
+            samples[key] = samples.get(key, 0) + value
+
+
+
+def _write(path: str, content: str) -> None:
+    with open(path + ".tmp", "w") as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+
+
+
+def _merge_dead(directory: str) -> None:
+    """Fold the files of the dead workers of <directory> into DEAD, removing them.
+    
+    A file belongs to a dead worker if its pid is not running anymore, or if a more recent file
+    has the same pid."""
+    files: Dict[int, List[Tuple[int, str]]] = {}
+    for path in glob.glob(os.path.join(directory, "*-*.json")):
+        try:
+            pid, start = map(int, os.path.basename(path)[:-len(".json")].split("-"))
+        except ValueError:  # pragma: no cover
+            continue
+        files.setdefault(pid, []).append((start, path))
+    
+    dead = []
+    for pid, entries in files.items():
+        entries.sort()
+        dead.extend(path for _, path in entries[:-1])
+        if pid != os.getpid() and not _alive(pid):
+            dead.append(entries[-1][1])
+    if not dead:
+        return
+    
+    samples: Samples = {}
+    path = os.path.join(directory, DEAD)
+    if os.path.exists(path):
+        _add(samples, _read(path))
+    for merged in dead:
+        _add(samples, _read(merged))
+    _write(path, json.dumps([[name, labels, value] for (name, labels), value in samples.items()]))
+    for merged in dead:
+        os.remove(merged)
+
+
+
+def _maybe_flush() -> None:
+    if settings.METRICS_DIR and time.monotonic() >= _next_flush:
+        flush()
+
+
+
+def flush() -> None:
+    """Write the samples of this process to its file of settings.METRICS_DIR, if set."""
+    global _next_flush
+    
+    if not settings.METRICS_DIR:
+        return
+    _next_flush = time.monotonic() + settings.METRICS_FLUSH_INTERVAL
+    with _lock:
+        content = json.dumps([[name, labels, value] for (name, labels), value in SAMPLES.items()])
+    
+    try:
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        _write(_path(), content)
+    except OSError:
+        logger.exception("Could not write the metrics to '%s'" % settings.METRICS_DIR)
+
+
+
+def collect() -> Samples:
+    """Returns the samples of every process writing to settings.METRICS_DIR, dead ones included,
+    or of this process only if it is not set."""
+    if not settings.METRICS_DIR:
+        with _lock:
+            return {key: json.loads(json.dumps(value)) for key, value in SAMPLES.items()}
+    
+    flush()
+    directory = settings.METRICS_DIR
+    samples: Samples = {}
+    # Without fcntl the files of dead workers are kept, their samples being still counted
+    with _locked(directory) if fcntl is not None else nullcontext():
+        if fcntl is not None:
+            _merge_dead(directory)
+        for path in glob.glob(os.path.join(directory, "*.json")):
+            _add(samples, _read(path))
+    return samples
+
+
+
+def _format(labels: Labels, extra: Labels = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+
+
+
+def render() -> str:
+    """Returns the samples returned by collect() in the Prometheus text format."""
+    samples = collect()
+    lines = []
+    for name in sorted({name for name, _ in samples} | set(METRICS)):
+        kind, description = METRICS.get(name, ("counter", ""))
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for (sample_name, labels), value in sorted(samples.items()):
+            if sample_name != name:
+                continue
+            if kind != "histogram":
+                lines.append("%s%s %s" % (name, _format(labels), repr(float(value))))
+                continue
+            
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), value[0]):
+                cumulative += count
+                lines.append("%s_bucket%s %d"
+                             % (name, _format(labels, (("le", str(bound)),)), cumulative))
+            lines.append("%s_sum%s %s" % (name, _format(labels), repr(float(value[1]))))
+            lines.append("%s_count%s %d" % (name, _format(labels), cumulative))
+    return "\n".join(lines) + "\n"
+
+
+
+def reset() -> None:
+    """Forget the samples of this process."""
+    with _lock:
+        SAMPLES.clear()
@@ -6,20 +6,27 @@
 #       - Coumes Quentin <coumes.quentin@gmail.com>
 #
 
+import hashlib
+import itertools
 import logging
 import random
+import time
 from datetime import timedelta
-from typing import Any
+from typing import Any, Dict, List, Optional, Tuple, Type
 
 import requests
 from defusedxml import DefusedXmlException, ElementTree
 from defusedxml.ElementTree import ParseError
 from django.conf import settings
 from django.core.validators import MinLengthValidator, URLValidator
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
 from oauthlib.oauth1.rfc5849 import Client
-from wimsapi import AdmRawError, Class, Exam, Sheet
+from wimsapi import AdmRawError, WimsAPI
 
+from lti_app import metrics
+from lti_app.capabilities import get_capability, sheet_score
+from lti_app.scheduling import slot, timeout_before
 from lti_app.validator import ModelsValidator
 
 
@@ -38,12 +45,72 @@ expiration_help = ("This is the classes default duration (format is 'day hours:m
 
 
 
+def digest(value: Optional[Any]) -> Optional[int]:
+    """Returns a signed 64 bits integer digest of <value> (None if <value> is None), as stored in
+    the BigIntegerField '<field>_hash'. <value> is first converted to a string, as done when it is
+    stored in the CharField '<field>', so that both give the same digest.
+    
+    Digests are stored alongside long LTI identifiers so that they can be looked up through small
+    fixed-width indexes, the identifiers themselves being kept to discard collisions."""
+    if value is None:
+        return None
+    return int.from_bytes(hashlib.sha1(str(value).encode()).digest()[:8], "big", signed=True)
+
+
+
+def lookup(field: str, value: Optional[str]) -> Dict[str, Any]:
+    """Returns the keyword arguments filtering <field> on <value> through its indexed digest,
+    e.g. `LMS.objects.get(**lookup("guid", guid))`."""
+    return {field + "_hash": digest(value), field: value}
+
+
+
+def name_key(value: str) -> str:
+    """Returns the case-insensitive prefix of <value> through which names are sorted and searched,
+    short enough to be indexed by every database."""
+    return value.casefold()[:64]
+
+
+
+def upsert(model: Type[models.Model], keys: Dict[str, Any], values: Dict[str, Any],
+           defaults: Optional[Dict[str, Any]] = None) -> Tuple[models.Model, bool]:
+    """Get the instance of <model> matching <keys> (which must be unique together), creating it
+    with <values> and <defaults> if it does not exist. Fields in <values> are only written if
+    they changed, <defaults> are only used on creation.
+    
+    Unlike QuerySet.update_or_create(), nothing is written when nothing changed and concurrent
+    creations do not fail, the instance inserted by the other caller being returned with created
+    set to False. save() is not called, digests must be given explicitly (see lookup()).
+    
+    Returns a tuple (instance, created)."""
+    created = False
+    try:
+        instance = model.objects.get(**keys)
+    except model.DoesNotExist:
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create([model(**keys, **values, **(defaults or {}))])
+            created = True
+        except IntegrityError:  # Inserted concurrently
+            pass
+        instance = model.objects.get(**keys)
+    
+    changed = {f: v for f, v in values.items() if getattr(instance, f) != v}
+    if changed:
+        model.objects.filter(pk=instance.pk).update(**changed)
+        for field, value in changed.items():
+            setattr(instance, field, value)
+    return instance, created
+
+
+
 class LMS(models.Model):
     """Represents a LMS."""
     
     guid = models.CharField(
         max_length=2048, help_text=lms_guid_help, verbose_name="GUID", default=None
     )
+    guid_hash = models.BigIntegerField(null=True, editable=False)
     name = models.CharField(max_length=2048, default=None)
     url = models.CharField(
         max_length=2048, verbose_name="URL", default=None,
@@ -59,11 +126,18 @@ class LMS(models.Model):
         verbose_name_plural = "LMS"
         indexes = [
             models.Index(fields=['key']),
+            models.Index(fields=['guid_hash']),
         ]
     
     
     def __str__(self) -> str:
         return "%s (%s)" % (self.name, self.url)
+    
+    
+    def save(self, *args: Any, **kwargs: Any) -> None:
+        """Keep the digest of the guid in sync."""
+        self.guid_hash = digest(self.guid)
+        super().save(*args, **kwargs)
 
 
 
@@ -107,18 +181,44 @@ class WimsClass(models.Model):
     
     lms = models.ForeignKey(LMS, models.CASCADE)
     lms_guid = models.CharField(max_length=256, default=None)
+    lms_guid_hash = models.BigIntegerField(null=True, editable=False)
     wims = models.ForeignKey(WIMS, models.CASCADE)
     qclass = models.CharField(max_length=256, default=None)
     name = models.CharField(max_length=2048, default=None)
+    name_key = models.CharField(max_length=64, default="", editable=False)
+    slot = models.PositiveSmallIntegerField(null=True, default=None, editable=False)
+    expiration = models.DateField(
+        null=True, blank=True, default=None,
+        help_text="Expiration date of the class on its WIMS server, see lti_app.retention."
+    )
+    modified = models.DateTimeField(default=timezone.now, editable=False)
     
     
     class Meta:
         verbose_name_plural = "WimsClasses"
         unique_together = (("lms", "lms_guid", "wims"), ("wims", "qclass"),)
+        indexes = [
+            models.Index(fields=['wims', 'slot']),
+            models.Index(fields=['lms_guid_hash', 'lms', 'wims']),
+            models.Index(fields=['expiration']),
+            models.Index(fields=['qclass']),
+            models.Index(fields=['wims', 'name_key']),
+            models.Index(fields=['wims', 'modified']),
+        ]
     
     
     def __str__(self) -> str:
         return "lms guid: %s - wims guid: %s" % (self.name, self.qclass)
+    
+    
+    def save(self, *args: Any, **kwargs: Any) -> None:
+        """Keep the slot of the class in the scheduled jobs' window in sync with its qclass, the
+        digest of its lms_guid and the key of its name, and record the time of the change."""
+        self.slot = slot(self.qclass)
+        self.lms_guid_hash = digest(self.lms_guid)
+        self.name_key = name_key(self.name)
+        self.modified = timezone.now()
+        super().save(*args, **kwargs)
 
 
 
@@ -126,6 +226,7 @@ class WimsUser(models.Model):
     """Represent an user on a WIMS server."""
     
     lms_guid = models.CharField(max_length=256, null=True)
+    lms_guid_hash = models.BigIntegerField(null=True, editable=False)
     wclass = models.ForeignKey(WimsClass, models.CASCADE)
     quser = models.CharField(max_length=256, default=None)
     
@@ -133,10 +234,19 @@ class WimsUser(models.Model):
     class Meta:
         verbose_name_plural = "WimsUsers"
         unique_together = (("quser", "wclass"),)
+        indexes = [
+            models.Index(fields=['wclass', 'lms_guid_hash']),
+        ]
     
     
     def __str__(self) -> str:
         return "lms guid: %s - wims guid: %s" % (self.lms_guid, self.quser)
+    
+    
+    def save(self, *args: Any, **kwargs: Any) -> None:
+        """Keep the digest of the lms_guid in sync."""
+        self.lms_guid_hash = digest(self.lms_guid)
+        super().save(*args, **kwargs)
 
 
 
@@ -145,15 +255,25 @@ class WimsSheet(models.Model):
     
     wclass = models.ForeignKey(WimsClass, models.CASCADE)
     lms_guid = models.CharField(max_length=256, default=None)
+    lms_guid_hash = models.BigIntegerField(null=True, editable=False)
     qsheet = models.CharField(max_length=256, null=True, default=None)
     
     
     class Meta:
         unique_together = (("qsheet", "wclass"),)
+        indexes = [
+            models.Index(fields=['wclass', 'lms_guid_hash']),
+        ]
     
     
     def __str__(self) -> str:
         return "lms guid: %s - wims guid: %s" % (self.lms_guid, self.qsheet)
+    
+    
+    def save(self, *args: Any, **kwargs: Any) -> None:
+        """Keep the digest of the lms_guid in sync."""
+        self.lms_guid_hash = digest(self.lms_guid)
+        super().save(*args, **kwargs)
 
 
 
@@ -162,27 +282,73 @@ class WimsExam(models.Model):
     
     wclass = models.ForeignKey(WimsClass, models.CASCADE)
     lms_guid = models.CharField(max_length=256, default=None)
+    lms_guid_hash = models.BigIntegerField(null=True, editable=False)
     qexam = models.CharField(max_length=256, null=True, default=None)
     
     
     class Meta:
         unique_together = (("qexam", "wclass"),)
+        indexes = [
+            models.Index(fields=['wclass', 'lms_guid_hash']),
+        ]
     
     
     def __str__(self) -> str:
         return "lms guid: %s - wims guid: %s" % (self.lms_guid, self.qexam)
+    
+    
+    def save(self, *args: Any, **kwargs: Any) -> None:
+        """Keep the digest of the lms_guid in sync."""
+        self.lms_guid_hash = digest(self.lms_guid)
+        super().save(*args, **kwargs)
+
+
+
+class OutcomeService(models.Model):
+    """Represents an outcome service of a LMS (its 'lis_outcome_service_url'), shared by every grade
+    link sending grades to it."""
+    
+    lms = models.ForeignKey(LMS, models.CASCADE)
+    url = models.URLField(max_length=1023)
+    url_hash = models.BigIntegerField(editable=False)
+    
+    
+    class Meta:
+        unique_together = (("lms", "url_hash"),)
+    
+    
+    def __str__(self) -> str:
+        return self.url
+    
+    
+    def save(self, *args: Any, **kwargs: Any) -> None:
+        """Keep the digest of the url in sync."""
+        self.url_hash = digest(self.url)
+        super().save(*args, **kwargs)
+    
+    
+    @classmethod
+    def get(cls, lms: LMS, url: str) -> 'OutcomeService':
+        """Returns the outcome service of <lms> at <url>, creating it if it does not exist."""
+        return upsert(cls, {"lms": lms, **lookup("url", url)}, {})[0]
 
 
 
 class GradeLinkBase(models.Model):
-    """Store links to send grade back to the LMS."""
+    """Store links to send grade back to the LMS.
+    
+    <url> and <lms> are the columns which stored the outcome service before OutcomeService was
+    introduced. They are only kept so that lti_app.tasks.fill_outcome_services can create the
+    services of existing links, and are removed (<service> becoming non-null) by the next
+    release."""
     
     activity: Any
     
     user = models.ForeignKey(WimsUser, models.CASCADE)
     sourcedid = models.CharField(max_length=256)
-    url = models.URLField(max_length=1023)
-    lms = models.ForeignKey(LMS, models.CASCADE)
+    service = models.ForeignKey(OutcomeService, models.CASCADE, null=True)
+    url = models.URLField(max_length=1023, null=True, default=None, editable=False)
+    lms = models.ForeignKey(LMS, models.CASCADE, null=True, default=None, editable=False)
     
     
     class Meta:
@@ -195,8 +361,52 @@ class GradeLinkBase(models.Model):
         raise NotImplementedError()
     
     
-    def send_back(self, grade: float) -> bool:
-        """Send the given grade back to the lms."""
+    @classmethod
+    def send_back_grades(cls, links: Dict[str, 'GradeLinkBase'], grades: List[Tuple[str, float]],
+                         deadline: Optional[float] = None) -> int:
+        """Send each grade of <grades> (a list of tuples (quser, grade)) through the link of the
+        user in <links>, returning the number of grades successfully sent.
+        
+        Grades are grouped by outcome service, reusing a single connection for each of them.
+        If given, <deadline> (according to time.monotonic()) bounds the time spent sending the
+        grades, the remaining ones being skipped once it is reached."""
+        pending = sorted(
+            ((links[quser], grade) for quser, grade in grades if quser in links),
+            key=lambda pair: pair[0].service_id
+        )
+        
+        total = 0
+        for _, group in itertools.groupby(pending, key=lambda pair: pair[0].service_id):
+            with requests.Session() as session:
+                for gl, grade in group:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        logger.info("Deadline reached while sending grades of class '%s'"
+                                    % gl.activity.wclass.qclass)
+                        return total
+                    total += gl.send_back(
+                        grade, timeout_before(deadline, settings.OUTCOME_SERVICE_TIMEOUT), session
+                    )
+        return total
+    
+    
+    def send_back(self, grade: float, timeout: Optional[float] = None,
+                  session: Optional[requests.Session] = None) -> bool:
+        """Send the given grade back to the lms, waiting at most <timeout> seconds for its
+        response (settings.OUTCOME_SERVICE_TIMEOUT by default). The request is sent through
+        <session> if given.
+        
+        Returns whether the grade was accepted by the LMS."""
+        with metrics.timer("lti_send_back_seconds", lms=self.service.lms.guid) as labels:
+            labels["outcome"] = self._send_back(grade, timeout, session)
+        return labels["outcome"] == "ok"
+    
+    
+    def _send_back(self, grade: float, timeout: Optional[float],
+                   session: Optional[requests.Session]) -> str:
+        """Send the given grade back to the lms, see send_back().
+        
+        Returns the outcome of the request: 'ok', 'unreachable' if the LMS could not be joined,
+        'rejected' if it refused the grade or 'malformed' if its response could not be parsed."""
         content = settings.XML_REPLACE % (random.randint(1, 99999999), self.sourcedid, str(grade))
         content = content.encode()
         
@@ -204,15 +414,18 @@ class GradeLinkBase(models.Model):
             "Content-Type":   "application/xml",
             "Content-Length": str(len(content)),
         }
-        c = Client(client_key=self.lms.key, client_secret=self.lms.secret)
+        c = Client(client_key=self.service.lms.key, client_secret=self.service.lms.secret)
         
         try:
-            uri, headers, body = c.sign(self.url, "POST", body=content, headers=headers)
-            response = requests.post(uri, data=body, headers=headers)
+            uri, headers, body = c.sign(self.service.url, "POST", body=content, headers=headers)
+            response = (session or requests).post(
+                uri, data=body, headers=headers,
+                timeout=timeout if timeout is not None else settings.OUTCOME_SERVICE_TIMEOUT
+            )
         except (requests.RequestException, ValueError):
             logger.warning("Could not join the LMS to send the grade back at url %s"
-                           % self.url)
-            return False
+                           % self.service.url)
+            return "unreachable"
         
         try:
             if not 200 <= response.status_code < 300:
@@ -222,7 +435,7 @@ class GradeLinkBase(models.Model):
                     % (self.user.quser, self.ident, self.activity.wclass.qclass,
                        response.status_code, response.text)
                 )
-                return False
+                return "rejected"
             root = ElementTree.fromstring(response.text)
             if not root[0][0][2][0].text == "success":
                 logger.warning(
@@ -232,16 +445,16 @@ class GradeLinkBase(models.Model):
                        root[0][0][2][2].text
                        )
                 )
-                return False
+                return "rejected"
         except (DefusedXmlException, IndexError, ParseError):
             logger.exception(
                 ("Consumer sent a badly formatted response after sending grade for user '%s' and "
                  "sheet '%s' in class '%s': ")
                 % (self.user.quser, self.ident, self.activity.wclass.qclass)
             )
-            return False
+            return "malformed"
         
-        return True
+        return "ok"
 
 
 
@@ -262,33 +475,36 @@ class GradeLinkSheet(GradeLinkBase):
     
     
     @classmethod
-    def send_back_all(cls, sheet: WimsSheet) -> int:
+    def send_back_all(cls, sheet: WimsSheet, deadline: Optional[float] = None) -> int:
         """Send the score of the sheet of every user back to the LMS. The score used
         it the the one set by the teacher at the sheet creation for WIMS > 4.18, else
-        the cumul score."""
-        try:
-            wclass = sheet.wclass
-            wims = wclass.wims
-            grades = Class.get(
-                wims.url, wclass.wims.ident, wims.passwd, wclass.qclass, wims.rclass,
-                timeout=settings.WIMSAPI_TIMEOUT
-            ).getitem(sheet.qsheet, Sheet).scores()
-        except AdmRawError as e:  # pragma: no cover
-            if "There is no user in this class" in str(e):
-                return 0
-            raise
+        the cumul score. The format of the score is given by the capabilities of the WIMS
+        server, see lti_app.capabilities.
         
-        total = 0
-        for grade in grades:
-            try:
-                user = WimsUser.objects.get(wclass=wclass, quser=grade.user.quser)
-                gl = GradeLinkSheet.objects.get(user=user, activity=sheet)
-            except (GradeLinkSheet.DoesNotExist, WimsUser.DoesNotExist):  # pragma: no cover
-                continue
-            score = grade.score / 10 if grade.score != -1 else grade.best / 100
-            total += gl.send_back(score)
+        If given, <deadline> (according to time.monotonic()) bounds the time spent sending the
+        grades, the remaining ones being skipped once it is reached."""
+        wclass = sheet.wclass
+        wims = wclass.wims
+        capability = get_capability(wims)
+        api = WimsAPI(wims.url, wims.ident, wims.passwd,
+                      timeout=timeout_before(deadline, settings.WIMSAPI_TIMEOUT))
+        status, response = api.getsheetscores(wclass.qclass, wims.rclass, sheet.qsheet,
+                                              verbose=True)
+        if not status:  # pragma: no cover
+            if "There is no user in this class" in response['message']:
+                return 0
+            raise AdmRawError(response['message'])
+        grades = [(data['id'], sheet_score(capability, response, data))
+                  for data in response["data_scores"]]
         
-        return total
+        links = {
+            gl.user.quser: gl
+            for gl in (GradeLinkSheet.objects.filter(activity=sheet)
+                       .select_related("user", "service__lms"))
+        }
+        for gl in links.values():
+            gl.activity = sheet
+        return cls.send_back_grades(links, grades, deadline)
 
 
 
@@ -309,27 +525,114 @@ class GradeLinkExam(GradeLinkBase):
     
     
     @classmethod
-    def send_back_all(cls, exam: WimsExam) -> int:
-        """Send the score of the exam of every user back to the LMS."""
-        try:
-            wclass = exam.wclass
-            wims = wclass.wims
-            grades = Class.get(
-                wims.url, wclass.wims.ident, wims.passwd, wclass.qclass, wims.rclass,
-                timeout=settings.WIMSAPI_TIMEOUT
-            ).getitem(exam.qexam, Exam).scores()
-        except AdmRawError as e:  # pragma: no cover
-            if "There's no user in this class" in str(e):
+    def send_back_all(cls, exam: WimsExam, deadline: Optional[float] = None) -> int:
+        """Send the score of the exam of every user back to the LMS.
+        
+        If given, <deadline> (according to time.monotonic()) bounds the time spent sending the
+        grades, the remaining ones being skipped once it is reached."""
+        wclass = exam.wclass
+        wims = wclass.wims
+        api = WimsAPI(wims.url, wims.ident, wims.passwd,
+                      timeout=timeout_before(deadline, settings.WIMSAPI_TIMEOUT))
+        status, response = api.getexamscores(wclass.qclass, wims.rclass, exam.qexam, verbose=True)
+        if not status:  # pragma: no cover
+            if "There's no user in this class" in response['message']:
                 return 0
-            raise
+            raise AdmRawError(response['message'])
+        grades = [(data['id'], data['score'] / 10) for data in response["data_scores"]]
         
-        total = 0
-        for grade in grades:
-            try:
-                user = WimsUser.objects.get(wclass=wclass, quser=grade.user.quser)
-                gl = GradeLinkExam.objects.get(user=user, activity=exam)
-            except (GradeLinkExam.DoesNotExist, WimsUser.DoesNotExist):  # pragma: no cover
-                continue
-            score = grade.score / 10
-            total += gl.send_back(score)
-        return total
+        links = {
+            gl.user.quser: gl
+            for gl in (GradeLinkExam.objects.filter(activity=exam)
+                       .select_related("user", "service__lms"))
+        }
+        for gl in links.values():
+            gl.activity = exam
+        return cls.send_back_grades(links, grades, deadline)
+
+
+
+class ExamSurge(models.Model):
+    """A period during which most students of the class of <exam> are expected to launch it.
+    
+    The state needed by these launches is fetched from the WIMS server and cached beforehand,
+    see lti_app.surge."""
+    
+    exam = models.ForeignKey(WimsExam, models.CASCADE)
+    start = models.DateTimeField(help_text="Time at which students start launching the exam.")
+    end = models.DateTimeField(help_text="Time after which launches are back to normal.")
+    warmed = models.DateTimeField(null=True, blank=True, editable=False)
+    
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['end', 'start']),
+        ]
+    
+    
+    def __str__(self) -> str:
+        return "%s (%s - %s)" % (self.exam, self.start, self.end)
+
+
+
+class WimsCapability(models.Model):
+    """Capabilities of a WIMS server, see lti_app.capabilities."""
+    
+    SCORE_AUTO = "auto"
+    SCORE_FORMULA = "formula"
+    SCORE_BEST = "best"
+    SCORE_FORMATS = (
+        (SCORE_AUTO, "Formula if sent by the server, level of success otherwise"),
+        (SCORE_FORMULA, "Formula chosen by the teacher (WIMS >= 4.18)"),
+        (SCORE_BEST, "Level of success (WIMS < 4.18)"),
+    )
+    
+    wims = models.OneToOneField(WIMS, models.CASCADE, related_name="capability")
+    version = models.CharField(max_length=64, blank=True, default="")
+    jobs = models.TextField(blank=True, default="", help_text="Supported adm/raw jobs.")
+    score_format = models.CharField(max_length=16, choices=SCORE_FORMATS, default=SCORE_AUTO)
+    bulk_listing = models.BooleanField(
+        default=False, help_text="Whether every class can be listed in a single request."
+    )
+    checked = models.DateTimeField(null=True, default=None)
+    failed = models.DateTimeField(
+        null=True, default=None, help_text="Time of the last failed probe, if any."
+    )
+    
+    
+    class Meta:
+        verbose_name_plural = "WimsCapabilities"
+    
+    
+    def __str__(self) -> str:
+        return "%s - version %s" % (self.wims, self.version or "unknown")
+    
+    
+    @property
+    def known(self) -> bool:
+        """Returns whether the WIMS server has been successfully probed at least once."""
+        return self.checked is not None
+    
+    
+    def supports(self, job: str) -> bool:
+        """Returns whether the adm/raw job <job> is supported by the WIMS server."""
+        return job in self.jobs.split()
+
+
+
+class JobCheckpoint(models.Model):
+    """Position reached by a scheduled job on a WIMS server, allowing its next run to resume where
+    the previous one stopped."""
+    
+    job = models.CharField(max_length=256)
+    wims = models.ForeignKey(WIMS, models.CASCADE)
+    position = models.PositiveSmallIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+    
+    
+    class Meta:
+        unique_together = (("job", "wims"),)
+    
+    
+    def __str__(self) -> str:
+        return "%s - %s: %d" % (self.job, self.wims, self.position)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+#  probes.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+"""Check whether classes and users exist on a WIMS server.
+
+Probes use the cheapest adm/raw job supported by the server (check* jobs, or a single listing of
+every class when available) instead of downloading the whole object. Positive answers are cached
+for settings.WIMS_PROBE_CACHE_TTL seconds."""
+
+import logging
+import re
+from typing import Optional, Pattern, Set
+
+import wimsapi
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Model
+
+from lti_app.capabilities import get_capability
+
+
+logger = logging.getLogger(__name__)
+
+# Matches the error messages of WIMS servers when the requested object does not exist.
+NOT_FOUND = re.compile(r"not existing|not in this class|does not exist", re.IGNORECASE)
+
+# Error message of WIMS servers when the requested class does not exist, formatted with its qclass.
+CLASS_NOT_FOUND = r"class %s not existing"
+
+
+
+def _key(wims: Model, *parts: str) -> str:
+    """Returns the cache key of a probe on <wims>."""
+    return "lti_app:probe:%d:%s" % (wims.pk, ":".join(str(p) for p in parts))
+
+
+
+def _exists(wims: Model, job: str, fallback: str, key: str, qclass: str, *args: str,
+            timeout: Optional[float] = None, not_found: Pattern = NOT_FOUND) -> bool:
+    """Returns whether an object exists, using the adm/raw <job> if supported by <wims>, the more
+    expensive <fallback> otherwise. <qclass> and <args> are given to the job.
+    
+    The object is considered missing only if the error message matches <not_found>.
+
+    Raises:
+        - wimsapi.AdmRawError if the WIMS server returned an error other than a missing object.
+        - requests.RequestException if the WIMS server could not be joined."""
+    if cache.get(key):
+        return True
+    
+    capability = get_capability(wims)
+    if not capability.known or not capability.supports(job):
+        job = fallback
+    
+    api = wimsapi.WimsAPI(wims.url, wims.ident, wims.passwd,
+                          timeout=timeout or settings.WIMSAPI_TIMEOUT)
+    status, response = getattr(api, job)(qclass, wims.rclass, *args, verbose=True)
+    if not status:
+        if not_found.search(response['message']):
+            return False
+        raise wimsapi.AdmRawError(response['message'])
+    
+    cache.set(key, True, settings.WIMS_PROBE_CACHE_TTL)
+    return True
+
+
+
+def listed_classes(wims: Model, timeout: Optional[float] = None) -> Set[str]:
+    """Returns the set of the qclass of every class of <wims> connected to its rclass, in a single
+    request. The set is cached for settings.WIMS_PROBE_CACHE_TTL seconds."""
+    key = _key(wims, "classes")
+    listed = cache.get(key)
+    if listed is None:
+        api = wimsapi.WimsAPI(wims.url, wims.ident, wims.passwd,
+                              timeout=timeout or settings.WIMSAPI_TIMEOUT)
+        status, response = api.listclasses(wims.rclass, verbose=True)
+        if not status:
+            if "there is no class allowed for this server" not in response['message']:
+                raise wimsapi.AdmRawError(response['message'])
+            response["classes_list"] = []
+        listed = {str(c['qclass']) for c in response["classes_list"]}
+        cache.set(key, listed, settings.WIMS_PROBE_CACHE_TTL)
+    return listed
+
+
+
+def class_exists(wims: Model, qclass: str, timeout: Optional[float] = None) -> bool:
+    """Returns whether the class <qclass> exists on <wims>.
+
+    If <wims> can list every class in a single request, this listing is used and shared by every
+    probe until it expires. As a missing class is deleted (see
+    lti_app.tasks.check_classes_exists), only the error message naming <qclass> means that it does
+    not exist, any other error being raised."""
+    key = _key(wims, "class", qclass)
+    if get_capability(wims).bulk_listing and str(qclass) in listed_classes(wims, timeout):
+        cache.set(key, True, settings.WIMS_PROBE_CACHE_TTL)
+        return True
+    not_found = re.compile(CLASS_NOT_FOUND % re.escape(str(qclass)), re.IGNORECASE)
+    return _exists(wims, "checkclass", "getclass", key, qclass, timeout=timeout,
+                   not_found=not_found)
+
+
+
+def user_exists(wims: Model, qclass: str, quser: str, timeout: Optional[float] = None) -> bool:
+    """Returns whether the user <quser> exists in the class <qclass> of <wims>."""
+    key = _key(wims, "user", qclass, quser)
+    return _exists(wims, "checkuser", "getuser", key, qclass, quser, timeout=timeout)
+
+
+
+def remember_user(wims: Model, qclass: str, quser: str, ttl: float) -> None:
+    """Cache for <ttl> seconds that the user <quser> exists in the class <qclass> of <wims>."""
+    cache.set(_key(wims, "user", qclass, quser), True, ttl)
+
+
+
+def forget(wims: Model, qclass: str) -> None:
+    """Remove the cached answers about the class <qclass> of <wims>, e.g. after its deletion."""
+    cache.delete(_key(wims, "class", qclass))
+    cache.delete(_key(wims, "classes"))
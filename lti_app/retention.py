@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+#  retention.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+"""Archive and delete the classes which expired on their WIMS server.
+
+A class is considered as expired settings.CLASS_RETENTION after its expiration date. Each expired
+class is exported with its users, sheets, exams, exam surges and grade links as a single JSON
+document per line of a gzip file in settings.ARCHIVE_ROOT, then deleted, by chunks of
+settings.SCHEDULED_JOBS_CHUNK_SIZE classes so that the tables and their indexes only contain
+classes still in use.
+
+The expiration date of a class is synced on each launch. Classes saved before these dates were
+stored get theirs from fetch_expiration(), called by lti_app.tasks.check_classes_exists."""
+
+import datetime
+import gzip
+import json
+import logging
+import os
+from typing import Any, Dict, IO, List, Optional
+
+import wimsapi
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Model, QuerySet
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+# Rows archived with each class: (key in the document, model, path to the class' id, lookups
+# archived along with the fields of the rows).
+RELATED = [
+    ("users", "WimsUser", "wclass_id", ()),
+    ("sheets", "WimsSheet", "wclass_id", ()),
+    ("exams", "WimsExam", "wclass_id", ()),
+    ("grade_links_sheet", "GradeLinkSheet", "activity__wclass_id",
+     ("service__url", "service__lms__guid")),
+    ("grade_links_exam", "GradeLinkExam", "activity__wclass_id",
+     ("service__url", "service__lms__guid")),
+    ("exam_surges", "ExamSurge", "exam__wclass_id", ()),
+]
+
+
+
+def expired(today: Optional[datetime.date] = None) -> QuerySet:
+    """Returns the classes whose retention period ended before <today>."""
+    WimsClass = apps.get_model("lti_app", "WimsClass")
+    
+    today = today or timezone.now().date()
+    return WimsClass.objects.filter(expiration__lt=today - settings.CLASS_RETENTION)
+
+
+
+def fetch_expiration(wclass: Model, timeout: Optional[float] = None
+                     ) -> Optional[datetime.date]:
+    """Fetch the expiration date of <wclass> from its WIMS server and save it, returning the date
+    (None if it could not be parsed).
+    
+    Raises:
+        - wimsapi.AdmRawError if the WIMS server returned an error.
+        - requests.RequestException if the WIMS server could not be joined."""
+    from lti_app.utils import parse_expiration
+    
+    WimsClass = apps.get_model("lti_app", "WimsClass")
+    
+    wims = wclass.wims
+    api = wimsapi.WimsAPI(wims.url, wims.ident, wims.passwd,
+                          timeout=timeout or settings.WIMSAPI_TIMEOUT)
+    status, response = api.getclass(wclass.qclass, wims.rclass, verbose=True)
+    if not status:
+        raise wimsapi.AdmRawError(response["message"])
+    
+    expiration = parse_expiration(response.get("expiration", ""))
+    if expiration is not None:
+        WimsClass.objects.filter(pk=wclass.pk).update(expiration=expiration)
+        wclass.expiration = expiration
+    return expiration
+
+
+
+def documents(ids: List[int]) -> List[Dict[str, Any]]:
+    """Returns the archive documents of the classes whose pk are in <ids>."""
+    WimsClass = apps.get_model("lti_app", "WimsClass")
+    
+    docs = {
+        c["id"]: {"class": c, **{key: [] for key, _, _, _ in RELATED}}
+        for c in WimsClass.objects.filter(pk__in=ids).values()
+    }
+    for key, name, path, lookups in RELATED:
+        model = apps.get_model("lti_app", name)
+        fields = [f.attname for f in model._meta.concrete_fields]
+        rows = (model.objects.filter(**{path + "__in": ids}).annotate(_wclass=F(path))
+                .values(*fields, *lookups, "_wclass"))
+        for row in rows:
+            docs[row.pop("_wclass")][key].append(row)
+    return list(docs.values())
+
+
+
+def delete(ids: List[int]) -> None:
+    """Delete the classes whose pk are in <ids> and their related rows, children first so that the
+    collector of Django finds no remaining row to cascade to. Each delete() still runs the queries
+    of the collector (selecting the rows, then deleting them by batches), not a single statement."""
+    WimsClass = apps.get_model("lti_app", "WimsClass")
+    
+    for _, name, path, _ in reversed(RELATED):
+        apps.get_model("lti_app", name).objects.filter(**{path + "__in": ids}).delete()
+    WimsClass.objects.filter(pk__in=ids).delete()
+
+
+
+def archive_expired(today: Optional[datetime.date] = None) -> int:
+    """Archive then delete every expired class, returning the number of deleted classes.
+
+    Classes are deleted without being archived if settings.ARCHIVE_ROOT is None."""
+    stream: Optional[IO[str]] = None
+    queryset = expired(today).order_by("pk").values_list("pk", flat=True)
+    total = last = 0
+    
+    try:
+        while True:
+            ids = list(queryset.filter(pk__gt=last)[:settings.SCHEDULED_JOBS_CHUNK_SIZE])
+            if not ids:
+                break
+            last = ids[-1]
+            
+            if settings.ARCHIVE_ROOT is not None:
+                if stream is None:
+                    os.makedirs(settings.ARCHIVE_ROOT, exist_ok=True)
+                    name = "classes-%s.ndjson.gz" % timezone.now().strftime("%Y%m%d-%H%M%S")
+                    stream = gzip.open(os.path.join(settings.ARCHIVE_ROOT, name), "at")
+                for doc in documents(ids):
+                    stream.write(json.dumps(doc, default=str) + "\n")
+                stream.flush()
+            
+            with transaction.atomic():
+                delete(ids)
+            total += len(ids)
+    finally:
+        if stream is not None:
+            stream.close()
+    
+    if total:
+        logger.info("Archived and deleted %d expired classes" % total)
+    return total
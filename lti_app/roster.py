@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+#  roster.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+"""Pre-provisioning of the students of a class from a roster.
+
+The first launch of a student is the slowest one, its WIMS account being created while it waits.
+Before a large exam, the accounts of the students of a roster (a CSV file with the columns
+'user_id', 'firstname', 'lastname' and optionally 'email', 'user_id' being the LTI user_id sent by
+the LMS) can be created in advance, so that every launch takes the path of returning users.
+
+Accounts are created on the WIMS server by batches of settings.ROSTER_BATCH_SIZE students, at most
+settings.ROSTER_CONCURRENCY at a time, the WimsUser rows of each batch being then inserted at once.
+Students already known in the class are skipped, so a roster can be provisioned again after being
+updated."""
+
+import csv
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, IO, List, Optional, Tuple
+
+import requests
+import wimsapi
+from django.conf import settings
+
+from lti_app.models import WimsClass, WimsUser, lookup
+from lti_app.utils import add_user
+
+
+logger = logging.getLogger(__name__)
+
+# Columns of a roster, the last ones being optional.
+COLUMNS = ("user_id", "firstname", "lastname", "email")
+REQUIRED = COLUMNS[:3]
+
+
+
+def read(stream: IO[str]) -> List[Dict[str, str]]:
+    """Returns the rows of the roster read from <stream>, skipping those without user_id.
+    
+    Raises ValueError if a required column is missing."""
+    reader = csv.DictReader(stream)
+    missing = [c for c in REQUIRED if c not in (reader.fieldnames or ())]
+    if missing:
+        raise ValueError("Missing column(s) in the roster: %s" % ", ".join(missing))
+    return [row for row in reader if row["user_id"]]
+
+
+
+def parameters(row: Dict[str, str]) -> Dict[str, Any]:
+    """Returns the LTI parameters a launch of the student of <row> would send."""
+    return {
+        'user_id':                          row["user_id"],
+        'lis_person_name_given':            row["firstname"],
+        'lis_person_name_family':           row["lastname"],
+        'lis_person_contact_email_primary': row.get("email") or "",
+    }
+
+
+
+def provision(wclass_db: WimsClass, rows: List[Dict[str, str]], concurrency: Optional[int] = None,
+              batch_size: Optional[int] = None) -> Dict[str, Any]:
+    """Create the WIMS accounts and WimsUser rows of the students of <rows> missing from
+    <wclass_db>.
+    
+    Raises:
+        - wimsapi.WimsAPIError if the class could not be retrieved from its WIMS' server.
+        - requests.RequestException if the WIMS server could not be joined.
+    
+    Returns a dictionary with the number of 'created' and 'existing' students, the list of
+    'failed' ones as tuples (user_id, error), and the list of the quser of the 'orphaned' WIMS
+    accounts, created for students which could not be saved in the database and not deleted."""
+    concurrency = concurrency or settings.ROSTER_CONCURRENCY
+    batch_size = batch_size or settings.ROSTER_BATCH_SIZE
+    wims = wclass_db.wims
+    wclass = wimsapi.Class.get(wims.url, wims.ident, wims.passwd, wclass_db.qclass, wims.rclass,
+                               timeout=settings.WIMSAPI_TIMEOUT)
+    
+    known = set(
+        WimsUser.objects.filter(wclass=wclass_db).exclude(lms_guid=None)
+        .values_list("lms_guid", flat=True)
+    )
+    pending = []
+    for row in rows:
+        if row["user_id"] not in known:
+            known.add(row["user_id"])
+            pending.append(row)
+    
+    report: Dict[str, Any] = {
+        "created":  0,
+        "existing": len(rows) - len(pending),
+        "failed":   [],
+        "orphaned": [],
+    }
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            futures = [(row, executor.submit(add_user, wclass, parameters(row))) for row in batch]
+            
+            created = []
+            for row, future in futures:
+                try:
+                    created.append((row, future.result()))
+                except (wimsapi.WimsAPIError, requests.RequestException) as e:
+                    logger.warning("Could not provision user '%s' in class %d: %s"
+                                   % (row["user_id"], wclass_db.id, str(e)))
+                    report["failed"].append((row["user_id"], str(e)))
+            
+            WimsUser.objects.bulk_create([
+                WimsUser(wclass=wclass_db, quser=user.quser, **lookup("lms_guid", row["user_id"]))
+                for row, user in created
+            ], ignore_conflicts=True)
+            _check_inserted(wclass_db, created, report)
+    
+    logger.info("Provisioned %d users in class %d (%d already existing, %d failed)"
+                % (report["created"], wclass_db.id, report["existing"], len(report["failed"])))
+    return report
+
+
+
+def _check_inserted(wclass_db: WimsClass, created: List[Tuple[Dict[str, str], wimsapi.User]],
+                    report: Dict[str, Any]) -> None:
+    """Count in <report> the WimsUser rows of <created> actually inserted.
+    
+    Rows are skipped by bulk_create(ignore_conflicts=True) when their quser is already used in the
+    class by a row left from an account since deleted on the WIMS server. The just created WIMS
+    accounts of these students are deleted, those which could not be are added to 'orphaned'."""
+    inserted = set(
+        WimsUser.objects.filter(wclass=wclass_db, quser__in=[user.quser for _, user in created])
+        .values_list("quser", "lms_guid")
+    )
+    for row, user in created:
+        if (user.quser, row["user_id"]) in inserted:
+            report["created"] += 1
+            continue
+        
+        error = "WIMS user '%s' is already linked to another student" % user.quser
+        logger.warning("Could not provision user '%s' in class %d: %s"
+                       % (row["user_id"], wclass_db.id, error))
+        report["failed"].append((row["user_id"], error))
+        try:
+            user.delete()
+        except (wimsapi.WimsAPIError, requests.RequestException) as e:
+            logger.warning("Could not delete the orphaned WIMS user '%s' of class %d: %s"
+                           % (user.quser, wclass_db.id, str(e)))
+            report["orphaned"].append(user.quser)
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+#
+#  scheduling.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+"""Spread the work of the scheduled jobs over a window of time and enforce their time budgets.
+
+Every WIMS server is given an offset and every class a slot in the window, both derived from a
+stable hash. Jobs process their items in the order of these positions, sleeping until each
+position is due, so that servers and classes are not all hit at the same second. Jobs sharing a
+trigger can be shifted relative to each other, so that they do not hit the same class at once.
+
+A run of a job stops once its time budget is spent or when cancelled, saving the position it
+reached on each WIMS server so that the next run resumes from there."""
+
+import heapq
+import logging
+import math
+import threading
+import time
+import zlib
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from django.apps import apps
+from django.conf import settings
+from django.db.models import F, Model, Q, QuerySet
+
+
+logger = logging.getLogger(__name__)
+
+# Number of slots a window is divided into.
+SLOTS = 3600
+
+# Runs of scheduled jobs currently in progress, by job name.
+RUNNING: Dict[str, 'JobRun'] = {}
+
+
+
+def slot(key: str) -> int:
+    """Returns the slot (in [0, SLOTS[) corresponding to <key>.
+
+    The slot only depends on <key>, it is thus the same across processes and restarts."""
+    return zlib.crc32(str(key).encode()) % SLOTS
+
+
+
+class Pacer:
+    """Pace a job so that the position <p> of its window is reached <p / SLOTS * window> seconds
+    after the creation of the pacer.
+
+    A window of 0 disables pacing. If <origin> is given, the pacer starts at this position
+    instead of the beginning of the window."""
+    
+    
+    def __init__(self, window: float, clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep, origin: int = 0):
+        self.window = window
+        self.clock = clock
+        self.sleep = sleep
+        self.origin = origin
+        self.start = clock()
+    
+    
+    def due(self, position: int) -> float:
+        """Returns the time (according to self.clock) at which <position> is due."""
+        return self.start + (position - self.origin) * self.window / SLOTS
+    
+    
+    def wait(self, position: int) -> None:
+        """Sleep until <position> is due."""
+        delay = self.due(position) - self.clock()
+        if delay > 0:
+            self.sleep(delay)
+
+
+
+def _server_stream(queryset: QuerySet, wims: Model, slot_field: str, start: int, shift: int = 0
+                   ) -> Iterator[Tuple[int, Model, Model]]:
+    """Yields the tuples (position, wims, instance) of <queryset> ordered by position, starting
+    at position <start>. The position of an instance is its slot shifted by the offset of <wims>
+    and by <shift>.
+    
+    Instances are fetched by chunks of settings.SCHEDULED_JOBS_CHUNK_SIZE using keyset
+    pagination, so that only one chunk is kept in memory and rows can be deleted while
+    iterating."""
+    offset = (slot(wims.url) + shift) % SLOTS
+    pivot = SLOTS - offset
+    chunk_size = settings.SCHEDULED_JOBS_CHUNK_SIZE
+    queryset = queryset.annotate(_slot=F(slot_field)).order_by("_slot", "pk")
+    lookups = (
+        {"_slot__gte": pivot + start},
+        {"_slot__lt": pivot, "_slot__gte": start - offset},
+    )
+    for lookup in lookups:
+        chunk = list(queryset.filter(**lookup)[:chunk_size])
+        while chunk:
+            for instance in chunk:
+                yield (instance._slot + offset) % SLOTS, wims, instance
+            if len(chunk) < chunk_size:
+                break
+            last = chunk[-1]
+            after = Q(_slot__gt=last._slot) | Q(_slot=last._slot, pk__gt=last.pk)
+            chunk = list(queryset.filter(after, **lookup)[:chunk_size])
+
+
+
+def spread(queryset: QuerySet, server_field: str, slot_field: str,
+           start: Optional[Dict[int, int]] = None, shift: int = 0
+           ) -> Iterator[Tuple[int, Model, Model]]:
+    """Yields the tuples (position, wims, instance) of every instance of <queryset>, ordered by
+    position.
+
+    <server_field> is the lookup to the WIMS server of an instance, and <slot_field> the lookup to
+    the slot of its class (e.g. 'wclass__wims' and 'wclass__slot' for a WimsSheet).
+
+    <start> can map the pk of WIMS servers to the position their instances start at, and <shift>
+    moves every position by this number of slots."""
+    WIMS = apps.get_model("lti_app", "WIMS")
+    start = start or {}
+    streams = [
+        _server_stream(
+            queryset.filter(**{server_field: wims}), wims, slot_field, start.get(wims.pk, 0),
+            shift
+        )
+        for wims in WIMS.objects.all()
+    ]
+    return heapq.merge(*streams, key=lambda t: t[0])
+
+
+
+def timeout_before(deadline: Optional[float], default: float) -> float:
+    """Returns the timeout to use for a request which must end before <deadline> (according to
+    time.monotonic()), <default> being used if there is no deadline or if it is farther."""
+    if deadline is None:
+        return default
+    return max(min(default, deadline - time.monotonic()), 0.1)
+
+
+
+def cancel(name: Optional[str] = None) -> None:
+    """Cancel the run of the job <name>, or every running job if <name> is not given.
+
+    Jobs stop after their current item, saving their progress."""
+    for run in list(RUNNING.values()):
+        if name is None or run.name == name:
+            run.cancelled.set()
+
+
+
+def shutdown(scheduler: Any) -> None:
+    """Cancel every running job, which stop after their current item and save their progress,
+    and shut the APScheduler <scheduler> down."""
+    cancel()
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+
+
+
+class JobRun:
+    """A run of the scheduled job <name>, pacing it over <window> seconds and enforcing its time
+    budgets.
+
+    The run stops once <budget> seconds have elapsed or when cancelled, and skips the remaining
+    items of a WIMS server once <server_budget> seconds have been spent processing them. The
+    position reached on each WIMS server is then saved, the next run resuming from there. A
+    budget of None means no limit.
+    
+    Positions are moved by <shift> slots, see spread()."""
+    
+    
+    def __init__(self, name: str, window: float = 0, budget: Optional[float] = None,
+                 server_budget: Optional[float] = None, shift: int = 0):
+        JobCheckpoint = apps.get_model("lti_app", "JobCheckpoint")
+        
+        self.name = name
+        self.shift = shift
+        self.deadline = time.monotonic() + (budget if budget is not None else math.inf)
+        self.server_budget = server_budget if server_budget is not None else math.inf
+        self.cancelled = threading.Event()
+        self.spent: Dict[int, float] = {}
+        self.exhausted = set()
+        self.start = dict(
+            JobCheckpoint.objects.filter(job=name).values_list("wims_id", "position")
+        )
+        self.progress = dict(self.start)
+        
+        WIMS = apps.get_model("lti_app", "WIMS")
+        origin = min(self.start.values()) if len(self.start) == WIMS.objects.count() else 0
+        self.pacer = Pacer(window, sleep=self.cancelled.wait, origin=origin)
+    
+    
+    def stopped(self) -> bool:
+        """Returns whether this run must stop."""
+        return self.cancelled.is_set() or time.monotonic() >= self.deadline
+    
+    
+    def server_deadline(self, wims: Model) -> float:
+        """Returns the time (according to time.monotonic()) at which the processing of the
+        current item of <wims> must end."""
+        remaining = self.server_budget - self.spent.get(wims.pk, 0)
+        return min(self.deadline, time.monotonic() + remaining)
+    
+    
+    def items(self, queryset: QuerySet, server_field: str, slot_field: str
+              ) -> Iterator[Tuple[Model, Model]]:
+        """Yields the tuples (wims, instance) of <queryset> which must be processed by this run,
+        see spread()."""
+        RUNNING[self.name] = self
+        finished = False
+        try:
+            for position, wims, instance in spread(queryset, server_field, slot_field,
+                                                   self.start, self.shift):
+                if wims.pk in self.exhausted:
+                    continue
+                
+                # Every item before this one has been processed
+                self.progress[wims.pk] = position
+                self.pacer.wait(position)
+                if self.stopped():
+                    logger.info("Stopping job '%s' (cancelled or time budget exceeded)"
+                                % self.name)
+                    break
+                
+                if self.spent.get(wims.pk, 0) >= self.server_budget:
+                    logger.info("Time budget of job '%s' exceeded for WIMS server '%s'"
+                                % (self.name, wims.url))
+                    self.exhausted.add(wims.pk)
+                    continue
+                
+                before = time.monotonic()
+                yield wims, instance
+                self.spent[wims.pk] = self.spent.get(wims.pk, 0) + time.monotonic() - before
+                # Resume after this item, unless the next one shares its position
+                self.progress[wims.pk] = position + 1
+            else:
+                finished = True
+        finally:
+            RUNNING.pop(self.name, None)
+            self.checkpoint(finished)
+    
+    
+    def checkpoint(self, finished: bool) -> None:
+        """Save the position reached on each WIMS server. Checkpoints of the servers which have
+        been entirely processed are removed if the run <finished>."""
+        JobCheckpoint = apps.get_model("lti_app", "JobCheckpoint")
+        
+        for wims_pk, position in self.progress.items():
+            if finished and wims_pk not in self.exhausted:
+                JobCheckpoint.objects.filter(job=self.name, wims_id=wims_pk).delete()
+            else:
+                JobCheckpoint.objects.update_or_create(
+                    job=self.name, wims_id=wims_pk, defaults={"position": position}
+                )
@@ -0,0 +1,605 @@
+# -*- coding: utf-8 -*-
+#
+#  stub.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+"""In-memory imitation of the adm/raw module of a WIMS server.
+
+Used in place of wimsapi.api.post so that views and tasks can be tested without a live WIMS
+server, counting every job received::
+
+    stub = StubWims()
+    with mock.patch("wimsapi.api.post", stub):
+        ...
+    stub.calls["getclass"]
+
+Latency and faults can be injected (see StubWims.latency and StubWims.inject()), and the stub can
+be served over HTTP for benchmarks and load tests, either in a thread (see StubWimsServer) or in
+its own process with the 'wims_stub' management command::
+
+    with StubWimsServer(stub) as server:
+        wimsapi.WimsAPI(server.url, "myself", "toto").checkident()
+
+StubLMSServer similarly serves the outcome service of a fake LMS, to which grades can be sent
+back."""
+
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple, Union
+from urllib.parse import parse_qsl
+
+import requests
+from defusedxml import ElementTree
+
+
+# Faults which can be injected with StubWims.inject().
+FAULTS = ("timeout", "unreachable", "error", "invalid")
+
+
+
+class StubResponse:
+    """Minimal imitation of requests.Response, as read by wimsapi.api.parse_response."""
+    
+    
+    def __init__(self, content: Optional[Dict[str, Any]], text: Optional[str] = None):
+        self.body = content
+        self.text = json.dumps(content) if text is None else text
+        self.content = self.text.encode()
+        self.status_code = 200
+    
+    
+    def json(self) -> Dict[str, Any]:
+        if self.body is None:
+            raise json.JSONDecodeError("Expecting value", self.text, 0)
+        return self.body
+
+
+
+def parse_data(data: str) -> Dict[str, str]:
+    """Parse the 'key=value' lines sent by wimsapi in data1 / data2."""
+    return dict(line.split("=", 1) for line in (data or "").split("\n") if "=" in line)
+
+
+
+class StubWims:
+    """State of a fake WIMS server, callable as wimsapi.api.post.
+
+    Classes are stored in <classes> as dictionaries {'info', 'users', 'sheets', 'exams'}, and the
+    number of requests received for each job in <calls>.
+    
+    Every request waits <latency> seconds before being answered, <latency> being either a number
+    or a dictionary mapping jobs to their latency ('*' for any other job). Requests are processed
+    one at a time, the stub being safe to use from several threads."""
+    
+    
+    def __init__(self, ident: str = "myself", passwd: str = "toto",
+                 latency: Union[float, Dict[str, float]] = 0, seed: int = 0):
+        self.ident = ident
+        self.passwd = passwd
+        self.latency = latency
+        self.classes: Dict[str, Dict[str, Any]] = {}
+        self.calls: Counter = Counter()
+        self.faults: List[Dict[str, Any]] = []
+        self.next_qclass = 9001
+        self.lock = threading.RLock()
+        self.random = random.Random(seed)
+    
+    
+    def __call__(self, url: str, data: Dict[str, Any], **kwargs: Any) -> StubResponse:
+        data = {k: v.decode("ISO-8859-1") if isinstance(v, bytes) else v for k, v in data.items()}
+        job = data.get("job")
+        
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(job, latency.get("*", 0))
+        if latency:
+            time.sleep(latency)
+        
+        with self.lock:
+            self.calls[job] += 1
+            fault = self.fault(job)
+            if fault == "timeout":
+                raise requests.Timeout("Stubbed timeout of job %s" % job)
+            if fault == "unreachable":
+                raise requests.ConnectionError("Stubbed connection error of job %s" % job)
+            if fault == "error":
+                return self.error("stubbed error of job %s" % job)
+            if fault == "invalid":
+                return StubResponse(None, "<html>\nStubbed invalid response\n</html>")
+            
+            if data.get("ident") != self.ident or data.get("passwd") != self.passwd:
+                return self.error("bad identification")
+            handler = getattr(self, "job_" + str(job), None)
+            if handler is None:
+                return self.error("unknown job %s" % job)
+            
+            status, content = handler(data)
+            if not status:
+                return self.error(content["message"])
+            return StubResponse({"status": "OK", "code": data.get("code"), **content})
+    
+    
+    def inject(self, fault: str, job: str = "*", count: Optional[int] = 1,
+               rate: float = 1) -> None:
+        """Make the next <count> requests of <job> ('*' for any job) fail with <fault>, each
+        request failing with a probability of <rate>. <count> can be None for the fault to never
+        expire.
+        
+        <fault> is one of:
+            - 'timeout': requests.Timeout is raised.
+            - 'unreachable': requests.ConnectionError is raised.
+            - 'error': the WIMS server answers with an error.
+            - 'invalid': the response is not an adm/raw response."""
+        if fault not in FAULTS:
+            raise ValueError("Unknown fault '%s', must be one of %s" % (fault, ", ".join(FAULTS)))
+        with self.lock:
+            self.faults.append({"fault": fault, "job": job, "count": count, "rate": rate})
+    
+    
+    def fault(self, job: str) -> Optional[str]:
+        """Returns the fault injected for the current request of <job>, if any."""
+        for fault in self.faults:
+            if fault["job"] not in ("*", job) or self.random.random() >= fault["rate"]:
+                continue
+            if fault["count"] is not None:
+                fault["count"] -= 1
+                if not fault["count"]:
+                    self.faults.remove(fault)
+            return fault["fault"]
+        return None
+    
+    
+    @staticmethod
+    def error(message: str) -> StubResponse:
+        return StubResponse({"status": "ERROR", "message": message})
+    
+    
+    def reset(self) -> None:
+        """Reset the counter of received requests and remove injected faults."""
+        self.calls.clear()
+        self.faults.clear()
+    
+    
+    def add_class(self, qclass: str = None, **info: Any) -> str:
+        """Add a class with a supervisor, returning its qclass."""
+        qclass = str(qclass or self.next_qclass)
+        self.next_qclass = max(self.next_qclass, int(qclass)) + 1
+        self.classes[qclass] = {
+            "info":   {
+                "description": "A title", "institution": "UPEM", "email": "test@email.com",
+                "password": "password", "lang": "en", "expiration": "20991231", "limit": "150",
+                "level": "H4", **info,
+            },
+            "users":  {
+                "supervisor": {
+                    "lastname": "Supervisor", "firstname": "", "password": "password",
+                    "email": "test@email.com",
+                },
+            },
+            "sheets": {},
+            "exams":  {},
+        }
+        return qclass
+    
+    
+    def add_sheet(self, qclass: str, sheetmode: int = 1, **info: Any) -> str:
+        """Add a sheet to the class <qclass>, returning its qsheet."""
+        sheets = self.classes[str(qclass)]["sheets"]
+        qsheet = str(max(map(int, sheets), default=0) + 1)
+        sheets[qsheet] = {"title": "Title", "description": "", "status": str(sheetmode), **info}
+        return qsheet
+    
+    
+    def add_exam(self, qclass: str, exammode: int = 1, **info: Any) -> str:
+        """Add an exam to the class <qclass>, returning its qexam."""
+        exams = self.classes[str(qclass)]["exams"]
+        qexam = str(max(map(int, exams), default=0) + 1)
+        exams[qexam] = {"title": "Title", "description": "", "status": str(exammode), **info}
+        return qexam
+    
+    
+    def populate(self, classes: int, students: int, sheets: int = 1, exams: int = 1
+                 ) -> List[str]:
+        """Add <classes> classes, each containing <students> students ('student<i>'), <sheets>
+        active sheets and <exams> active exams, returning their qclass."""
+        qclasses = []
+        for _ in range(classes):
+            qclass = self.add_class()
+            for i in range(students):
+                self.classes[qclass]["users"]["student%d" % i] = {
+                    "lastname": "Student", "firstname": str(i), "password": "password",
+                    "email": "",
+                }
+            for i in range(sheets):
+                self.add_sheet(qclass, title="Sheet %d" % (i + 1))
+            for i in range(exams):
+                self.add_exam(qclass, title="Exam %d" % (i + 1))
+            qclasses.append(qclass)
+        return qclasses
+    
+    
+    def get_class(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        wclass = self.classes.get(str(data.get("qclass")))
+        if wclass is None:
+            return False, {"message": "class %s not existing" % data.get("qclass")}
+        return True, wclass
+    
+    
+    def job_checkident(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        return True, {}
+    
+    
+    def job_getinfoserver(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        return True, {"wims_version": "4.21"}
+    
+    
+    def job_listclasses(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        if not self.classes:
+            return False, {"message": "there is no class allowed for this server"}
+        return True, {"classes_list": [{"qclass": q} for q in self.classes]}
+    
+    
+    def job_addclass(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        info = parse_data(data.get("data1"))
+        info["description"] = info.pop("name", "")
+        qclass = self.add_class(data.get("qclass"), **info)
+        self.classes[qclass]["users"]["supervisor"].update(parse_data(data.get("data2")))
+        return True, {"class_id": qclass}
+    
+    
+    def job_modclass(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        status, wclass = self.get_class(data)
+        if not status:
+            return status, wclass
+        info = parse_data(data.get("data1"))
+        if "name" in info:
+            info["description"] = info.pop("name")
+        wclass["info"].update(info)
+        return True, {"queryclass": str(data["qclass"])}
+    
+    
+    def job_delclass(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        status, wclass = self.get_class(data)
+        if status:
+            del self.classes[str(data["qclass"])]
+        return status, {} if status else wclass
+    
+    
+    def job_checkclass(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        status, wclass = self.get_class(data)
+        return status, {} if status else wclass
+    
+    
+    def job_getclass(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        status, wclass = self.get_class(data)
+        return status, {**wclass["info"], "rclass": data["rclass"]} if status else wclass
+    
+    
+    def job_adduser(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        status, wclass = self.get_class(data)
+        if not status:
+            return status, wclass
+        if data["quser"] in wclass["users"]:
+            return False, {"message": "user already exists"}
+        wclass["users"][data["quser"]] = parse_data(data.get("data1"))
+        return True, {"user_id": data["quser"]}
+    
+    
+    def job_checkuser(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        status, wclass = self.get_class(data)
+        if status and data.get("quser") not in wclass["users"]:
+            return False, {
+                "message": "user %s not in this class (%s)" % (data.get("quser"), data["qclass"])
+            }
+        return status, {} if status else wclass
+    
+    
+    def job_getuser(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        status, wclass = self.get_class(data)
+        if status and data.get("quser") not in wclass["users"]:
+            return False, {"message": "user %s not existing" % data.get("quser")}
+        return status, dict(wclass["users"][data["quser"]]) if status else wclass
+    
+    
+    def job_moduser(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        status, user = self.job_getuser(data)
+        if not status:
+            return status, user
+        self.classes[str(data["qclass"])]["users"][data["quser"]].update(
+            parse_data(data.get("data1"))
+        )
+        return True, {"user_id": data["quser"]}
+    
+    
+    def job_deluser(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        status, user = self.job_getuser(data)
+        if not status:
+            return status, user
+        del self.classes[str(data["qclass"])]["users"][data["quser"]]
+        return True, {}
+    
+    
+    def job_authuser(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        status, user = self.job_getuser(data)
+        if not status:
+            return status, user
+        return True, {
+            "wims_session": "STUB",
+            "home_url":     "http://stub.wims/wims.cgi?session=STUB&user=%s" % data["quser"],
+        }
+    
+    
+    def _get_item(self, data: Dict[str, Any], kind: str) -> Tuple[bool, Dict[str, Any]]:
+        status, wclass = self.get_class(data)
+        if not status:
+            return status, wclass
+        ident = str(data.get("q" + kind))
+        item = wclass[kind + "s"].get(ident)
+        if item is None:
+            return False, {"message": "%s %s not existing" % (kind, ident)}
+        return True, {
+            "query_" + kind: ident, **{kind + "_" + k: v for k, v in item.items()}
+        }
+    
+    
+    @staticmethod
+    def _item_info(data: Dict[str, Any], kind: str) -> Dict[str, str]:
+        """Returns the properties of the sheet or exam sent in <data>."""
+        info = parse_data(data.get("data1"))
+        stored = {k: info[k] for k in ("title", "description", "expiration") if k in info}
+        if kind + "mode" in info:
+            stored["status"] = info[kind + "mode"]
+        return stored
+    
+    
+    def _add_item(self, data: Dict[str, Any], kind: str) -> Tuple[bool, Dict[str, Any]]:
+        status, wclass = self.get_class(data)
+        if not status:
+            return status, wclass
+        info = {"status": "0", **self._item_info(data, kind)}
+        add = self.add_sheet if kind == "sheet" else self.add_exam
+        ident = add(data["qclass"], int(info.pop("status")), **info)
+        return True, {kind + "_id": ident}
+    
+    
+    def _mod_item(self, data: Dict[str, Any], kind: str) -> Tuple[bool, Dict[str, Any]]:
+        status, response = self._get_item(data, kind)
+        if not status:
+            return status, response
+        ident = str(data["q" + kind])
+        self.classes[str(data["qclass"])][kind + "s"][ident].update(self._item_info(data, kind))
+        return True, {kind + "_id": ident}
+    
+    
+    def _del_item(self, data: Dict[str, Any], kind: str) -> Tuple[bool, Dict[str, Any]]:
+        status, response = self._get_item(data, kind)
+        if not status:
+            return status, response
+        del self.classes[str(data["qclass"])][kind + "s"][str(data["q" + kind])]
+        return True, {}
+    
+    
+    def job_addsheet(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        return self._add_item(data, "sheet")
+    
+    
+    def job_modsheet(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        return self._mod_item(data, "sheet")
+    
+    
+    def job_delsheet(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        return self._del_item(data, "sheet")
+    
+    
+    def job_checksheet(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        status, response = self._get_item(data, "sheet")
+        if not status and "not existing" in response["message"]:
+            response["message"] = ("element #%s of type sheet does not exist in this class (%s)"
+                                   % (data.get("qsheet"), data["qclass"]))
+        return status, {} if status else response
+    
+    
+    def job_getsheet(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        return self._get_item(data, "sheet")
+    
+    
+    def job_listsheets(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        status, wclass = self.get_class(data)
+        return status, {"sheetlist": list(wclass["sheets"])} if status else wclass
+    
+    
+    def job_getsheetscores(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        status, response = self._get_item(data, "sheet")
+        if not status:
+            return status, response
+        users = [u for u in self.get_class(data)[1]["users"] if u != "supervisor"]
+        if not users:
+            return False, {"message": "There is no user in this class"}
+        return True, {"data_scores": [
+            {"id": u, "user_quality": 0, "user_percent": 0, "user_best": 0, "user_level": 0}
+            for u in users
+        ]}
+    
+    
+    def job_addexam(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        return self._add_item(data, "exam")
+    
+    
+    def job_modexam(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        return self._mod_item(data, "exam")
+    
+    
+    def job_delexam(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        return self._del_item(data, "exam")
+    
+    
+    def job_checkexam(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        status, response = self._get_item(data, "exam")
+        if not status and "not existing" in response["message"]:
+            response["message"] = ("element #%s of type exam does not exist in this class (%s)"
+                                   % (data.get("qexam"), data["qclass"]))
+        return status, {} if status else response
+    
+    
+    def job_getexam(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        return self._get_item(data, "exam")
+    
+    
+    def job_listexams(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        status, wclass = self.get_class(data)
+        return status, {"examlist": list(wclass["exams"])} if status else wclass
+    
+    
+    def job_getexamscores(self, data: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        status, response = self._get_item(data, "exam")
+        if not status:
+            return status, response
+        users = [u for u in self.get_class(data)[1]["users"] if u != "supervisor"]
+        if not users:
+            return False, {"message": "There's no user in this class"}
+        return True, {"data_scores": [{"id": u, "score": 0} for u in users]}
+
+
+
+class StubWimsHandler(BaseHTTPRequestHandler):
+    """Answer the adm/raw requests received by a StubWimsServer with its stub."""
+    
+    
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        data = dict(parse_qsl(self.rfile.read(length).decode("ISO-8859-1"),
+                              keep_blank_values=True, encoding="ISO-8859-1"))
+        try:
+            response = self.server.stub(self.server.url, data=data)
+        except requests.Timeout:
+            self.server.stopped.wait(self.server.timeout_delay)
+            self.close_connection = True
+            return
+        except requests.ConnectionError:
+            self.close_connection = True
+            return
+        
+        content = response.content
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+    
+    
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+
+class StubLMSHandler(BaseHTTPRequestHandler):
+    """Accept the grades sent to the outcome service of a StubLMSServer."""
+    
+    
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        root = ElementTree.fromstring(self.rfile.read(length).decode())
+        identifier = int(root[0][0][1].text)
+        sourcedid = root[1][0][0][0][0].text
+        grade = float(root[1][0][0][1][0][1].text)
+        with self.server.lock:
+            self.server.grades[sourcedid] = grade
+        
+        with open(os.path.join(os.path.dirname(__file__), "resources/replaceResult.xml")) as f:
+            content = (f.read() % ("success", sourcedid, grade, identifier)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+    
+    
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+
+class StubServer(ThreadingHTTPServer):
+    """HTTP server listening on <host>:<port> (a free port if 0), which can be run in a
+    background thread."""
+    
+    daemon_threads = True
+    
+    
+    def __init__(self, handler: type, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), handler)
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+    
+    
+    def start(self) -> 'StubServer':
+        """Serve in a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+    
+    
+    def stop(self) -> None:
+        """Stop serving and release the port."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.shutdown()
+            self.thread.join()
+        self.server_close()
+    
+    
+    def __enter__(self) -> 'StubServer':
+        return self.start()
+    
+    
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+
+
+class StubWimsServer(StubServer):
+    """Serve <stub> over HTTP.
+    
+    Injected timeouts hold the connection <timeout_delay> seconds (or until the server is stopped)
+    without answering, and connection errors close it without answering."""
+    
+    
+    def __init__(self, stub: Optional[StubWims] = None, host: str = "127.0.0.1", port: int = 0,
+                 timeout_delay: float = 60):
+        super().__init__(StubWimsHandler, host, port)
+        self.stub = stub if stub is not None else StubWims()
+        self.timeout_delay = timeout_delay
+    
+    
+    @property
+    def url(self) -> str:
+        """URL of the adm/raw module of the served stub."""
+        host, port = self.server_address[:2]
+        return "http://%s:%d/wims/wims.cgi" % (host, port)
+
+
+
+class StubLMSServer(StubServer):
+    """Outcome service of a fake LMS, accepting every grade sent and storing the last grade
+    received for each sourcedid in <grades>."""
+    
+    
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        super().__init__(StubLMSHandler, host, port)
+        self.grades: Dict[str, float] = {}
+        self.lock = threading.Lock()
+    
+    
+    @property
+    def url(self) -> str:
+        """URL of the outcome service."""
+        host, port = self.server_address[:2]
+        return "http://%s:%d/outcome" % (host, port)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+#  surge.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+"""Warm-up of the state needed by the launches of an exam during a surge.
+
+When hundreds of students launch an exam within a few minutes, each launch would otherwise check
+the WIMS server, fetch its class and exam and check the existence of its user. For each ExamSurge
+starting within settings.SURGE_WARMUP_LEAD, warm_up() fetches these once and caches them until
+the end of the surge, so that launches of its exam only send 'authuser' to the WIMS server. The
+warm-up is repeated every settings.SURGE_WARMUP_REFRESH during the surge, bounding how long a
+change made on the WIMS server (e.g. closing the exam) goes unnoticed.
+
+Only the fields of the class and the exam used by the launches are cached, the passwords of the
+class and of its supervisor never being stored in the shared cache."""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Optional
+
+import requests
+import wimsapi
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Model, QuerySet
+from django.utils import timezone
+
+from lti_app import probes
+from lti_app.capabilities import get_capability
+
+
+logger = logging.getLogger(__name__)
+
+
+
+def _key(wims_pk: int, *parts: str) -> str:
+    """Returns the cache key of a state of the WIMS server <wims_pk> warmed up for a surge."""
+    return "lti_app:surge:%d:%s" % (wims_pk, ":".join(str(p) for p in parts))
+
+
+
+def healthy(wims_pk: int, qclass: str, qexam: Any) -> bool:
+    """Returns whether the WIMS server <wims_pk> was joined successfully by the warm-up, still in
+    effect, of the exam <qexam> of the class <qclass>."""
+    return bool(cache.get(_key(wims_pk, "healthy", qclass, qexam)))
+
+
+
+def cached_class(wims: Model, qclass: str) -> Optional[wimsapi.Class]:
+    """Returns the class <qclass> of <wims> if cached by a warm-up, None otherwise.
+    
+    The returned class only has the fields needed by the launches (qclass, rclass and lang), and
+    can be used to send requests about its users and items."""
+    fields = cache.get(_key(wims.pk, "class", qclass))
+    if fields is None:
+        return None
+    wclass = wimsapi.Class(fields["rclass"], "", "", "", "", None, qclass=fields["qclass"],
+                           lang=fields["lang"])
+    wclass._api = wimsapi.WimsAPI(wims.url, wims.ident, wims.passwd,
+                                  timeout=settings.WIMSAPI_TIMEOUT)
+    wclass._saved = True
+    return wclass
+
+
+
+def cached_exam(wims_pk: int, qclass: str, qexam: Any) -> Optional[wimsapi.Exam]:
+    """Returns the exam <qexam> of the class <qclass> of <wims_pk> if cached by a warm-up, None
+    otherwise. The returned exam only has the fields needed by the launches (qexam, title and
+    exammode)."""
+    fields = cache.get(_key(wims_pk, "exam", qclass, qexam))
+    if fields is None:
+        return None
+    exam = wimsapi.Exam(fields["title"], exammode=fields["exammode"])
+    exam.qexam = fields["qexam"]
+    return exam
+
+
+
+def due(now: Optional[datetime] = None) -> QuerySet:
+    """Returns the surges which should be warmed up at <now>: those starting within
+    settings.SURGE_WARMUP_LEAD and not ended, never warmed up or not since
+    settings.SURGE_WARMUP_REFRESH."""
+    ExamSurge = apps.get_model("lti_app", "ExamSurge")
+    
+    now = now or timezone.now()
+    return (
+        ExamSurge.objects
+        .filter(start__lte=now + settings.SURGE_WARMUP_LEAD, end__gt=now)
+        .exclude(warmed__gt=now - settings.SURGE_WARMUP_REFRESH)
+        .select_related("exam__wclass__wims__capability")
+    )
+
+
+
+def warm_up(surge: Model, now: Optional[datetime] = None) -> int:
+    """Fetch the state needed by the launches of <surge> and cache it until its end.
+    
+    Raises:
+        - wimsapi.WimsAPIError if the WIMS' server denied a request.
+        - requests.RequestException if the WIMS server could not be joined.
+    
+    Returns the number of users whose existence was confirmed."""
+    WimsUser = apps.get_model("lti_app", "WimsUser")
+    
+    now = now or timezone.now()
+    ttl = (surge.end - now).total_seconds()
+    if ttl <= 0:
+        return 0
+    
+    exam_db = surge.exam
+    wclass_db = exam_db.wclass
+    wims = wclass_db.wims
+    api = wimsapi.WimsAPI(wims.url, wims.ident, wims.passwd, timeout=settings.WIMSAPI_TIMEOUT)
+    
+    status, response = api.checkident(verbose=True)
+    if not status:
+        raise wimsapi.WimsAPIError(response['message'])
+    
+    wclass = wimsapi.Class.get(wims.url, wims.ident, wims.passwd, wclass_db.qclass, wims.rclass,
+                               timeout=settings.WIMSAPI_TIMEOUT)
+    exam = wclass.getitem(exam_db.qexam, wimsapi.Exam)
+    
+    capability = get_capability(wims)
+    job = "checkuser" if capability.known and capability.supports("checkuser") else "getuser"
+    qusers = list(WimsUser.objects.filter(wclass=wclass_db).values_list("quser", flat=True))
+    
+    def exists(quser: str) -> bool:
+        try:
+            return getattr(api, job)(wclass_db.qclass, wims.rclass, quser)[0]
+        except requests.RequestException:
+            return False
+    
+    with ThreadPoolExecutor(max_workers=settings.SURGE_WARMUP_CONCURRENCY) as executor:
+        existing = [q for q, ok in zip(qusers, executor.map(exists, qusers)) if ok]
+    for quser in existing:
+        probes.remember_user(wims, wclass_db.qclass, quser, ttl)
+    
+    cache.set(_key(wims.pk, "class", wclass_db.qclass), {
+        "qclass": wclass.qclass,
+        "rclass": wclass.rclass,
+        "lang":   wclass.lang,
+    }, ttl)
+    cache.set(_key(wims.pk, "exam", wclass_db.qclass, exam_db.qexam), {
+        "qexam":    exam.qexam,
+        "title":    exam.title,
+        "exammode": exam.exammode,
+    }, ttl)
+    cache.set(_key(wims.pk, "healthy", wclass_db.qclass, exam_db.qexam), True, ttl)
+    
+    surge.warmed = now
+    surge.save(update_fields=["warmed"])
+    logger.info("Warmed up exam %s of class %s for %d users until %s"
+                % (exam_db.qexam, wclass_db.qclass, len(existing), surge.end))
+    return len(existing)
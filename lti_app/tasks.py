@@ -7,10 +7,17 @@
 
 import logging
 import traceback
+from typing import Any, Optional
 
+import requests
 import wimsapi
 from django.apps import apps
+from django.db.models import Q
+from django.utils import timezone
 
+from lti_app import metrics, probes, retention, surge
+from lti_app.capabilities import probe
+from lti_app.scheduling import JobRun, SLOTS, timeout_before
 from wimsLTI import settings
 
 
@@ -18,17 +25,25 @@ logger = logging.getLogger(__name__)
 
 
 
-def send_back_all_sheets_grades() -> int:
-    """Send back the grades of every User of every WimsSheet to their corresponding LMS."""
+@metrics.timed("lti_job_seconds", job="send_back_all_sheets_grades")
+def send_back_all_sheets_grades(window: float = 0, budget: Optional[float] = None,
+                                server_budget: Optional[float] = None) -> int:
+    """Send back the grades of every User of every WimsSheet to their corresponding LMS.
+    
+    Sheets are processed according to the slot of their class, the job pacing itself to spread
+    the work over <window> seconds, see lti_app.scheduling.JobRun for <budget> and
+    <server_budget>."""
     GradeLinkSheet = apps.get_model("lti_app", "GradeLinkSheet")
     WimsSheet = apps.get_model("lti_app", "WimsSheet")
     total = 0
     
     logger.info("Sending grades of every User of every WimsSheet to their LMS")
-    for sheet in WimsSheet.objects.all():
+    run = JobRun("send_back_all_sheets_grades", window, budget, server_budget)
+    sheets = WimsSheet.objects.select_related("wclass__wims")
+    for wims, sheet in run.items(sheets, "wclass__wims", "wclass__slot"):
         try:
-            total = + GradeLinkSheet.send_back_all(sheet)
-        except wimsapi.WimsAPIError:  # pragma: no cover
+            total += GradeLinkSheet.send_back_all(sheet, run.server_deadline(wims))
+        except (wimsapi.WimsAPIError, requests.RequestException):  # pragma: no cover
             logger.info("Failed to send grade for sheet '%s'" % str(sheet))
             logger.info(traceback.format_exc())
     logger.info("Done sending grades of every User of every WimsSheet to their LMS (%d sent)"
@@ -37,17 +52,26 @@ def send_back_all_sheets_grades() -> int:
 
 
 
-def send_back_all_exams_grades() -> int:
-    """Send back the grades of every User of every WimsExam to their corresponding LMS."""
+@metrics.timed("lti_job_seconds", job="send_back_all_exams_grades")
+def send_back_all_exams_grades(window: float = 0, budget: Optional[float] = None,
+                               server_budget: Optional[float] = None) -> int:
+    """Send back the grades of every User of every WimsExam to their corresponding LMS.
+    
+    Exams are processed according to the slot of their class, the job pacing itself to spread
+    the work over <window> seconds, see lti_app.scheduling.JobRun for <budget> and
+    <server_budget>. Positions are shifted by half the window so that a class is not hit by this
+    job and send_back_all_sheets_grades(), sharing the same trigger, at the same time."""
     GradeLinkExam = apps.get_model("lti_app", "GradeLinkExam")
     WimsExam = apps.get_model("lti_app", "WimsExam")
     total = 0
     
     logger.info("Sending grades of every User of every WimsExam to their LMS")
-    for exam in WimsExam.objects.all():
+    run = JobRun("send_back_all_exams_grades", window, budget, server_budget, shift=SLOTS // 2)
+    exams = WimsExam.objects.select_related("wclass__wims")
+    for wims, exam in run.items(exams, "wclass__wims", "wclass__slot"):
         try:
-            total = + GradeLinkExam.send_back_all(exam)
-        except wimsapi.WimsAPIError:  # pragma: no cover
+            total += GradeLinkExam.send_back_all(exam, run.server_deadline(wims))
+        except (wimsapi.WimsAPIError, requests.RequestException):  # pragma: no cover
             logger.info("Failed to send grade for exam '%s'" % str(exam))
             logger.info(traceback.format_exc())
     logger.info("Done sending grades of every User of every WimsExam to their LMS (%d sent)"
@@ -56,21 +80,38 @@ def send_back_all_exams_grades() -> int:
 
 
 
-def check_classes_exists() -> int:
+@metrics.timed("lti_job_seconds", job="check_classes_exists")
+def check_classes_exists(window: float = 0, budget: Optional[float] = None,
+                         server_budget: Optional[float] = None) -> int:
     """Checks that the corresponding class exists on its WIMS server for every WimsClass. Delete
-    the instance of WimsClass if not."""
+    the instance of WimsClass if not, and fetch its expiration date if it has none (see
+    lti_app.retention).
+    
+    Classes are processed according to their slot, the job pacing itself to spread the work over
+    <window> seconds, see lti_app.scheduling.JobRun for <budget> and <server_budget>."""
     WimsClass = apps.get_model("lti_app", "WimsClass")
     
     deleted = 0
-    for c in WimsClass.objects.all():
+    run = JobRun("check_classes_exists", window, budget, server_budget)
+    classes = WimsClass.objects.select_related("wims__capability")
+    for wims, c in run.items(classes, "wims", "slot"):
+        timeout = timeout_before(run.server_deadline(wims), settings.WIMSAPI_TIMEOUT)
         try:
-            wimsapi.Class.get(
-                c.wims.url, c.wims.ident, c.wims.passwd, c.qclass, c.wims.rclass,
-                timeout=settings.WIMSAPI_TIMEOUT
+            exists = probes.class_exists(c.wims, c.qclass, timeout=timeout)
+            if exists and c.expiration is None:
+                retention.fetch_expiration(c, timeout)
+        except requests.RequestException:  # pragma: no cover
+            logger.info("Could not join the WIMS server '%s' while checking class of pk '%s'"
+                        % (c.wims.url, str(c.pk)))
+        except wimsapi.WimsAPIError:  # pragma: no cover
+            logger.info(
+                "An error occurred checking for class of pk '%s' (qclass '%s', server '%s')"
+                % (str(c.pk), str(c.qclass), c.wims.url)
             )
-        except wimsapi.WimsAPIError as e:
+            logger.info(traceback.format_exc())
+        else:
             # Delete the class if it does not exists on the server anymore
-            if "class %s not existing" % str(c.qclass) in str(e):
+            if not exists:
                 logger.info(
                     (
                         "Deleting class of pk '%s' has the corresponding class of id '%s' does not "
@@ -78,12 +119,174 @@ def check_classes_exists() -> int:
                     % (str(c.pk), str(c.qclass), c.wims.url)
                 )
                 c.delete()
+                probes.forget(c.wims, c.qclass)
                 deleted += 1
-            else:  # pragma: no cover
-                logger.info(
-                    "An error occurred checking for class of pk '%s' (qclass '%s', server '%s')"
-                    % (str(c.pk), str(c.qclass), c.wims.url)
-                )
-                logger.info(traceback.format_exc())
     
     return deleted
+
+
+
+@metrics.timed("lti_job_seconds", job="refresh_capabilities")
+def refresh_capabilities() -> int:
+    """Probe the capabilities of every WIMS server which has never been probed or whose
+    capabilities are older than settings.WIMS_CAPABILITIES_TTL, unless its last probe failed
+    less than settings.WIMS_CAPABILITIES_RETRY ago."""
+    WIMS = apps.get_model("lti_app", "WIMS")
+    
+    refreshed = 0
+    now = timezone.now()
+    stale = (Q(capability__isnull=True) | Q(capability__checked__isnull=True)
+             | Q(capability__checked__lt=now - settings.WIMS_CAPABILITIES_TTL))
+    retry = (Q(capability__failed__isnull=True)
+             | Q(capability__failed__lt=now - settings.WIMS_CAPABILITIES_RETRY))
+    for wims in WIMS.objects.filter(stale & retry):
+        try:
+            probe(wims)
+            refreshed += 1
+        except (wimsapi.WimsAPIError, requests.RequestException):  # pragma: no cover
+            logger.info("Could not refresh the capabilities of WIMS server '%s'" % wims.url)
+            logger.info(traceback.format_exc())
+    
+    return refreshed
+
+
+
+@metrics.timed("lti_job_seconds", job="warm_up_exams")
+def warm_up_exams() -> int:
+    """Warm up the exams whose surge starts within settings.SURGE_WARMUP_LEAD, see
+    lti_app.surge. Returns the number of warmed up surges."""
+    warmed = 0
+    for exam_surge in surge.due():
+        try:
+            surge.warm_up(exam_surge)
+            warmed += 1
+        except (wimsapi.WimsAPIError, requests.RequestException):
+            logger.warning("Could not warm up exam surge %d" % exam_surge.pk)
+            logger.info(traceback.format_exc())
+    
+    return warmed
+
+
+
+@metrics.timed("lti_job_seconds", job="archive_expired_classes")
+def archive_expired_classes() -> int:
+    """Archive and delete the classes expired for longer than settings.CLASS_RETENTION, see
+    lti_app.retention."""
+    logger.info("Archiving expired classes")
+    return retention.archive_expired()
+
+
+
+def fill_lookup_hashes(**kwargs: Any) -> int:
+    """Compute the digests of the LTI identifiers of the rows saved before these digests were
+    introduced, returning the number of updated rows.
+    
+    Connected to the post_migrate signal, does nothing once every digest is filled."""
+    from lti_app.models import digest
+    
+    filled = 0
+    for name, field in (("LMS", "guid"), ("WimsClass", "lms_guid"), ("WimsUser", "lms_guid"),
+                        ("WimsSheet", "lms_guid"), ("WimsExam", "lms_guid")):
+        model = apps.get_model("lti_app", name)
+        queryset = (model.objects.filter(**{field + "_hash": None}).exclude(**{field: None})
+                    .only("pk", field).order_by("pk"))
+        while True:
+            rows = list(queryset[:settings.SCHEDULED_JOBS_CHUNK_SIZE])
+            if not rows:
+                break
+            for row in rows:
+                setattr(row, field + "_hash", digest(getattr(row, field)))
+            model.objects.bulk_update(rows, [field + "_hash"])
+            filled += len(rows)
+    
+    if filled:
+        logger.info("Filled the lookup digests of %d rows" % filled)
+    return filled
+
+
+
+def fill_class_name_keys(**kwargs: Any) -> int:
+    """Compute the name keys of the classes saved before these keys were introduced, returning the
+    number of updated classes.
+    
+    Connected to the post_migrate signal, does nothing once every key is filled."""
+    from lti_app.models import name_key
+    
+    WimsClass = apps.get_model("lti_app", "WimsClass")
+    
+    filled = 0
+    queryset = (WimsClass.objects.filter(name_key="").exclude(name="").only("pk", "name")
+                .order_by("pk"))
+    while True:
+        rows = list(queryset[:settings.SCHEDULED_JOBS_CHUNK_SIZE])
+        if not rows:
+            break
+        for row in rows:
+            row.name_key = name_key(row.name)
+        WimsClass.objects.bulk_update(rows, ["name_key"])
+        filled += len(rows)
+    
+    if filled:
+        logger.info("Filled the name keys of %d classes" % filled)
+    return filled
+
+
+
+def fill_class_slots(**kwargs: Any) -> int:
+    """Compute the slots of the classes saved before these slots were introduced, returning the
+    number of updated classes.
+    
+    Connected to the post_migrate signal, does nothing once every slot is filled."""
+    from lti_app.scheduling import slot
+    
+    WimsClass = apps.get_model("lti_app", "WimsClass")
+    
+    filled = 0
+    queryset = WimsClass.objects.filter(slot=None).only("pk", "qclass").order_by("pk")
+    while True:
+        rows = list(queryset[:settings.SCHEDULED_JOBS_CHUNK_SIZE])
+        if not rows:
+            break
+        for row in rows:
+            row.slot = slot(row.qclass)
+        WimsClass.objects.bulk_update(rows, ["slot"])
+        filled += len(rows)
+    
+    if filled:
+        logger.info("Filled the slots of %d classes" % filled)
+    return filled
+
+
+
+def fill_outcome_services(**kwargs: Any) -> int:
+    """Create the outcome services of the grade links saved before OutcomeService was introduced,
+    from their legacy url and lms columns, returning the number of updated links.
+    
+    Connected to the post_migrate signal, does nothing once every link references its service."""
+    from lti_app.models import lookup, upsert
+    
+    OutcomeService = apps.get_model("lti_app", "OutcomeService")
+    
+    filled = 0
+    services = {}
+    for name in ("GradeLinkSheet", "GradeLinkExam"):
+        model = apps.get_model("lti_app", name)
+        queryset = (model.objects.filter(service=None).exclude(url=None).exclude(lms=None)
+                    .only("pk", "url", "lms_id").order_by("pk"))
+        while True:
+            rows = list(queryset[:settings.SCHEDULED_JOBS_CHUNK_SIZE])
+            if not rows:
+                break
+            for row in rows:
+                key = (row.lms_id, row.url)
+                if key not in services:
+                    services[key] = upsert(
+                        OutcomeService, {"lms_id": row.lms_id, **lookup("url", row.url)}, {}
+                    )[0]
+                row.service = services[key]
+            model.objects.bulk_update(rows, ["service"])
+            filled += len(rows)
+    
+    if filled:
+        logger.info("Filled the outcome services of %d grade links" % filled)
+    return filled
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+#
+#  cassettes.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+"""Record and replay the adm/raw calls sent to the WIMS server used for tests.
+
+The calls of each test (and of the setUpClass() of its test case) are stored in a cassette, a JSON
+file of the 'cassettes' directory named after the test, tests sending no call having none. The
+cassettes are recorded against the wims-minimal docker image by the 'record' workflow and
+committed. The behaviour is chosen with the environment variable WIMS_CASSETTES:
+
+    - 'once' (default): replay the cassette if it exists, record it against WIMS_URL otherwise.
+    - 'replay': always replay, a call missing from the cassette failing the test. No WIMS server
+      is needed, so that the tests can run with --parallel once every cassette is committed.
+    - 'record': record every cassette again against WIMS_URL.
+    - 'off': always use WIMS_URL, nothing being recorded.
+
+A cassette is never recorded if WIMS_URL cannot be joined, the test failing instead.
+
+Replayed calls are matched on the fields of MATCH_ON, each recorded call being replayed once, in
+the order it was recorded. Cassettes re-recorded against a newer WIMS server can be compared to
+the previous ones to detect a drift of its responses::
+
+    python3 -m lti_app.tests.cassettes OLD_DIRECTORY NEW_DIRECTORY"""
+
+import json
+import os
+import sys
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from unittest import mock
+from urllib.parse import urlsplit
+
+import requests
+
+from lti_app.stub import StubResponse
+
+
+# Mode of the cassettes, see the documentation of this module.
+MODE = os.getenv("WIMS_CASSETTES", "once")
+
+# URL to the WIMS server used for tests, the server must recognise ident 'myself' and passwd 'toto'
+WIMS_URL = os.getenv("WIMS_URL") or "http://localhost:7777/wims/wims.cgi"
+
+# Directory containing the cassettes.
+DIRECTORY = os.path.join(os.path.dirname(__file__), "cassettes")
+
+# Fields of a call identifying the recorded call to replay.
+MATCH_ON = ("job", "ident", "qclass", "rclass", "quser", "qsheet", "qexam")
+
+# Fields of a call which are not stored.
+SECRET = ("passwd", "code")
+
+
+
+class CassetteError(AssertionError):
+    """Raised when a call cannot be replayed."""
+
+
+
+class Cassette:
+    """Record the calls sent through wimsapi.api.post while active, or replay them from the
+    cassette <name>.
+    
+    Recorded calls are not saved if an exception is raised or if <keep> is set to False."""
+    
+    # Cassette currently active, if any.
+    current: Optional['Cassette'] = None
+    
+    
+    def __init__(self, name: str, mode: str = MODE):
+        self.name = name
+        self.mode = mode
+        self.path = os.path.join(DIRECTORY, name + ".json")
+        self.recording = mode == "record" or (mode == "once" and not os.path.exists(self.path))
+        self.interactions: List[Dict[str, Any]] = []
+        self.remaining: Dict[Tuple, Deque[Dict[str, Any]]] = defaultdict(deque)
+        self.patcher: Optional[Any] = None
+        self.post: Optional[Any] = None
+        self.keep = True
+    
+    
+    @staticmethod
+    def key(data: Dict[str, Any]) -> Tuple:
+        """Returns the fields of <data> identifying a call."""
+        return tuple(str(data.get(field, "")) for field in MATCH_ON)
+    
+    
+    def load(self) -> None:
+        """Load the recorded calls of the cassette, a missing cassette containing no call."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            self.interactions = json.load(f)
+        for interaction in self.interactions:
+            self.remaining[self.key(interaction["request"])].append(interaction)
+    
+    
+    def save(self) -> None:
+        """Write the recorded calls to the cassette, removing it if there is none."""
+        if not self.interactions:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        os.makedirs(DIRECTORY, exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.interactions, f, indent=4, sort_keys=True)
+            f.write("\n")
+        os.replace(self.path + ".tmp", self.path)
+    
+    
+    def record(self, url: str, data: Dict[str, Any], **kwargs: Any) -> Any:
+        """Send the call through the real wimsapi.api.post, recording its response.
+        
+        Raises CassetteError if WIMS_URL cannot be joined, recording the connection error would
+        make the test pass against no server at all."""
+        request = {k: str(v) for k, v in data.items() if k not in SECRET}
+        try:
+            response = self.post(url, data=data, **kwargs)
+        except requests.ConnectionError as e:
+            if urlsplit(url).netloc != urlsplit(WIMS_URL).netloc:
+                self.interactions.append({
+                    "request":  request,
+                    "response": {"exception": type(e).__name__, "message": str(e)},
+                })
+                raise
+            self.keep = False
+            raise CassetteError("Could not record the cassette '%s', the WIMS server %s could not "
+                                "be joined: %s" % (self.path, WIMS_URL, str(e)))
+        except requests.RequestException as e:
+            self.interactions.append({
+                "request":  request,
+                "response": {"exception": type(e).__name__, "message": str(e)},
+            })
+            raise
+        self.interactions.append({
+            "request":  request,
+            "response": {"status_code": response.status_code, "text": response.text},
+        })
+        return response
+    
+    
+    def replay(self, url: str, data: Dict[str, Any], **kwargs: Any) -> StubResponse:
+        """Returns the response recorded for the call."""
+        key = self.key(data)
+        if not self.remaining[key]:
+            raise CassetteError("No call matching %s left in the cassette '%s', record it again "
+                                "with WIMS_CASSETTES=record" % (dict(zip(MATCH_ON, key)), self.path))
+        response = self.remaining[key].popleft()["response"]
+        if "exception" in response:
+            raise getattr(requests.exceptions, response["exception"])(response["message"])
+        
+        try:
+            body = json.loads(response["text"])
+        except ValueError:
+            body = None
+        replayed = StubResponse(body, response["text"])
+        replayed.status_code = response["status_code"]
+        return replayed
+    
+    
+    def __call__(self, url: str, data: Dict[str, Any] = None, **kwargs: Any) -> Any:
+        data = {
+            k: v.decode("ISO-8859-1") if isinstance(v, bytes) else v
+            for k, v in (data or {}).items()
+        }
+        if self.recording:
+            return self.record(url, data, **kwargs)
+        return self.replay(url, data, **kwargs)
+    
+    
+    def __enter__(self) -> 'Cassette':
+        if self.mode == "off":
+            return self
+        if not self.recording:
+            self.load()
+        
+        import wimsapi.api
+        self.post = wimsapi.api.post
+        self.patcher = mock.patch("wimsapi.api.post", self)
+        self.patcher.start()
+        Cassette.current = self
+        return self
+    
+    
+    def __exit__(self, exc_type: Optional[type], *args: Any) -> None:
+        if self.patcher is None:
+            return
+        self.patcher.stop()
+        Cassette.current = None
+        if self.recording and self.keep and exc_type is None:
+            self.save()
+
+
+
+def replaying() -> bool:
+    """Returns whether the calls to WIMS are currently replayed, the WIMS server not being
+    joined."""
+    return Cassette.current is not None and not Cassette.current.recording
+
+
+
+class CassetteMixin:
+    """Mixin of test cases recording or replaying the WIMS calls of each of their tests, and of
+    their setUpClass(), see Cassette."""
+    
+    
+    @classmethod
+    def setUpClass(cls) -> None:
+        with Cassette("%s.%s.setUpClass" % (cls.__module__, cls.__qualname__)):
+            super().setUpClass()
+    
+    
+    def run(self, result: Any = None) -> Any:
+        result = result if result is not None else self.defaultTestResult()
+        failed = len(result.failures) + len(result.errors)
+        with Cassette(self.id()) as cassette:
+            super().run(result)
+            # Do not record the calls of a failed test, which may not be the expected ones
+            cassette.keep &= len(result.failures) + len(result.errors) == failed
+        return result
+
+
+
+def signature(interactions: List[Dict[str, Any]]) -> List[Tuple[str, str, Tuple[str, ...]]]:
+    """Returns the job, the outcome and the fields of the response of each call of
+    <interactions>, ignoring the values which differ between recordings."""
+    calls = []
+    for interaction in interactions:
+        response = interaction["response"]
+        if "exception" in response:
+            calls.append((interaction["request"].get("job", ""), response["exception"], ()))
+            continue
+        try:
+            body = json.loads(response["text"])
+            status, fields = body.get("status", ""), tuple(sorted(set(body) - {"code"}))
+        except (ValueError, AttributeError):
+            status, fields = response["text"].split("\n", 1)[0].split(" ", 1)[0], ()
+        calls.append((interaction["request"].get("job", ""), status, fields))
+    return calls
+
+
+
+def drift(old: str, new: str) -> List[str]:
+    """Returns the differences between the cassettes of the directories <old> and <new>."""
+    names = {n for d in (old, new) for n in os.listdir(d) if n.endswith(".json")}
+    differences = []
+    for name in sorted(names):
+        if not os.path.exists(os.path.join(old, name)):
+            differences.append("%s: new cassette" % name)
+            continue
+        if not os.path.exists(os.path.join(new, name)):
+            differences.append("%s: cassette not recorded anymore" % name)
+            continue
+        
+        with open(os.path.join(old, name)) as f:
+            before = signature(json.load(f))
+        with open(os.path.join(new, name)) as f:
+            after = signature(json.load(f))
+        if before != after:
+            index = next(
+                (i for i, (a, b) in enumerate(zip(before, after)) if a != b),
+                min(len(before), len(after))
+            )
+            differences.append("%s: call %d differs, %s recorded, %s previously" % (
+                name, index + 1, after[index] if index < len(after) else "nothing",
+                before[index] if index < len(before) else "nothing",
+            ))
+    return differences
+
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage: python3 -m lti_app.tests.cassettes OLD_DIRECTORY NEW_DIRECTORY\n")
+        sys.exit(2)
+    found = drift(sys.argv[1], sys.argv[2])
+    for difference in found:
+        sys.stdout.write(difference + "\n")
+    sys.exit(1 if found else 0)
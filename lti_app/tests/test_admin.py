@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+#  test_admin.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from lti_app import admin, db
+from lti_app.models import (GradeLinkSheet, LMS, OutcomeService, WIMS, WimsClass, WimsSheet,
+                            WimsUser)
+
+
+
+class ScalableAdminTestCase(TestCase):
+    
+    def setUp(self):
+        self.client.force_login(
+            User.objects.create_superuser("admin", "admin@upem.fr", "password")
+        )
+        self.lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                      name="Moodle UPEM", key="provider1", secret="secret1")
+        self.wims = WIMS.objects.create(url="https://wims.upem.fr", name="WIMS UPEM",
+                                        ident="myself", passwd="toto", rclass="myclass")
+        self.wclass = WimsClass.objects.create(lms=self.lms, lms_guid="77777", wims=self.wims,
+                                               qclass="1", name="test1")
+        self.sheet = WimsSheet.objects.create(wclass=self.wclass, lms_guid="1", qsheet="1")
+        self.service = OutcomeService.get(self.lms, "https://elearning.u-pem.fr/outcome")
+    
+    
+    def add_users(self, n: int) -> None:
+        start = WimsUser.objects.count()
+        for i in range(start, start + n):
+            user = WimsUser.objects.create(wclass=self.wclass, lms_guid=str(i), quser="user%d" % i)
+            GradeLinkSheet.objects.create(user=user, activity=self.sheet, sourcedid=str(i),
+                                          service=self.service)
+    
+    
+    def changelist(self, url: str, **params: str) -> CaptureQueriesContext:
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(url, params)
+        self.assertEqual(200, response.status_code)
+        captured.response = response
+        return captured
+    
+    
+    def test_queries_independent_of_rows(self):
+        url = reverse("admin:lti_app_gradelinksheet_changelist")
+        self.add_users(2)
+        few = len(self.changelist(url))
+        self.add_users(20)
+        self.assertEqual(few, len(self.changelist(url)))
+    
+    
+    def test_cursor_pagination(self):
+        self.add_users(5)
+        url = reverse("admin:lti_app_wimsuser_changelist")
+        seen = []
+        params = {}
+        with mock.patch.object(admin.WIMSUserAdmin, "list_per_page", 2):
+            while True:
+                cl = self.changelist(url, **params).response.context["cl"]
+                seen += [u.quser for u in cl.result_list]
+                if cl.next_cursor is None:
+                    break
+                params = {admin.CURSOR_VAR: str(cl.next_cursor)}
+        self.assertEqual(["user%d" % i for i in range(4, -1, -1)], seen)
+    
+    
+    def test_cursor_invalid(self):
+        response = self.client.get(reverse("admin:lti_app_wimsuser_changelist"),
+                                   {admin.CURSOR_VAR: "abc"})
+        self.assertEqual(302, response.status_code)
+    
+    
+    def test_search(self):
+        self.add_users(3)
+        url = reverse("admin:lti_app_wimsuser_changelist")
+        cl = self.changelist(url, q="user1").response.context["cl"]
+        self.assertEqual(["user1"], [u.quser for u in cl.result_list])
+        cl = self.changelist(url, q="2").response.context["cl"]
+        self.assertEqual(["user2"], [u.quser for u in cl.result_list])
+        cl = self.changelist(url, q="user").response.context["cl"]
+        self.assertEqual([], cl.result_list)
+    
+    
+    def test_estimated_count(self):
+        self.add_users(3)
+        url = reverse("admin:lti_app_wimsuser_changelist")
+        WimsUser.objects.filter(quser="user1").delete()
+        
+        cl = self.changelist(url).response.context["cl"]
+        self.assertEqual(2, cl.result_count)
+        self.assertFalse(cl.result_count_estimated)
+        
+        # The greatest primary key overstates the number of users, which are counted exactly
+        # while fewer than the threshold
+        with override_settings(ADMIN_ESTIMATED_COUNT_THRESHOLD=3):
+            cl = self.changelist(url).response.context["cl"]
+            self.assertEqual(2, cl.result_count)
+            self.assertFalse(cl.result_count_estimated)
+        
+        with override_settings(ADMIN_ESTIMATED_COUNT_THRESHOLD=1):
+            cl = self.changelist(url).response.context["cl"]
+            self.assertEqual(db.estimated_count(WimsUser), cl.result_count)
+            self.assertTrue(cl.result_count_estimated)
+            cl = self.changelist(url, q="user2").response.context["cl"]
+            self.assertEqual(1, cl.result_count)
+            self.assertFalse(cl.result_count_estimated)
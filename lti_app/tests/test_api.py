@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+#  test_api.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from lti_app.models import LMS, WimsClass
+from lti_app.tests.utils import StubWimsMixin
+
+
+
+@override_settings(API_PAGE_SIZE=2, API_MAX_AGE=60)
+class APITestCase(StubWimsMixin, TestCase):
+    
+    def setUp(self):
+        super().setUp()
+        self.other = LMS.objects.create(guid="elearning.test.fr", url="https://elearning.test.fr/",
+                                        name="Moodle Test", key="provider2", secret="secret2")
+        self.wims.allowed_lms.add(self.lms)
+        
+        self.classes = []
+        for i in range(3):
+            qclass = self.stub.add_class()
+            self.stub.add_sheet(qclass, title="Sheet%d" % i)
+            self.stub.add_exam(qclass, title="Exam%d" % i)
+            self.classes.append(WimsClass.objects.create(
+                lms=self.lms, lms_guid=str(i), wims=self.wims, qclass=qclass, name="Class%d" % i
+            ))
+        WimsClass.objects.create(lms=self.other, lms_guid="0", wims=self.wims, qclass="999999",
+                                 name="Other")
+    
+    
+    def test_lms(self):
+        response = self.client.get(reverse("lti:api_lms"))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([
+            {
+                "pk":      self.lms.pk,
+                "name":    "Moodle UPEM",
+                "url":     "https://elearning.u-pem.fr/",
+                "api_url": "http://testserver" + reverse("lti:api_wims", args=[self.lms.pk]),
+            },
+            {
+                "pk":      self.other.pk,
+                "name":    "Moodle Test",
+                "url":     "https://elearning.test.fr/",
+                "api_url": "http://testserver" + reverse("lti:api_wims", args=[self.other.pk]),
+            },
+        ], response.json()["results"])
+        self.assertIsNone(response.json()["next"])
+    
+    
+    def test_wims(self):
+        response = self.client.get(reverse("lti:api_wims", args=[self.lms.pk]))
+        results = response.json()["results"]
+        self.assertEqual([self.wims.pk], [w["pk"] for w in results])
+        self.assertEqual("http://testserver" + reverse("lti:wims_class", args=[self.wims.pk]),
+                         results[0]["lti_url"])
+        
+        response = self.client.get(reverse("lti:api_wims", args=[self.other.pk]))
+        self.assertEqual([], response.json()["results"])
+        self.assertEqual(404, self.client.get(reverse("lti:api_wims", args=[9999])).status_code)
+    
+    
+    def test_classes_cursor(self):
+        url = reverse("lti:api_classes", args=[self.lms.pk, self.wims.pk])
+        response = self.client.get(url, {"fields": "pk,name"})
+        self.assertEqual([
+            {"pk": self.classes[0].pk, "name": "Class0"},
+            {"pk": self.classes[1].pk, "name": "Class1"},
+        ], response.json()["results"])
+        
+        response = self.client.get(response.json()["next"])
+        self.assertEqual([{"pk": self.classes[2].pk, "name": "Class2"}],
+                         response.json()["results"])
+        self.assertIsNone(response.json()["next"])
+        
+        response = self.client.get(url, {"limit": 1, "cursor": self.classes[0].pk})
+        self.assertEqual([self.classes[1].pk], [c["pk"] for c in response.json()["results"]])
+    
+    
+    def test_classes_bad_parameters(self):
+        url = reverse("lti:api_classes", args=[self.lms.pk, self.wims.pk])
+        self.assertEqual(400, self.client.get(url, {"fields": "pk,secret"}).status_code)
+        self.assertEqual(400, self.client.get(url, {"cursor": "abc"}).status_code)
+        self.assertEqual(400, self.client.get(url, {"limit": 0}).status_code)
+        self.assertEqual(405, self.client.post(url).status_code)
+        self.assertEqual(404, self.client.get(
+            reverse("lti:api_classes", args=[self.other.pk, self.wims.pk])
+        ).status_code)
+    
+    
+    def test_activities(self):
+        wclass = self.classes[1]
+        url = reverse("lti:api_activities", args=[self.lms.pk, self.wims.pk, wclass.pk])
+        response = self.client.get(url)
+        self.assertEqual({
+            "sheets": [{
+                "id":          "1",
+                "title":       "Sheet1",
+                "description": "",
+                "mode":        "active",
+                "lti_url":     "http://testserver" + reverse("lti:wims_sheet",
+                                                             args=[self.wims.pk, 1]),
+            }],
+            "exams":  [{
+                "id":          "1",
+                "title":       "Exam1",
+                "description": "",
+                "mode":        "active",
+                "lti_url":     "http://testserver" + reverse("lti:wims_exam",
+                                                             args=[self.wims.pk, 1]),
+            }],
+        }, response.json())
+        self.assertIn("Last-Modified", response)
+        
+        self.stub.reset()
+        response = self.client.get(url, {"fields": "id"})
+        self.assertEqual({"sheets": [{"id": "1"}], "exams": [{"id": "1"}]}, response.json())
+        self.assertFalse(self.stub.calls)
+    
+    
+    def test_activities_wims_error(self):
+        wclass = self.classes[0]
+        del self.stub.classes[wclass.qclass]
+        url = reverse("lti:api_activities", args=[self.lms.pk, self.wims.pk, wclass.pk])
+        response = self.client.get(url)
+        self.assertEqual(502, response.status_code)
+        self.assertIn("not existing", response.json()["error"])
+        self.assertTrue(WimsClass.objects.filter(pk=wclass.pk).exists())
+    
+    
+    def test_conditional_get(self):
+        url = reverse("lti:api_classes", args=[self.lms.pk, self.wims.pk])
+        response = self.client.get(url)
+        self.assertIn("max-age=60", response["Cache-Control"])
+        self.assertIn("private", response["Cache-Control"])
+        
+        etag = response["ETag"]
+        self.assertEqual(304, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        
+        self.classes[0].name = "Renamed"
+        self.classes[0].save()
+        self.assertEqual(200, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+#
+#  test_budgets.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+"""Query count and WIMS call count budgets of the launch views.
+
+WIMS is replaced by lti_app.stub.StubWims, every scenario asserting the exact number of
+database queries and of requests sent to WIMS (per job). A report of the measured costs, including
+the duration of each launch, is written on stderr at the end of the run, and as JSON to the path
+given by the environment variable LAUNCH_BUDGET_REPORT if set. Durations depend on the load of the
+machine and are only reported, not asserted."""
+
+import json
+import os
+import sys
+import time
+from collections import Counter
+from datetime import date, timedelta
+from typing import Any, Dict
+
+import oauth2
+import oauthlib.oauth1.rfc5849.signature as oauth_signature
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from lti_app import surge
+from lti_app.models import (ExamSurge, GradeLinkSheet, WimsCapability, WimsClass, WimsExam,
+                            WimsSheet, WimsUser)
+from lti_app.tests.utils import KEY, SECRET, StubWimsMixin, TEST_SERVER
+
+
+# Costs measured during the run, written by tearDownModule().
+REPORT: Dict[str, Dict[str, Any]] = {}
+
+
+
+def tearDownModule():
+    if not REPORT:  # pragma: no cover
+        return
+    lines = ["", "Launch budgets:"]
+    for name, cost in sorted(REPORT.items()):
+        lines.append("  %-40s %3d queries  %3d WIMS calls  %7.1f ms"
+                     % (name, cost["queries"], sum(cost["wims"].values()), cost["ms"]))
+    sys.stderr.write("\n".join(lines) + "\n")
+    
+    path = os.getenv("LAUNCH_BUDGET_REPORT")
+    if path:  # pragma: no cover
+        with open(path, "w") as f:
+            json.dump(REPORT, f, indent=4, sort_keys=True)
+
+
+
+class LaunchBudgetTestCase(StubWimsMixin, TestCase):
+    
+    def setUp(self):
+        super().setUp()
+        WimsCapability.objects.create(
+            wims=self.wims, version="4.21", checked=timezone.now(),
+            jobs="checkclass checkuser getsheetscores getexamscores",
+            score_format=WimsCapability.SCORE_FORMULA,
+        )
+    
+    
+    def add_class(self) -> WimsClass:
+        """Add a class with a sheet and an exam on the stub and in the database."""
+        qclass = self.stub.add_class()
+        self.stub.add_sheet(qclass)
+        self.stub.add_exam(qclass)
+        wclass = WimsClass.objects.create(lms=self.lms, lms_guid="77777", wims=self.wims,
+                                          qclass=qclass, name="A title",
+                                          expiration=date(2099, 12, 31))
+        WimsUser.objects.create(wclass=wclass, quser="supervisor")
+        return wclass
+    
+    
+    def add_student(self, wclass: WimsClass) -> WimsUser:
+        """Add a student to <wclass>, as after its first launch."""
+        self.stub.classes[wclass.qclass]["users"]["jdoe"] = {
+            "lastname": "Doe", "firstname": "John", "password": "password", "email": "",
+        }
+        return WimsUser.objects.create(wclass=wclass, lms_guid="77", quser="jdoe")
+    
+    
+    def params(self, url: str, teacher: bool = False) -> Dict[str, str]:
+        """Returns the signed parameters of an LTI launch to <url>."""
+        params = {
+            'lti_message_type':                   'basic-lti-launch-request',
+            'lti_version':                        'LTI-1p0',
+            'launch_presentation_locale':         'fr-FR',
+            'resource_link_id':                   'X',
+            'context_id':                         '77777',
+            'context_title':                      "A title",
+            'user_id':                            '77',
+            'lis_person_contact_email_primary':   'test@email.com',
+            'lis_person_name_family':             'Doe',
+            'lis_person_name_given':              'John',
+            'lis_result_sourcedid':               "14821455",
+            'lis_outcome_service_url':            "http://www.outcom.com",
+            'tool_consumer_instance_description': 'UPEM',
+            'tool_consumer_instance_guid':        "elearning.upem.fr",
+            'oauth_consumer_key':                 KEY,
+            'oauth_signature_method':             'HMAC-SHA1',
+            'oauth_timestamp':                    str(oauth2.generate_timestamp()),
+            'oauth_nonce':                        oauth2.generate_nonce(),
+            'roles':                              (
+                settings.ROLES_ALLOWED_CREATE_WIMS_CLASS[0].value if teacher else "Learner"
+            ),
+        }
+        norm_params = oauth_signature.normalize_parameters([(k, v) for k, v in params.items()])
+        uri = oauth_signature.base_string_uri(TEST_SERVER + url)
+        base_string = oauth_signature.signature_base_string("POST", uri, norm_params)
+        params['oauth_signature'] = oauth_signature.sign_hmac_sha1(base_string, SECRET, None)
+        return params
+    
+    
+    def assertBudget(self, name: str, queries: int, wims: Dict[str, int], url: str,
+                     data: Dict[str, str] = None, status: int = 302) -> None:
+        """Request <url> (POSTing <data>, GET if None) and check that it used exactly <queries>
+        database queries and the WIMS jobs in <wims>."""
+        self.stub.reset()
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            if data is None:
+                response = self.client.get(url, secure=True)
+            else:
+                response = self.client.post(url, data, secure=True)
+            elapsed = time.perf_counter() - start
+        
+        REPORT[name] = {
+            "queries": len(captured), "wims": dict(self.stub.calls), "ms": elapsed * 1000,
+        }
+        self.assertEqual(status, response.status_code, response.content)
+        self.assertEqual(
+            queries, len(captured),
+            "%d queries executed, %d expected:\n%s" % (
+                len(captured), queries,
+                "\n".join("%d. %s" % (i, q['sql']) for i, q in enumerate(captured, 1))
+            )
+        )
+        self.assertEqual(Counter(wims), self.stub.calls)
+    
+    
+    def test_class_new_class(self):
+        url = reverse("lti:wims_class", args=[self.wims.pk])
+        self.assertBudget("wims_class: new class", 9, {
+            "checkident": 1, "addclass": 1, "checkuser": 1, "authuser": 1,
+        }, url, self.params(url, teacher=True))
+        self.assertEqual(1, WimsClass.objects.count())
+    
+    
+    def test_class_new_user(self):
+        self.add_class()
+        url = reverse("lti:wims_class", args=[self.wims.pk])
+        self.assertBudget("wims_class: new user", 7, {
+            "checkident": 1, "getclass": 2, "getuser": 2, "adduser": 1, "authuser": 1,
+        }, url, self.params(url))
+        self.assertEqual(2, WimsUser.objects.count())
+    
+    
+    def test_class_returning_student(self):
+        self.add_student(self.add_class())
+        url = reverse("lti:wims_class", args=[self.wims.pk])
+        self.assertBudget("wims_class: returning student", 8, {
+            "checkident": 1, "getclass": 2, "getuser": 2, "checkuser": 1, "authuser": 1,
+        }, url, self.params(url))
+    
+    
+    def test_class_teacher(self):
+        self.add_class()
+        url = reverse("lti:wims_class", args=[self.wims.pk])
+        self.assertBudget("wims_class: teacher", 8, {
+            "checkident": 1, "getclass": 2, "getuser": 2, "checkuser": 1, "authuser": 1,
+        }, url, self.params(url, teacher=True))
+    
+    
+    def test_sheet_new_user(self):
+        self.add_class()
+        url = reverse("lti:wims_sheet", args=[self.wims.pk, 1])
+        self.assertBudget("wims_sheet: new user", 22, {
+            "checkident": 1, "getclass": 2, "getuser": 2, "adduser": 1, "getsheet": 1,
+            "authuser": 1,
+        }, url, self.params(url))
+        self.assertEqual(1, GradeLinkSheet.objects.count())
+    
+    
+    def test_sheet_returning_student(self):
+        self.add_student(self.add_class())
+        url = reverse("lti:wims_sheet", args=[self.wims.pk, 1])
+        self.client.post(url, self.params(url), secure=True)
+        cache.clear()
+        self.assertBudget("wims_sheet: returning student", 11, {
+            "checkident": 1, "getclass": 2, "getuser": 2, "checkuser": 1, "getsheet": 1,
+            "authuser": 1,
+        }, url, self.params(url))
+        self.assertEqual(1, WimsSheet.objects.count())
+    
+    
+    def test_sheet_teacher(self):
+        self.add_student(self.add_class())
+        url = reverse("lti:wims_sheet", args=[self.wims.pk, 1])
+        self.client.post(url, self.params(url, teacher=True), secure=True)
+        cache.clear()
+        self.assertBudget("wims_sheet: teacher", 15, {
+            "checkident": 1, "getclass": 2, "getuser": 2, "checkuser": 1, "getsheet": 1,
+            "getsheetscores": 1, "authuser": 1,
+        }, url, self.params(url, teacher=True))
+    
+    
+    @override_settings(LAUNCH_SLOW_THRESHOLD=0)
+    def test_sheet_server_timing(self):
+        self.add_student(self.add_class())
+        url = reverse("lti:wims_sheet", args=[self.wims.pk, 1])
+        with self.assertLogs("lti_app.metrics", "WARNING") as logs:
+            response = self.client.post(url, self.params(url, teacher=True), secure=True)
+        
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(
+            ["oauth", "lookup", "checkident", "class", "user", "getitem", "grade_link",
+             "send_back_all", "authuser", "total"],
+            [t.split(";")[0] for t in response["Server-Timing"].split(", ")]
+        )
+        entry = json.loads(logs.output[0].split("Slow launch: ", 1)[1])
+        self.assertEqual("wims_sheet", entry["view"])
+        self.assertEqual(302, entry["status"])
+        self.assertIn("authuser", entry["stages"])
+    
+    
+    def test_exam_returning_student(self):
+        self.add_student(self.add_class())
+        url = reverse("lti:wims_exam", args=[self.wims.pk, 1])
+        self.client.post(url, self.params(url), secure=True)
+        cache.clear()
+        self.assertBudget("wims_exam: returning student", 11, {
+            "checkident": 1, "getclass": 2, "getuser": 2, "checkuser": 1, "getexam": 1,
+            "authuser": 1,
+        }, url, self.params(url))
+        self.assertEqual(1, WimsExam.objects.count())
+    
+    
+    def test_exam_teacher(self):
+        self.add_student(self.add_class())
+        url = reverse("lti:wims_exam", args=[self.wims.pk, 1])
+        self.client.post(url, self.params(url, teacher=True), secure=True)
+        cache.clear()
+        self.assertBudget("wims_exam: teacher", 14, {
+            "checkident": 1, "getclass": 2, "getuser": 2, "checkuser": 1, "getexam": 1,
+            "getexamscores": 1, "authuser": 1,
+        }, url, self.params(url, teacher=True))
+    
+    
+    def test_exam_surge(self):
+        wclass = self.add_class()
+        self.add_student(wclass)
+        url = reverse("lti:wims_exam", args=[self.wims.pk, 1])
+        self.client.post(url, self.params(url), secure=True)
+        cache.clear()
+        now = timezone.now()
+        surge.warm_up(ExamSurge.objects.create(exam=WimsExam.objects.get(), start=now,
+                                               end=now + timedelta(minutes=30)))
+        self.assertBudget("wims_exam: surge", 10, {
+            "authuser": 1,
+        }, url, self.params(url))
+    
+    
+    def test_activities(self):
+        wclass = self.add_class()
+        url = reverse("lti:sheets", args=[self.lms.pk, self.wims.pk, wclass.pk])
+        self.assertBudget("activities", 1, {
+            "listsheets": 1, "getsheet": 1, "listexams": 1, "getexam": 1,
+        }, url, status=200)
+    
+    
+    def test_activities_cached(self):
+        wclass = self.add_class()
+        url = reverse("lti:sheets", args=[self.lms.pk, self.wims.pk, wclass.pk])
+        self.client.get(url, secure=True)
+        self.assertBudget("activities: cached", 1, {}, url, status=200)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+#  test_capabilities.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+from unittest import mock
+
+import requests
+from django.conf import settings
+from django.test import TestCase
+from django.utils import timezone
+
+from lti_app import capabilities, tasks
+from lti_app.models import WIMS, WimsCapability
+from lti_app.stub import StubWims
+
+
+
+class CapabilitiesTestCase(TestCase):
+    
+    def setUp(self):
+        self.wims = WIMS.objects.create(url="https://wims.upem.fr", name="One", ident="myself",
+                                        passwd="toto", rclass="myclass")
+    
+    
+    def test_parse_version(self):
+        self.assertEqual((4, 18), capabilities.parse_version("4.18"))
+        self.assertEqual((4, 9), capabilities.parse_version("WIMS 4.09a"))
+        self.assertEqual(None, capabilities.parse_version("unknown"))
+    
+    
+    @mock.patch("lti_app.capabilities.probe_job", lambda wims, job: job != "listclasses")
+    @mock.patch("wimsapi.WimsAPI.getinfoserver")
+    def test_probe(self, getinfoserver):
+        getinfoserver.return_value = (True, {"status": "OK", "wims_version": "4.21"})
+        capability = capabilities.probe(self.wims)
+        self.assertEqual("4.21", capability.version)
+        self.assertEqual(WimsCapability.SCORE_FORMULA, capability.score_format)
+        self.assertTrue(capability.supports("checkuser"))
+        self.assertFalse(capability.supports("listclasses"))
+        self.assertFalse(capability.bulk_listing)
+        wims = WIMS.objects.get(pk=self.wims.pk)
+        self.assertEqual(capability, capabilities.get_capability(wims))
+    
+    
+    @mock.patch("lti_app.capabilities.probe_job", lambda wims, job: True)
+    @mock.patch("wimsapi.WimsAPI.getinfoserver")
+    def test_probe_old_version(self, getinfoserver):
+        getinfoserver.return_value = (True, {"status": "OK", "version": "4.17"})
+        capability = capabilities.probe(self.wims)
+        self.assertEqual(WimsCapability.SCORE_BEST, capability.score_format)
+        self.assertTrue(capability.bulk_listing)
+    
+    
+    def test_probe_stub(self):
+        stub = StubWims()
+        with mock.patch("wimsapi.api.post", stub):
+            self.assertTrue(capabilities.probe_job(self.wims, "checkclass"))
+            self.assertFalse(capabilities.probe_job(self.wims, "nosuchjob"))
+            self.assertEqual(2, sum(stub.calls.values()))
+            
+            capability = capabilities.probe(self.wims)
+        self.assertTrue(capability.known)
+        self.assertEqual(capabilities.PROBED_JOBS, capability.jobs.split())
+        self.assertEqual(3 + len(capabilities.PROBED_JOBS), sum(stub.calls.values()))
+    
+    
+    @mock.patch("wimsapi.WimsAPI.getinfoserver", side_effect=requests.ConnectionError)
+    def test_get_capability_unreachable(self, getinfoserver):
+        capability = capabilities.get_capability(self.wims)
+        self.assertFalse(capability.known)
+        self.assertIsNotNone(capability.failed)
+        self.assertEqual(WimsCapability.SCORE_AUTO, capability.score_format)
+        
+        # The failure is saved, the server is not probed again
+        wims = WIMS.objects.get(pk=self.wims.pk)
+        self.assertEqual(capability, capabilities.get_capability(wims))
+        getinfoserver.assert_called_once()
+    
+    
+    def test_compute_grade(self):
+        self.assertEqual(4, capabilities.compute_grade("I*Q", "0", 5, 80, 50, 0))
+        self.assertEqual(5, capabilities.compute_grade("I", "1", 5, 80, 50, 0))
+        self.assertEqual(2.5, capabilities.compute_grade("I^2", "2", 5, 80, 50, 50))
+        self.assertEqual(8, capabilities.compute_grade("max(I,Q)", "0", 5, 80, 50, 0))
+        with self.assertRaises(NameError):
+            capabilities.compute_grade("__import__('os')", "0", 5, 80, 50, 0)
+    
+    
+    def test_sheet_score(self):
+        response = {"sheet_formula": {"formula": "I*Q", "I": "0"}}
+        data = {"user_quality": 5, "user_percent": 80, "user_best": 50, "user_level": 0}
+        formula = WimsCapability(wims=self.wims, score_format=WimsCapability.SCORE_FORMULA)
+        best = WimsCapability(wims=self.wims, score_format=WimsCapability.SCORE_BEST)
+        self.assertAlmostEqual(0.4, capabilities.sheet_score(formula, response, data))
+        self.assertAlmostEqual(0.5, capabilities.sheet_score(best, response, data))
+        self.assertAlmostEqual(0.5, capabilities.sheet_score(formula, {}, data))
+    
+    
+    @mock.patch("lti_app.tasks.probe")
+    def test_refresh_capabilities(self, probe):
+        self.assertEqual(1, tasks.refresh_capabilities())
+        probe.assert_called_once_with(self.wims)
+    
+    
+    @mock.patch("lti_app.tasks.probe")
+    def test_refresh_capabilities_retry(self, probe):
+        capability = WimsCapability.objects.create(wims=self.wims, failed=timezone.now())
+        self.assertEqual(0, tasks.refresh_capabilities())
+        probe.assert_not_called()
+        
+        capability.failed = timezone.now() - settings.WIMS_CAPABILITIES_RETRY
+        capability.save()
+        self.assertEqual(1, tasks.refresh_capabilities())
+        probe.assert_called_once()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+#  test_cassettes.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+import json
+import os
+import tempfile
+from unittest import mock
+
+import requests
+import wimsapi
+from django.test import SimpleTestCase
+
+from lti_app.stub import StubWims, StubWimsServer
+from lti_app.tests import cassettes
+from lti_app.tests.cassettes import Cassette, CassetteError, drift, replaying
+
+
+
+class CassetteTestCase(SimpleTestCase):
+    
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = mock.patch.object(cassettes, "DIRECTORY", self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        
+        self.stub = StubWims()
+        self.qclass = self.stub.add_class()
+    
+    
+    def scenario(self, url: str) -> None:
+        api = wimsapi.WimsAPI(url, "myself", "toto")
+        self.assertTrue(api.checkident()[0])
+        self.assertEqual("A title", wimsapi.Class.get(url, "myself", "toto", self.qclass,
+                                                      "myclass").name)
+        self.assertFalse(api.checkclass(9999, "myclass")[0])
+        self.stub.inject("unreachable")
+        with self.assertRaises(requests.ConnectionError):
+            api.checkident()
+    
+    
+    def test_record_and_replay(self):
+        with StubWimsServer(self.stub) as server:
+            with Cassette("test", mode="once") as cassette:
+                self.assertTrue(cassette.recording)
+                self.assertFalse(replaying())
+                self.scenario(server.url)
+        calls = sum(self.stub.calls.values())
+        
+        with open(os.path.join(self.directory, "test.json")) as f:
+            interactions = json.load(f)
+        self.assertEqual(calls, len(interactions))
+        self.assertNotIn("passwd", interactions[0]["request"])
+        
+        # The server is stopped, every call is replayed
+        with Cassette("test", mode="replay") as cassette:
+            self.assertTrue(replaying())
+            self.scenario(server.url)
+        self.assertFalse(replaying())
+        self.assertEqual(calls, sum(self.stub.calls.values()))
+        
+        with Cassette("test", mode="once"):
+            with self.assertRaises(CassetteError):
+                wimsapi.WimsAPI(server.url, "myself", "toto").checkclass(1234, "myclass")
+    
+    
+    def test_no_call(self):
+        with Cassette("empty", mode="record"):
+            pass
+        self.assertFalse(os.listdir(self.directory))
+        
+        with Cassette("empty", mode="replay"):
+            with self.assertRaises(CassetteError):
+                wimsapi.WimsAPI("http://stub.wims/wims.cgi", "myself", "toto").checkident()
+    
+    
+    def test_off(self):
+        with mock.patch("wimsapi.api.post", self.stub):
+            with Cassette("off", mode="off"):
+                self.assertTrue(wimsapi.WimsAPI("http://stub.wims/wims.cgi", "myself",
+                                                "toto").checkident()[0])
+        self.assertFalse(os.listdir(self.directory))
+    
+    
+    def test_drift(self):
+        old, new = os.path.join(self.directory, "old"), os.path.join(self.directory, "new")
+        os.makedirs(old)
+        os.makedirs(new)
+        ok = {"status_code": 200, "text": json.dumps({"status": "OK", "code": "A", "x": 1})}
+        error = {"status_code": 200, "text": json.dumps({"status": "ERROR", "message": "m"})}
+        for directory, response, name in ((old, ok, "a"), (new, error, "a"), (old, ok, "b"),
+                                          (new, dict(ok, text=ok["text"].replace("A", "B")), "b"),
+                                          (new, ok, "c")):
+            with open(os.path.join(directory, name + ".json"), "w") as f:
+                json.dump([{"request": {"job": "checkident"}, "response": response}], f)
+        
+        differences = drift(old, new)
+        self.assertEqual(2, len(differences))
+        self.assertTrue(differences[0].startswith("a.json: call 1 differs"))
+        self.assertEqual("c.json: new cassette", differences[1])
+    
+    
+    def test_failure_not_recorded(self):
+        with StubWimsServer(self.stub) as server:
+            with self.assertRaises(ValueError):
+                with Cassette("failed", mode="record"):
+                    wimsapi.WimsAPI(server.url, "myself", "toto").checkident()
+                    raise ValueError
+        self.assertFalse(os.listdir(self.directory))
+    
+    
+    def test_server_unreachable_not_recorded(self):
+        with StubWimsServer(self.stub) as server:
+            self.stub.inject("unreachable")
+            with mock.patch.object(cassettes, "WIMS_URL", server.url):
+                with self.assertRaisesMessage(CassetteError, "could not be joined"):
+                    with Cassette("unreachable", mode="record"):
+                        wimsapi.WimsAPI(server.url, "myself", "toto").checkident()
+        self.assertFalse(os.listdir(self.directory))
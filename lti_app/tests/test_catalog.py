@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+#  test_catalog.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+from unittest import mock
+
+import requests
+import wimsapi
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from lti_app import catalog
+from lti_app.models import WimsClass
+from lti_app.tests.utils import StubWimsMixin
+
+
+
+@override_settings(CATALOG_STALE_AFTER=60)
+class CatalogTestCase(StubWimsMixin, TestCase):
+    
+    def setUp(self):
+        super().setUp()
+        self.qclass = self.stub.add_class()
+        self.stub.add_sheet(self.qclass, title="Sheet1")
+        self.stub.add_sheet(self.qclass, sheetmode=2, title="Sheet2")
+        self.stub.add_exam(self.qclass, title="Exam1")
+        self.wclass = WimsClass.objects.create(lms=self.lms, lms_guid="77777", wims=self.wims,
+                                               qclass=self.qclass, name="A title")
+    
+    
+    def test_fetch(self):
+        c = catalog.fetch(self.wims, self.qclass)
+        
+        self.assertEqual([
+            {
+                "qsheet":      "1",
+                "title":       "Sheet1",
+                "description": "",
+                "sheetmode":   "active",
+                "url":         reverse("lti:wims_sheet", args=[self.wims.pk, "1"]),
+            },
+            {
+                "qsheet":      "2",
+                "title":       "Sheet2",
+                "description": "",
+                "sheetmode":   "expired",
+                "url":         reverse("lti:wims_sheet", args=[self.wims.pk, "2"]),
+            },
+        ], c["sheets"])
+        self.assertEqual([
+            {
+                "qexam":       "1",
+                "title":       "Exam1",
+                "description": "",
+                "exammode":    "active",
+                "url":         reverse("lti:wims_exam", args=[self.wims.pk, "1"]),
+            },
+        ], c["exams"])
+        self.assertEqual({"listsheets": 1, "getsheet": 2, "listexams": 1, "getexam": 1},
+                         self.stub.calls)
+    
+    
+    def test_fetch_class_not_existing(self):
+        with self.assertRaisesRegex(wimsapi.AdmRawError, "not existing"):
+            catalog.fetch(self.wims, "999999")
+    
+    
+    def test_get_cached(self):
+        c = catalog.get(self.wims, self.qclass)
+        self.stub.reset()
+        
+        with mock.patch.object(catalog.EXECUTOR, "submit") as submit:
+            self.assertEqual(c, catalog.get(self.wims, self.qclass))
+        submit.assert_not_called()
+        self.assertFalse(self.stub.calls)
+    
+    
+    def test_get_stale(self):
+        c = catalog.get(self.wims, self.qclass)
+        self.stub.add_exam(self.qclass, title="Exam2")
+        
+        with mock.patch("time.time", return_value=c["fetched"] + 61), \
+                mock.patch.object(catalog.EXECUTOR, "submit") as submit:
+            self.assertEqual(c, catalog.get(self.wims, self.qclass))
+            self.assertEqual(c, catalog.get(self.wims, self.qclass))
+        submit.assert_called_once_with(catalog.refresh, self.wims, self.qclass)
+        
+        catalog.refresh(self.wims, self.qclass)
+        self.assertEqual(2, len(catalog.get(self.wims, self.qclass)["exams"]))
+    
+    
+    def test_refresh_error(self):
+        catalog.get(self.wims, self.qclass)
+        
+        del self.stub.classes[self.qclass]
+        catalog.refresh(self.wims, self.qclass)
+        self.assertIsNone(cache.get(catalog._key(self.wims.pk, self.qclass)))
+    
+    
+    def test_refresh_unreachable(self):
+        c = catalog.get(self.wims, self.qclass)
+        
+        with mock.patch("wimsapi.api.post", side_effect=requests.ConnectionError):
+            catalog.refresh(self.wims, self.qclass)
+        self.assertEqual(c, catalog.get(self.wims, self.qclass))
+    
+    
+    def test_activities_view(self):
+        url = reverse("lti:sheets", args=[self.lms.pk, self.wims.pk, self.wclass.pk])
+        response = self.client.get(url)
+        self.assertContains(response, "Sheet1")
+        self.assertContains(response, "Exam1")
+        self.assertContains(response, "http://testserver"
+                            + reverse("lti:wims_exam", args=[self.wims.pk, "1"]))
+        
+        self.stub.reset()
+        self.assertContains(self.client.get(url), "Sheet2")
+        self.assertFalse(self.stub.calls)
+    
+    
+    def test_activities_view_class_not_existing(self):
+        del self.stub.classes[self.qclass]
+        url = reverse("lti:sheets", args=[self.lms.pk, self.wims.pk, self.wclass.pk])
+        response = self.client.get(url)
+        self.assertRedirects(response, reverse("lti:classes", args=[self.lms.pk, self.wims.pk]),
+                             fetch_redirect_response=False)
+        self.assertFalse(WimsClass.objects.filter(pk=self.wclass.pk).exists())
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#
+#  test_content_items.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+import json
+from typing import Dict
+
+import oauth2
+import oauthlib.oauth1.rfc5849.signature as oauth_signature
+from django.conf import settings
+from django.test import TestCase
+from django.urls import reverse
+
+from lti_app import content_items
+from lti_app.models import WimsClass
+from lti_app.tests.utils import KEY, SECRET, StubWimsMixin, TEST_SERVER
+
+
+RETURN_URL = "https://elearning.u-pem.fr/mod/lti/contentitem_return.php"
+
+
+
+class ContentItemsTestCase(StubWimsMixin, TestCase):
+    
+    def setUp(self):
+        super().setUp()
+        qclass = self.stub.add_class()
+        self.stub.add_sheet(qclass, title="Sheet", description="A sheet")
+        self.stub.add_exam(qclass, title="Exam", description="An exam")
+        self.wclass = WimsClass.objects.create(lms=self.lms, lms_guid="77777", wims=self.wims,
+                                               qclass=qclass, name="A title")
+        self.url = reverse("lti:wims_class", args=[self.wims.pk])
+    
+    
+    def params(self, teacher: bool = True, **kwargs: str) -> Dict[str, str]:
+        """Returns the signed parameters of a Content-Item selection request, updated with
+        <kwargs>."""
+        params = {
+            'lti_message_type':                     'ContentItemSelectionRequest',
+            'lti_version':                          'LTI-1p0',
+            'launch_presentation_locale':           'fr-FR',
+            'context_id':                           '77777',
+            'context_title':                        "A title",
+            'user_id':                              '77',
+            'lis_person_contact_email_primary':     'test@email.com',
+            'lis_person_name_family':               'Doe',
+            'lis_person_name_given':                'John',
+            'tool_consumer_instance_description':   'UPEM',
+            'tool_consumer_instance_guid':          "elearning.upem.fr",
+            'content_item_return_url':              RETURN_URL,
+            'accept_media_types':                   content_items.LTI_LINK,
+            'accept_presentation_document_targets': 'iframe,window',
+            'accept_multiple':                      'true',
+            'data':                                 'opaque',
+            'oauth_consumer_key':                   KEY,
+            'oauth_signature_method':               'HMAC-SHA1',
+            'oauth_timestamp':                      str(oauth2.generate_timestamp()),
+            'oauth_nonce':                          oauth2.generate_nonce(),
+            'roles':                                (
+                settings.ROLES_ALLOWED_CREATE_WIMS_CLASS[0].value if teacher else "Learner"
+            ),
+        }
+        params.update(kwargs)
+        norm_params = oauth_signature.normalize_parameters([(k, v) for k, v in params.items()])
+        uri = oauth_signature.base_string_uri(TEST_SERVER + self.url)
+        base_string = oauth_signature.signature_base_string("POST", uri, norm_params)
+        params['oauth_signature'] = oauth_signature.sign_hmac_sha1(base_string, SECRET, None)
+        return params
+    
+    
+    def test_selection_page(self):
+        response = self.client.post(self.url, self.params(), secure=True)
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertContains(response, 'value="sheet:1"')
+        self.assertContains(response, 'value="exam:1"')
+        self.assertContains(response, 'type="checkbox"')
+        self.assertNotIn("X-Frame-Options", response)
+        self.assertEqual(1, self.stub.calls["listsheets"])
+        
+        self.stub.reset()
+        response = self.client.post(self.url, self.params(accept_multiple="false"), secure=True)
+        self.assertContains(response, 'type="radio"')
+        self.assertFalse(self.stub.calls)
+    
+    
+    def test_selection_page_new_class(self):
+        response = self.client.post(self.url, self.params(context_id="88888"), secure=True)
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual(2, WimsClass.objects.count())
+        self.assertEqual(1, self.stub.calls["addclass"])
+    
+    
+    def test_selection_refused(self):
+        response = self.client.post(self.url, self.params(teacher=False), secure=True)
+        self.assertEqual(403, response.status_code)
+        
+        response = self.client.post(self.url, self.params(accept_media_types="image/*"),
+                                    secure=True)
+        self.assertEqual(400, response.status_code)
+        
+        params = self.params()
+        del params["content_item_return_url"]
+        self.assertEqual(400, self.client.post(self.url, params, secure=True).status_code)
+    
+    
+    def test_selection_returned(self):
+        response = self.client.post(self.url, self.params(), secure=True)
+        token = response.context["token"]
+        
+        response = self.client.post(reverse("lti:content_items", args=[self.wims.pk]), {
+            "token": token, "items": ["sheet:1", "exam:1", "sheet:9"],
+        })
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual(RETURN_URL, response.context["url"])
+        
+        params = response.context["params"]
+        self.assertEqual("ContentItemSelection", params["lti_message_type"])
+        self.assertEqual("opaque", params["data"])
+        self.assertEqual(KEY, params["oauth_consumer_key"])
+        self.assertIn("oauth_signature", params)
+        
+        graph = json.loads(params["content_items"])["@graph"]
+        self.assertEqual([
+            "http://testserver" + reverse("lti:wims_sheet", args=[self.wims.pk, 1]),
+            "http://testserver" + reverse("lti:wims_exam", args=[self.wims.pk, 1]),
+        ], [item["url"] for item in graph])
+        self.assertEqual(["A sheet", "An exam"], [item["text"] for item in graph])
+        self.assertEqual("window", graph[0]["placementAdvice"]["presentationDocumentTarget"])
+    
+    
+    def test_selection_returned_single(self):
+        response = self.client.post(self.url, self.params(accept_multiple="false"), secure=True)
+        response = self.client.post(reverse("lti:content_items", args=[self.wims.pk]), {
+            "token": response.context["token"], "items": ["sheet:1", "exam:1"],
+        })
+        graph = json.loads(response.context["params"]["content_items"])["@graph"]
+        self.assertEqual(1, len(graph))
+    
+    
+    def test_selection_invalid_token(self):
+        url = reverse("lti:content_items", args=[self.wims.pk])
+        self.assertEqual(400, self.client.post(url, {"token": "invalid"}).status_code)
+        self.assertEqual(405, self.client.get(url).status_code)
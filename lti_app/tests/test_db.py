@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+#  test_db.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from lti_app import db
+from lti_app.models import LMS, WIMS
+
+
+
+class ConfigureSqliteTestCase(TestCase):
+    
+    def test_configure_sqlite(self):
+        with override_settings(SQLITE_PRAGMAS={"busy_timeout": 1234, "cache_size": -4000}):
+            db.configure_sqlite(None, connection)
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(1234, cursor.fetchone()[0])
+            cursor.execute("PRAGMA cache_size")
+            self.assertEqual(-4000, cursor.fetchone()[0])
+    
+    
+    def test_configure_other_vendor(self):
+        other = mock.Mock(vendor="postgresql")
+        db.configure_sqlite(None, other)
+        other.cursor.assert_not_called()
+
+
+
+class CheckConnectionsTestCase(TestCase):
+    
+    @mock.patch("django.db.backends.sqlite3.base.DatabaseWrapper.close")
+    @mock.patch("django.db.backends.sqlite3.base.DatabaseWrapper.is_usable", return_value=False)
+    def test_check_connections_unusable(self, is_usable, close):
+        connection.ensure_connection()
+        db.check_connections()
+        close.assert_called()
+    
+    
+    @mock.patch("django.db.backends.sqlite3.base.DatabaseWrapper.close")
+    def test_check_connections_usable(self, close):
+        connection.ensure_connection()
+        db.check_connections()
+        close.assert_not_called()
+    
+    
+    @override_settings(DATABASE_HEALTH_CHECKS=False)
+    @mock.patch("django.db.backends.sqlite3.base.DatabaseWrapper.is_usable")
+    def test_check_connections_disabled(self, is_usable):
+        db.check_connections()
+        is_usable.assert_not_called()
+
+
+
+class BenchmarkDbTestCase(TransactionTestCase):
+    
+    def test_benchmark_db(self):
+        out = StringIO()
+        call_command("benchmark_db", launches=20, concurrency=2, classes=3, stdout=out)
+        # Errors (e.g. 'database table is locked') are listed under their profile, indented
+        profiles = [line for line in out.getvalue().splitlines() if not line.startswith(" ")]
+        self.assertTrue(profiles[0].startswith("configured"))
+        self.assertTrue(profiles[1].startswith("no persistent connections"))
+        self.assertEqual(0, LMS.objects.count())
+        self.assertEqual(0, WIMS.objects.count())
+
+
+
+class EstimatedCountTestCase(TestCase):
+    
+    def test_estimated_count(self):
+        self.assertIsNone(db.estimated_count(LMS))
+        lms = [
+            LMS.objects.create(guid=str(i), url="https://lms%d.fr/" % i, name=str(i),
+                               key="provider%d" % i, secret="secret")
+            for i in range(3)
+        ]
+        self.assertEqual(lms[-1].pk, db.estimated_count(LMS))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+#  test_export.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+import csv
+import json
+import os
+import tempfile
+from datetime import date
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from lti_app import export
+from lti_app.models import (GradeLinkExam, GradeLinkSheet, LMS, OutcomeService, WIMS, WimsClass,
+                            WimsExam, WimsSheet, WimsUser)
+
+
+
+class ExportTestCase(TestCase):
+    
+    def setUp(self):
+        self.lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                      name="Moodle UPEM", key="provider1", secret="secret1")
+        self.wims = WIMS.objects.create(url="https://wims.upem.fr", name="WIMS UPEM",
+                                        ident="myself", passwd="toto", rclass="myclass")
+        self.wclass = WimsClass.objects.create(lms=self.lms, lms_guid="77777", wims=self.wims,
+                                               qclass="1", name="test1",
+                                               expiration=date(2021, 6, 1))
+        sheet = WimsSheet.objects.create(wclass=self.wclass, lms_guid="1", qsheet="1")
+        exam = WimsExam.objects.create(wclass=self.wclass, lms_guid="1", qexam="1")
+        service = OutcomeService.get(self.lms, "https://elearning.u-pem.fr/outcome")
+        for i in range(3):
+            user = WimsUser.objects.create(wclass=self.wclass, lms_guid=str(i), quser="user%d" % i)
+            GradeLinkSheet.objects.create(user=user, activity=sheet, sourcedid=str(i),
+                                          service=service)
+            GradeLinkExam.objects.create(user=user, activity=exam, sourcedid=str(i),
+                                         service=service)
+    
+    
+    def test_every_table_exported(self):
+        for name in export.EXPORTS:
+            for fmt in export.FORMATS:
+                self.assertTrue(list(export.lines(export.queryset(name), fmt)))
+    
+    
+    @override_settings(SCHEDULED_JOBS_CHUNK_SIZE=1)
+    def test_csv(self):
+        lines = list(export.lines(WimsUser.objects.all(), "csv"))
+        rows = list(csv.reader(lines))
+        self.assertEqual(export.EXPORTS["users"][1], rows[0])
+        self.assertEqual(["Moodle UPEM", "WIMS UPEM", "1", "0", "user0"], rows[1][1:])
+        self.assertEqual(4, len(rows))
+    
+    
+    def test_ndjson(self):
+        docs = [json.loads(line) for line in export.lines(WimsClass.objects.all(), "ndjson")]
+        self.assertEqual(1, len(docs))
+        self.assertEqual("Moodle UPEM", docs[0]["lms__name"])
+        self.assertEqual("https://wims.upem.fr", docs[0]["wims__url"])
+        self.assertEqual("2021-06-01", docs[0]["expiration"])
+    
+    
+    def test_grade_links(self):
+        docs = [
+            json.loads(line)
+            for line in export.lines(GradeLinkExam.objects.filter(user__quser="user2"), "ndjson")
+        ]
+        self.assertEqual(1, len(docs))
+        self.assertEqual("2", docs[0]["sourcedid"])
+        self.assertEqual("https://elearning.u-pem.fr/outcome", docs[0]["service__url"])
+    
+    
+    def test_command_stdout(self):
+        out = StringIO()
+        call_command("export", "grade_links_sheet", "--format", "ndjson", stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertEqual("user0", json.loads(lines[0])["user__quser"])
+    
+    
+    def test_command_output(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "users.csv")
+            call_command("export", "users", "--output", path)
+            with open(path, newline="") as f:
+                self.assertEqual(4, len(list(csv.reader(f))))
+    
+    
+    def test_admin_action(self):
+        self.client.force_login(
+            User.objects.create_superuser("admin", "admin@upem.fr", "password")
+        )
+        selected = WimsUser.objects.filter(quser__in=["user0", "user2"])
+        response = self.client.post(reverse("admin:lti_app_wimsuser_changelist"), {
+            "action":           "export_ndjson",
+            "_selected_action": [str(u.pk) for u in selected],
+        })
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.streaming)
+        self.assertEqual("application/x-ndjson", response["Content-Type"])
+        self.assertIn('filename="users-', response["Content-Disposition"])
+        docs = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual(["user0", "user2"], [d["quser"] for d in docs])
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+#  test_load.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+import json
+import os
+import random
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TransactionTestCase
+
+from lti_app.management.commands.load_test import percentile, schedule
+from lti_app.models import LMS, WIMS
+
+
+
+class ScheduleTestCase(SimpleTestCase):
+    
+    def test_class(self):
+        arrivals = schedule("class", 2, 5, 3, 0, 0, random.Random(0))
+        self.assertEqual(12, len(arrivals))
+        self.assertEqual([None, None], [a.student for a in arrivals[:2]])
+        self.assertEqual({"wims_sheet", "wims_class"}, {a.view for a in arrivals})
+        self.assertTrue(all(0 <= a.offset <= 3 for a in arrivals))
+        self.assertEqual(sorted(a.offset for a in arrivals), [a.offset for a in arrivals])
+    
+    
+    def test_exam(self):
+        arrivals = schedule("exam", 2, 5, 3, 0, 0, random.Random(0))
+        self.assertEqual({"wims_exam"}, {a.view for a in arrivals})
+    
+    
+    def test_trickle(self):
+        arrivals = schedule("trickle", 2, 5, 0, 100, 10, random.Random(0))
+        self.assertTrue(800 < len(arrivals) < 1200, len(arrivals))
+        self.assertTrue(all(0 <= a.offset < 100 for a in arrivals))
+        self.assertEqual({"wims_class", "wims_sheet", "wims_exam"}, {a.view for a in arrivals})
+    
+    
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(99, percentile(values, 99))
+        self.assertEqual(1, percentile(values[:1], 99))
+        self.assertEqual(0, percentile([], 50))
+
+
+
+class LoadTestTestCase(TransactionTestCase):
+    
+    def test_load_test(self):
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "report.json")
+            call_command("load_test", classes=1, students=3, ramp=0, concurrency=1, latency=0,
+                         returning=0.5, json=path, interactive=False, stdout=out)
+            with open(path) as f:
+                report = json.load(f)
+        
+        total = report["views"]["total"]
+        self.assertEqual(4, total["launches"])
+        self.assertEqual(0, total["errors"], total["statuses"])
+        self.assertGreater(total["queries"], 0)
+        self.assertGreater(report["wims_calls"], 0)
+        self.assertTrue(out.getvalue().startswith("view"))
+        self.assertEqual(0, LMS.objects.count())
+        self.assertEqual(0, WIMS.objects.count())
+    
+    
+    def test_load_test_cancelled(self):
+        with mock.patch("builtins.input", return_value="no"):
+            with self.assertRaisesMessage(CommandError, "cancelled"):
+                call_command("load_test", classes=1, students=3)
+        self.assertEqual(0, LMS.objects.count())
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+#  test_metrics.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+import glob
+import json
+import os
+import tempfile
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from lti_app import metrics
+
+
+
+class MetricsTestCase(TestCase):
+    
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+    
+    
+    def test_counter(self):
+        metrics.inc("lti_test_total", lms="a")
+        metrics.inc("lti_test_total", 2, lms="a")
+        metrics.inc("lti_test_total", lms='b"')
+        text = metrics.render()
+        self.assertIn("# TYPE lti_test_total counter", text)
+        self.assertIn('lti_test_total{lms="a"} 3.0', text)
+        self.assertIn('lti_test_total{lms="b\\""} 1.0', text)
+    
+    
+    def test_histogram(self):
+        metrics.observe("lti_job_seconds", 0.003, job="a", outcome="ok")
+        metrics.observe("lti_job_seconds", 0.2, job="a", outcome="ok")
+        metrics.observe("lti_job_seconds", 1000, job="a", outcome="ok")
+        text = metrics.render()
+        self.assertIn("# TYPE lti_job_seconds histogram", text)
+        self.assertIn('lti_job_seconds_bucket{job="a",outcome="ok",le="0.005"} 1', text)
+        self.assertIn('lti_job_seconds_bucket{job="a",outcome="ok",le="0.25"} 2', text)
+        self.assertIn('lti_job_seconds_bucket{job="a",outcome="ok",le="300"} 2', text)
+        self.assertIn('lti_job_seconds_bucket{job="a",outcome="ok",le="+Inf"} 3', text)
+        self.assertIn('lti_job_seconds_count{job="a",outcome="ok"} 3', text)
+    
+    
+    def test_timed(self):
+        @metrics.timed("lti_job_seconds", job="failing")
+        def failing():
+            raise ValueError
+        
+        with self.assertRaises(ValueError):
+            failing()
+        key = ("lti_job_seconds", (("job", "failing"), ("outcome", "error")))
+        self.assertEqual(1, sum(metrics.SAMPLES[key][0]))
+    
+    
+    def test_timing(self):
+        ticks = iter([0, 0.5, 1.75, 2])
+        timing = metrics.Timing(clock=lambda: next(ticks))
+        timing.lap("oauth")
+        timing.lap("authuser")
+        self.assertEqual([("oauth", 0.5), ("authuser", 1.25)], timing.stages)
+        self.assertEqual("oauth;dur=500.0, authuser;dur=1250.0, total;dur=2000.0",
+                         timing.header(timing.elapsed()))
+    
+    
+    def test_aggregated_across_workers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(METRICS_DIR=directory):
+                with open(os.path.join(directory, "1-1.json"), "w") as f:
+                    json.dump([
+                        ["lti_test_total", [["lms", "a"]], 4],
+                        ["lti_job_seconds", [["job", "a"]],
+                         [[1] + [0] * len(metrics.BUCKETS), 1]],
+                    ], f)
+                metrics.inc("lti_test_total", lms="a")
+                metrics.observe("lti_job_seconds", 0.001, job="a")
+                
+                samples = metrics.collect()
+                self.assertEqual(1, len(glob.glob(os.path.join(directory, "%d-*.json")
+                                                  % os.getpid())))
+        
+        self.assertEqual(5, samples[("lti_test_total", (("lms", "a"),))])
+        self.assertEqual(2, samples[("lti_job_seconds", (("job", "a"),))][0][0])
+    
+    
+    def test_dead_workers(self):
+        dead = next(pid for pid in range(2 ** 22, 0, -1) if not metrics._alive(pid))
+        alive = os.getppid()
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(METRICS_DIR=directory):
+                # The pid of the alive worker was used by a previous worker
+                for name, value in (("%d-1" % dead, 1), ("%d-1" % alive, 2), ("%d-2" % alive, 4)):
+                    with open(os.path.join(directory, name + ".json"), "w") as f:
+                        json.dump([["lti_test_total", [], value]], f)
+                
+                self.assertEqual(7, metrics.collect()[("lti_test_total", ())])
+                self.assertEqual(
+                    {metrics.DEAD, "%d-2.json" % alive},
+                    {n for n in os.listdir(directory) if not n.startswith(str(os.getpid()))}
+                    - {".lock"}
+                )
+                self.assertEqual(7, metrics.collect()[("lti_test_total", ())])
+    
+    
+    def test_endpoint(self):
+        self.client.get(reverse("lti:wims_class", args=[1]))
+        response = self.client.get(reverse("lti:metrics"))
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        self.assertIn(
+            'lti_launch_seconds_count{outcome="ok",status="405",view="wims_class"} 1',
+            response.content.decode()
+        )
+        
+        response = self.client.get(reverse("lti:metrics"), REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(403, response.status_code)
@@ -5,7 +5,15 @@
 #  Authors:
 #       - Coumes Quentin <coumes.quentin@gmail.com>
 
-from lti_app.models import GradeLinkExam, GradeLinkSheet
+import time
+from unittest import mock
+
+from django.test import TestCase
+
+from lti_app import tasks
+from lti_app.models import (GradeLinkExam, GradeLinkSheet, LMS, OutcomeService, WIMS, WimsClass,
+                            WimsSheet, WimsUser, digest, lookup, name_key, upsert)
+from lti_app.scheduling import slot
 from lti_app.tests.utils import BaseGradeLinksViewTestCase
 
 
@@ -13,33 +21,33 @@ from lti_app.tests.utils import BaseGradeLinksViewTestCase
 class GradeLinkSheetTestCase(BaseGradeLinksViewTestCase):
     
     def test_send_back_ok(self):
-        gl = GradeLinkSheet.objects.create(user=self.user, sourcedid="1", url=self.url_ok,
-                                           lms=self.lms1, activity=self.wsheet1)
+        gl = GradeLinkSheet.objects.create(user=self.user, sourcedid="1", activity=self.wsheet1,
+                                           service=OutcomeService.get(self.lms1, self.url_ok))
         self.assertTrue(gl.send_back(1))
     
     
     def test_send_back_wrong_url(self):
-        gl = GradeLinkSheet.objects.create(user=self.user, sourcedid="1", url="wrong",
-                                           lms=self.lms1, activity=self.wsheet1)
+        gl = GradeLinkSheet.objects.create(user=self.user, sourcedid="1", activity=self.wsheet1,
+                                           service=OutcomeService.get(self.lms1, "wrong"))
         self.assertFalse(gl.send_back(1))
     
     
     def test_send_back_error(self):
-        gl = GradeLinkSheet.objects.create(user=self.user, sourcedid="1", url=self.url_error,
-                                           lms=self.lms1, activity=self.wsheet1)
+        gl = GradeLinkSheet.objects.create(user=self.user, sourcedid="1", activity=self.wsheet1,
+                                           service=OutcomeService.get(self.lms1, self.url_error))
         self.assertFalse(gl.send_back(1))
     
     
     def test_send_back_badly_formatted(self):
-        gl = GradeLinkSheet.objects.create(user=self.user, sourcedid="1",
-                                           url=self.url_badly_formatted, lms=self.lms1,
-                                           activity=self.wsheet1)
+        service = OutcomeService.get(self.lms1, self.url_badly_formatted)
+        gl = GradeLinkSheet.objects.create(user=self.user, sourcedid="1", activity=self.wsheet1,
+                                           service=service)
         self.assertFalse(gl.send_back(1))
     
     
     def test_send_back_all(self):
-        GradeLinkSheet.objects.create(user=self.user, sourcedid="1", url=self.url_ok,
-                                      lms=self.lms1, activity=self.wsheet1)
+        GradeLinkSheet.objects.create(user=self.user, sourcedid="1", activity=self.wsheet1,
+                                      service=OutcomeService.get(self.lms1, self.url_ok))
         self.assertEqual(1, GradeLinkSheet.send_back_all(self.wsheet1))
 
 
@@ -47,31 +55,196 @@ class GradeLinkSheetTestCase(BaseGradeLinksViewTestCase):
 class GradeLinkExamTestCase(BaseGradeLinksViewTestCase):
     
     def test_send_back_ok(self):
-        gl = GradeLinkExam.objects.create(user=self.user, sourcedid="1", url=self.url_ok,
-                                          lms=self.lms1, activity=self.wexam1)
+        gl = GradeLinkExam.objects.create(user=self.user, sourcedid="1", activity=self.wexam1,
+                                          service=OutcomeService.get(self.lms1, self.url_ok))
         self.assertTrue(gl.send_back(1))
     
     
     def test_send_back_wrong_url(self):
-        gl = GradeLinkExam.objects.create(user=self.user, sourcedid="1", url="wrong",
-                                          lms=self.lms1, activity=self.wexam1)
+        gl = GradeLinkExam.objects.create(user=self.user, sourcedid="1", activity=self.wexam1,
+                                          service=OutcomeService.get(self.lms1, "wrong"))
         self.assertFalse(gl.send_back(1))
     
     
     def test_send_back_error(self):
-        gl = GradeLinkExam.objects.create(user=self.user, sourcedid="1", url=self.url_error,
-                                          lms=self.lms1, activity=self.wexam1)
+        gl = GradeLinkExam.objects.create(user=self.user, sourcedid="1", activity=self.wexam1,
+                                          service=OutcomeService.get(self.lms1, self.url_error))
         self.assertFalse(gl.send_back(1))
     
     
     def test_send_back_badly_formatted(self):
-        gl = GradeLinkExam.objects.create(user=self.user, sourcedid="1",
-                                          url=self.url_badly_formatted, lms=self.lms1,
-                                          activity=self.wexam1)
+        service = OutcomeService.get(self.lms1, self.url_badly_formatted)
+        gl = GradeLinkExam.objects.create(user=self.user, sourcedid="1", activity=self.wexam1,
+                                          service=service)
         self.assertFalse(gl.send_back(1))
     
     
     def test_send_back_all(self):
-        GradeLinkExam.objects.create(user=self.user, sourcedid="1", url=self.url_ok,
-                                     lms=self.lms1, activity=self.wexam1)
+        GradeLinkExam.objects.create(user=self.user, sourcedid="1", activity=self.wexam1,
+                                     service=OutcomeService.get(self.lms1, self.url_ok))
         self.assertEqual(1, GradeLinkExam.send_back_all(self.wexam1))
+
+
+
+class LookupTestCase(TestCase):
+    
+    def setUp(self):
+        self.lms = LMS.objects.create(guid="elearning.upem.fr" * 100,
+                                      url="https://elearning.u-pem.fr/", name="Moodle UPEM",
+                                      key="provider1", secret="secret1")
+        self.wims = WIMS.objects.create(url="https://wims.upem.fr", name="WIMS UPEM",
+                                        ident="myself", passwd="toto", rclass="myclass")
+        self.wclass = WimsClass.objects.create(lms=self.lms, lms_guid="77777", wims=self.wims,
+                                               qclass="1", name="test1")
+    
+    
+    def test_digest(self):
+        self.assertIsNone(digest(None))
+        self.assertEqual(digest("77777"), digest("77777"))
+        self.assertEqual(digest("1"), digest(1))
+        self.assertNotEqual(digest("77777"), digest("77778"))
+        self.assertTrue(-2 ** 63 <= digest("77777") < 2 ** 63)
+    
+    
+    def test_lookup(self):
+        self.assertEqual(self.lms, LMS.objects.get(**lookup("guid", "elearning.upem.fr" * 100)))
+        self.assertEqual(self.wclass, WimsClass.objects.get(lms=self.lms, wims=self.wims,
+                                                            **lookup("lms_guid", "77777")))
+        supervisor = WimsUser.objects.create(wclass=self.wclass, quser="supervisor")
+        self.assertEqual(supervisor, WimsUser.objects.get(wclass=self.wclass,
+                                                          **lookup("lms_guid", None)))
+    
+    
+    def test_lookup_collision(self):
+        WimsClass.objects.filter(pk=self.wclass.pk).update(lms_guid_hash=digest("88888"))
+        with self.assertRaises(WimsClass.DoesNotExist):
+            WimsClass.objects.get(**lookup("lms_guid", "88888"))
+    
+    
+    def test_fill_lookup_hashes(self):
+        WimsClass.objects.update(lms_guid_hash=None)
+        LMS.objects.update(guid_hash=None)
+        self.assertEqual(2, tasks.fill_lookup_hashes())
+        self.assertEqual(0, tasks.fill_lookup_hashes())
+        self.assertEqual(self.wclass, WimsClass.objects.get(**lookup("lms_guid", "77777")))
+    
+    
+    def test_fill_class_name_keys(self):
+        WimsClass.objects.update(name_key="")
+        self.assertEqual(1, tasks.fill_class_name_keys())
+        self.assertEqual(0, tasks.fill_class_name_keys())
+        self.assertEqual(name_key(self.wclass.name), WimsClass.objects.get().name_key)
+    
+    
+    def test_fill_class_slots(self):
+        WimsClass.objects.update(slot=None)
+        self.assertEqual(1, tasks.fill_class_slots())
+        self.assertEqual(0, tasks.fill_class_slots())
+        self.assertEqual(slot(self.wclass.qclass), WimsClass.objects.get().slot)
+    
+    
+    def test_upsert(self):
+        keys = {"wclass": self.wclass, "qsheet": "1"}
+        sheet, created = upsert(WimsSheet, keys, lookup("lms_guid", "12"))
+        self.assertTrue(created)
+        self.assertEqual(digest("12"), WimsSheet.objects.get(pk=sheet.pk).lms_guid_hash)
+        
+        with self.assertNumQueries(1):
+            self.assertEqual((sheet, False), upsert(WimsSheet, keys, lookup("lms_guid", "12")))
+        
+        with self.assertNumQueries(2):
+            sheet, created = upsert(WimsSheet, keys, lookup("lms_guid", "13"))
+        self.assertFalse(created)
+        self.assertEqual("13", WimsSheet.objects.get(pk=sheet.pk).lms_guid)
+        self.assertEqual(1, WimsSheet.objects.count())
+    
+    
+    def test_upsert_concurrent(self):
+        keys = {"wclass": self.wclass, "qsheet": "1"}
+        sheet = WimsSheet.objects.create(**keys, lms_guid="12")
+        # Another caller inserts the sheet between the lookup and the insert
+        missing = [WimsSheet.DoesNotExist, sheet]
+        with mock.patch.object(WimsSheet.objects, "get", side_effect=missing):
+            self.assertEqual((sheet, False), upsert(WimsSheet, keys, lookup("lms_guid", "12")))
+        self.assertEqual(1, WimsSheet.objects.count())
+
+
+
+class OutcomeServiceTestCase(TestCase):
+    
+    def setUp(self):
+        self.lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                      name="Moodle UPEM", key="provider1", secret="secret1")
+        self.wims = WIMS.objects.create(url="https://wims.upem.fr", name="WIMS UPEM",
+                                        ident="myself", passwd="toto", rclass="myclass")
+        wclass = WimsClass.objects.create(lms=self.lms, lms_guid="77777", wims=self.wims,
+                                          qclass="1", name="test1")
+        self.sheet = WimsSheet.objects.create(wclass=wclass, lms_guid="1", qsheet="1")
+        self.users = [
+            WimsUser.objects.create(wclass=wclass, lms_guid=str(i), quser="user%d" % i)
+            for i in range(4)
+        ]
+    
+    
+    def test_get(self):
+        url = "https://elearning.u-pem.fr/mod/lti/service.php"
+        service = OutcomeService.get(self.lms, url)
+        self.assertEqual(digest(url), service.url_hash)
+        self.assertEqual(service, OutcomeService.get(self.lms, url))
+        self.assertNotEqual(service, OutcomeService.get(self.lms, url + "?v=2"))
+        self.assertEqual(2, OutcomeService.objects.count())
+    
+    
+    def test_fill_outcome_services(self):
+        # Links saved before OutcomeService was introduced
+        url = "https://elearning.u-pem.fr/outcome"
+        for i, user in enumerate(self.users):
+            GradeLinkSheet.objects.create(user=user, activity=self.sheet, sourcedid=str(i),
+                                          url=url + "/%d" % (i % 2), lms=self.lms)
+        
+        self.assertEqual(len(self.users), tasks.fill_outcome_services())
+        self.assertEqual(0, tasks.fill_outcome_services())
+        self.assertEqual(2, OutcomeService.objects.count())
+        for i, gl in enumerate(GradeLinkSheet.objects.select_related("service").order_by("pk")):
+            self.assertEqual(url + "/%d" % (i % 2), gl.service.url)
+            self.assertEqual(self.lms, gl.service.lms)
+    
+    
+    def test_send_back_grades_grouped_by_service(self):
+        services = [OutcomeService.get(self.lms, "https://elearning.u-pem.fr/outcome/%d" % i)
+                    for i in range(2)]
+        links = {
+            user.quser: GradeLinkSheet.objects.create(user=user, activity=self.sheet,
+                                                      sourcedid=user.lms_guid,
+                                                      service=services[i % 2])
+            for i, user in enumerate(self.users)
+        }
+        grades = [(user.quser, 0.5) for user in self.users] + [("unknown", 1.0)]
+        
+        sent = []
+        
+        def send_back(gl, grade, timeout=None, session=None):
+            sent.append((gl.service_id, session))
+            return True
+        
+        with mock.patch.object(GradeLinkSheet, "send_back", send_back):
+            self.assertEqual(4, GradeLinkSheet.send_back_grades(links, grades))
+        
+        self.assertEqual([services[0].pk] * 2 + [services[1].pk] * 2, [s for s, _ in sent])
+        self.assertIs(sent[0][1], sent[1][1])
+        self.assertIs(sent[2][1], sent[3][1])
+        self.assertIsNot(sent[0][1], sent[2][1])
+    
+    
+    def test_send_back_grades_deadline(self):
+        service = OutcomeService.get(self.lms, "https://elearning.u-pem.fr/outcome")
+        links = {
+            user.quser: GradeLinkSheet.objects.create(user=user, activity=self.sheet,
+                                                      sourcedid=user.lms_guid, service=service)
+            for user in self.users
+        }
+        with mock.patch.object(GradeLinkSheet, "send_back") as send_back:
+            self.assertEqual(0, GradeLinkSheet.send_back_grades(
+                links, [(user.quser, 0.5) for user in self.users], time.monotonic() - 1
+            ))
+        send_back.assert_not_called()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+#  test_probes.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+from unittest import mock
+
+import requests
+import wimsapi
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from lti_app import probes
+from lti_app.models import WIMS, WimsCapability
+
+
+
+class ProbesTestCase(TestCase):
+    
+    def setUp(self):
+        cache.clear()
+        self.wims = WIMS.objects.create(url="https://wims.upem.fr", name="One", ident="myself",
+                                        passwd="toto", rclass="myclass")
+        self.capability = WimsCapability.objects.create(
+            wims=self.wims, version="4.21", jobs="checkclass checkuser",
+            checked=timezone.now()
+        )
+    
+    
+    @mock.patch("wimsapi.WimsAPI.checkuser")
+    def test_user_exists_cached(self, checkuser):
+        checkuser.return_value = (True, {"status": "OK"})
+        self.assertTrue(probes.user_exists(self.wims, "9001", "jdoe"))
+        self.assertTrue(probes.user_exists(self.wims, "9001", "jdoe"))
+        checkuser.assert_called_once_with("9001", "myclass", "jdoe", verbose=True)
+    
+    
+    @mock.patch("wimsapi.WimsAPI.checkuser")
+    def test_user_not_existing(self, checkuser):
+        checkuser.return_value = (False, {"status": "ERROR", "message": "user jdoe not existing"})
+        self.assertFalse(probes.user_exists(self.wims, "9001", "jdoe"))
+        self.assertFalse(probes.user_exists(self.wims, "9001", "jdoe"))
+        self.assertEqual(2, checkuser.call_count)
+    
+    
+    @mock.patch("wimsapi.WimsAPI.checkuser")
+    def test_error(self, checkuser):
+        checkuser.return_value = (False, {"status": "ERROR", "message": "bad identification"})
+        with self.assertRaises(wimsapi.AdmRawError):
+            probes.user_exists(self.wims, "9001", "jdoe")
+    
+    
+    @mock.patch("wimsapi.WimsAPI.getuser")
+    def test_fallback(self, getuser):
+        self.capability.jobs = "checkclass"
+        self.capability.save()
+        getuser.return_value = (True, {"status": "OK"})
+        self.assertTrue(probes.user_exists(self.wims, "9001", "jdoe"))
+        getuser.assert_called_once_with("9001", "myclass", "jdoe", verbose=True)
+    
+    
+    @mock.patch("wimsapi.WimsAPI.checkuser")
+    @mock.patch("wimsapi.WimsAPI.getuser")
+    def test_fallback_failed_probe(self, getuser, checkuser):
+        # Check jobs are not used until the server has been successfully probed
+        self.capability.delete()
+        getuser.return_value = (True, {"status": "OK"})
+        wims = WIMS.objects.get(pk=self.wims.pk)
+        with mock.patch("wimsapi.WimsAPI.getinfoserver", side_effect=requests.ConnectionError):
+            self.assertTrue(probes.user_exists(wims, "9001", "jdoe"))
+        self.assertIsNotNone(WimsCapability.objects.get(wims=wims).failed)
+        getuser.assert_called_once_with("9001", "myclass", "jdoe", verbose=True)
+        checkuser.assert_not_called()
+    
+    
+    @mock.patch("wimsapi.WimsAPI.checkclass")
+    def test_class_exists_other_error(self, checkclass):
+        # Only the message naming the class means that it does not exist
+        for message in ("user supervisor not existing", "class 90010 not existing"):
+            checkclass.return_value = (False, {"status": "ERROR", "message": message})
+            with self.assertRaises(wimsapi.AdmRawError):
+                probes.class_exists(self.wims, "9001")
+        checkclass.return_value = (False, {"status": "ERROR", "message": "class 9001 not existing"})
+        self.assertFalse(probes.class_exists(self.wims, "9001"))
+    
+    
+    @mock.patch("wimsapi.WimsAPI.checkclass")
+    @mock.patch("wimsapi.WimsAPI.listclasses")
+    def test_class_exists_bulk_listing(self, listclasses, checkclass):
+        self.capability.bulk_listing = True
+        self.capability.save()
+        listclasses.return_value = (True, {"status": "OK", "classes_list": [{"qclass": 9001}]})
+        checkclass.return_value = (False, {"status": "ERROR", "message": "class 9002 not existing"})
+        self.assertTrue(probes.class_exists(self.wims, "9001"))
+        self.assertFalse(probes.class_exists(self.wims, "9002"))
+        listclasses.assert_called_once_with("myclass", verbose=True)
+        checkclass.assert_called_once_with("9002", "myclass", verbose=True)
+    
+    
+    @mock.patch("wimsapi.WimsAPI.checkclass")
+    def test_forget(self, checkclass):
+        checkclass.return_value = (True, {"status": "OK"})
+        probes.class_exists(self.wims, "9001")
+        probes.forget(self.wims, "9001")
+        probes.class_exists(self.wims, "9001")
+        self.assertEqual(2, checkclass.call_count)
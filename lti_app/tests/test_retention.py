@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+#  test_retention.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+import gzip
+import json
+import os
+import tempfile
+from datetime import date, datetime, timedelta, timezone
+from unittest import mock
+
+import wimsapi
+from django.test import TestCase, override_settings
+
+from lti_app import retention, tasks
+from lti_app.models import (ExamSurge, GradeLinkSheet, LMS, OutcomeService, WIMS, WimsClass,
+                            WimsExam, WimsSheet, WimsUser)
+
+
+
+class RetentionTestCase(TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        
+        lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                 name="Moodle UPEM", key="provider1", secret="secret1")
+        wims = WIMS.objects.create(url="https://wims.upem.fr", name="WIMS UPEM", ident="myself",
+                                   passwd="toto", rclass="myclass")
+        service = OutcomeService.get(lms, "https://elearning.u-pem.fr/outcome")
+        self.today = date(2021, 6, 1)
+        for i, expiration in enumerate([date(2020, 1, 1), date(2020, 1, 2), date(2021, 5, 1),
+                                        None]):
+            wclass = WimsClass.objects.create(lms=lms, lms_guid=str(i), wims=wims, qclass=str(i),
+                                              name="class %d" % i, expiration=expiration)
+            user = WimsUser.objects.create(wclass=wclass, lms_guid=str(i), quser="jdoe")
+            sheet = WimsSheet.objects.create(wclass=wclass, lms_guid=str(i), qsheet="1")
+            exam = WimsExam.objects.create(wclass=wclass, lms_guid=str(i), qexam="1")
+            start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+            ExamSurge.objects.create(exam=exam, start=start, end=start + timedelta(hours=2))
+            GradeLinkSheet.objects.create(user=user, activity=sheet, sourcedid=str(i),
+                                          service=service)
+    
+    
+    @override_settings(CLASS_RETENTION=timedelta(days=180))
+    def test_expired(self):
+        expired = retention.expired(self.today)
+        self.assertEqual({"0", "1"}, set(expired.values_list("qclass", flat=True)))
+    
+    
+    @override_settings(CLASS_RETENTION=timedelta(days=180), SCHEDULED_JOBS_CHUNK_SIZE=1)
+    def test_archive_expired(self):
+        with override_settings(ARCHIVE_ROOT=self.directory.name):
+            self.assertEqual(2, retention.archive_expired(self.today))
+        
+        self.assertEqual({"2", "3"}, set(WimsClass.objects.values_list("qclass", flat=True)))
+        self.assertEqual(2, WimsUser.objects.count())
+        self.assertEqual(2, WimsSheet.objects.count())
+        self.assertEqual(2, WimsExam.objects.count())
+        self.assertEqual(2, GradeLinkSheet.objects.count())
+        self.assertEqual(2, ExamSurge.objects.count())
+        
+        archives = os.listdir(self.directory.name)
+        self.assertEqual(1, len(archives))
+        with gzip.open(os.path.join(self.directory.name, archives[0]), "rt") as f:
+            docs = [json.loads(line) for line in f]
+        self.assertEqual(["0", "1"], [d["class"]["qclass"] for d in docs])
+        self.assertEqual("2020-01-01", docs[0]["class"]["expiration"])
+        self.assertEqual(["jdoe"], [u["quser"] for u in docs[0]["users"]])
+        self.assertEqual(["0"], [gl["sourcedid"] for gl in docs[0]["grade_links_sheet"]])
+        self.assertEqual(["https://elearning.u-pem.fr/outcome"],
+                         [gl["service__url"] for gl in docs[0]["grade_links_sheet"]])
+        self.assertEqual(["elearning.upem.fr"],
+                         [gl["service__lms__guid"] for gl in docs[0]["grade_links_sheet"]])
+        self.assertEqual([], docs[1]["grade_links_exam"])
+        self.assertEqual(["2020-01-01 02:00:00+00:00"], [s["end"] for s in docs[0]["exam_surges"]])
+    
+    
+    @override_settings(CLASS_RETENTION=timedelta(days=180), ARCHIVE_ROOT=None)
+    def test_archive_expired_without_archive(self):
+        self.assertEqual(2, retention.archive_expired(self.today))
+        self.assertEqual(2, WimsClass.objects.count())
+    
+    
+    @mock.patch("wimsapi.WimsAPI.getclass")
+    def test_fetch_expiration(self, getclass):
+        wclass = WimsClass.objects.get(qclass="3")
+        getclass.return_value = (True, {"status": "OK", "expiration": "20200101"})
+        self.assertEqual(date(2020, 1, 1), retention.fetch_expiration(wclass))
+        self.assertEqual(date(2020, 1, 1), WimsClass.objects.get(qclass="3").expiration)
+        getclass.assert_called_once_with("3", "myclass", verbose=True)
+        
+        getclass.return_value = (False, {"status": "ERROR", "message": "class 3 not existing"})
+        with self.assertRaises(wimsapi.AdmRawError):
+            retention.fetch_expiration(wclass)
+    
+    
+    @mock.patch("lti_app.probes.class_exists", return_value=True)
+    @mock.patch("wimsapi.WimsAPI.getclass")
+    def test_check_classes_exists_fetch_expiration(self, getclass, class_exists):
+        getclass.return_value = (True, {"status": "OK", "expiration": "20200101"})
+        self.assertEqual(0, tasks.check_classes_exists())
+        self.assertEqual(4, class_exists.call_count)
+        # Only the class without expiration date is fetched
+        getclass.assert_called_once_with("3", "myclass", verbose=True)
+        self.assertEqual(date(2020, 1, 1), WimsClass.objects.get(qclass="3").expiration)
+    
+    
+    def test_archive_expired_classes_task(self):
+        with override_settings(ARCHIVE_ROOT=self.directory.name):
+            self.assertEqual(3, tasks.archive_expired_classes())
+        self.assertEqual(["3"], list(WimsClass.objects.values_list("qclass", flat=True)))
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+#  test_roster.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+import os
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+from django.urls import reverse
+
+from lti_app import roster
+from lti_app.models import WimsClass, WimsUser, lookup
+from lti_app.tests.utils import StubWimsMixin
+
+
+ROSTER = (
+    "user_id,firstname,lastname,email\n"
+    "1,John,Doe,jdoe@upem.fr\n"
+    "2,Jane,Doe,\n"
+    "3,Jean,Doe,jean@upem.fr\n"
+    ",Nobody,Missing,\n"
+)
+
+
+
+class RosterTestCase(StubWimsMixin, TestCase):
+    
+    def setUp(self):
+        super().setUp()
+        qclass = self.stub.add_class()
+        self.wclass = WimsClass.objects.create(lms=self.lms, lms_guid="77777", wims=self.wims,
+                                               qclass=qclass, name="A title")
+        WimsUser.objects.create(wclass=self.wclass, quser="supervisor")
+    
+    
+    def test_read(self):
+        rows = roster.read(StringIO(ROSTER))
+        self.assertEqual(["1", "2", "3"], [r["user_id"] for r in rows])
+        self.assertEqual("Jane", rows[1]["firstname"])
+    
+    
+    def test_read_missing_column(self):
+        with self.assertRaisesMessage(ValueError, "lastname"):
+            roster.read(StringIO("user_id,firstname\n1,John\n"))
+    
+    
+    def test_provision(self):
+        rows = roster.read(StringIO(ROSTER))
+        report = roster.provision(self.wclass, rows, concurrency=1, batch_size=2)
+        self.assertEqual({"created": 3, "existing": 0, "failed": [], "orphaned": []}, report)
+        
+        users = self.stub.classes[self.wclass.qclass]["users"]
+        self.assertEqual({"supervisor", "jdoe", "jdoe1", "jdoe2"}, set(users))
+        self.assertEqual(4, WimsUser.objects.filter(wclass=self.wclass).count())
+        user = WimsUser.objects.get(wclass=self.wclass, **lookup("lms_guid", "1"))
+        self.assertEqual("jdoe", user.quser)
+        
+        self.stub.reset()
+        report = roster.provision(self.wclass, rows + [{"user_id": "4", "firstname": "Jim",
+                                                        "lastname": "Beam"}])
+        self.assertEqual({"created": 1, "existing": 3, "failed": [], "orphaned": []}, report)
+        self.assertEqual(1, self.stub.calls["adduser"])
+    
+    
+    def test_provision_failed(self):
+        rows = roster.read(StringIO(ROSTER))
+        adduser = self.stub.job_adduser
+        
+        def job_adduser(data):
+            if "Jane" in data.get("data1", ""):
+                return False, {"message": "refused"}
+            return adduser(data)
+        
+        with mock.patch.object(self.stub, "job_adduser", job_adduser):
+            report = roster.provision(self.wclass, rows)
+        self.assertEqual(2, report["created"])
+        self.assertEqual(["2"], [user_id for user_id, _ in report["failed"]])
+        self.assertIn("refused", report["failed"][0][1])
+        self.assertFalse(WimsUser.objects.filter(**lookup("lms_guid", "2")).exists())
+    
+    
+    def test_provision_skipped(self):
+        # Row left from a WIMS account since deleted, taking the quser the roster will get
+        WimsUser.objects.create(wclass=self.wclass, quser="jdoe", lms_guid="other")
+        rows = roster.read(StringIO(ROSTER))
+        report = roster.provision(self.wclass, rows, concurrency=1)
+        self.assertEqual(2, report["created"])
+        self.assertEqual(["1"], [user_id for user_id, _ in report["failed"]])
+        self.assertEqual([], report["orphaned"])
+        self.assertEqual({"supervisor", "jdoe1", "jdoe2"},
+                         set(self.stub.classes[self.wclass.qclass]["users"]))
+        self.assertFalse(WimsUser.objects.filter(**lookup("lms_guid", "1")).exists())
+    
+    
+    def test_provision_orphaned(self):
+        WimsUser.objects.create(wclass=self.wclass, quser="jdoe", lms_guid="other")
+        rows = roster.read(StringIO(ROSTER))
+        with mock.patch.object(self.stub, "job_deluser", return_value=(False, {"message": "no"})):
+            report = roster.provision(self.wclass, rows)
+        self.assertEqual(["jdoe"], report["orphaned"])
+        self.assertIn("jdoe", self.stub.classes[self.wclass.qclass]["users"])
+    
+    
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "roster.csv")
+            with open(path, "w") as f:
+                f.write(ROSTER)
+            out = StringIO()
+            call_command("provision_roster", str(self.wclass.pk), path, stdout=out)
+        self.assertIn("3 created, 0 already existing, 0 failed", out.getvalue())
+        
+        with self.assertRaises(CommandError):
+            call_command("provision_roster", str(self.wclass.pk + 1), path)
+        with self.assertRaises(CommandError):
+            call_command("provision_roster", str(self.wclass.pk), path)
+    
+    
+    def test_admin_action(self):
+        self.client.force_login(
+            User.objects.create_superuser("admin", "admin@upem.fr", "password")
+        )
+        url = reverse("admin:lti_app_wimsclass_changelist")
+        data = {"action": "provision_roster", "_selected_action": [str(self.wclass.pk)]}
+        
+        response = self.client.post(url, data)
+        self.assertEqual(200, response.status_code)
+        self.assertTemplateUsed(response, "admin/lti_app/provision_roster.html")
+        
+        response = self.client.post(url, {
+            **data, "apply": "Provision",
+            "roster": SimpleUploadedFile("roster.csv", ROSTER.encode(), "text/csv"),
+        })
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(4, WimsUser.objects.filter(wclass=self.wclass).count())
+        
+        response = self.client.post(url, {
+            **data, "apply": "Provision",
+            "roster": SimpleUploadedFile("roster.csv", b"user_id\n1\n", "text/csv"),
+        })
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, "Missing column(s) in the roster")
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#
+#  test_scheduling.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+from lti_app import scheduling
+from lti_app.models import JobCheckpoint, LMS, WIMS, WimsClass, WimsSheet
+
+
+
+class SlotTestCase(TestCase):
+    
+    def test_slot_stable(self):
+        self.assertEqual(scheduling.slot("6948902"), scheduling.slot(6948902))
+        self.assertTrue(0 <= scheduling.slot("6948902") < scheduling.SLOTS)
+    
+    
+    def test_class_slot_saved(self):
+        lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                 name="No WIMS", key="provider1", secret="secret1")
+        wims = WIMS.objects.create(url="https://wims.upem.fr", name="One", ident="myself",
+                                   passwd="toto", rclass="myclass")
+        wclass = WimsClass.objects.create(lms=lms, lms_guid="1", wims=wims, qclass="6948902",
+                                          name="test")
+        self.assertEqual(scheduling.slot("6948902"), wclass.slot)
+
+
+
+class PacerTestCase(TestCase):
+    
+    def test_wait(self):
+        now = [100.0]
+        slept = []
+        
+        def sleep(delay):
+            slept.append(delay)
+            now[0] += delay
+        
+        pacer = scheduling.Pacer(3600, clock=lambda: now[0], sleep=sleep)
+        pacer.wait(0)
+        pacer.wait(scheduling.SLOTS // 2)
+        now[0] += 3600
+        pacer.wait(scheduling.SLOTS - 1)
+        self.assertEqual([1800], slept)
+    
+    
+    def test_no_window(self):
+        pacer = scheduling.Pacer(0, sleep=lambda d: self.fail("Should not sleep"))
+        pacer.wait(scheduling.SLOTS - 1)
+
+
+
+class SpreadTestCase(TestCase):
+    
+    def test_spread(self):
+        lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                 name="No WIMS", key="provider1", secret="secret1")
+        wims1 = WIMS.objects.create(url="https://wims1.upem.fr", name="One", ident="myself",
+                                    passwd="toto", rclass="myclass")
+        wims2 = WIMS.objects.create(url="https://wims2.upem.fr", name="Two", ident="myself",
+                                    passwd="toto", rclass="myclass")
+        for i in range(20):
+            wclass = WimsClass.objects.create(lms=lms, lms_guid=str(i), wims=(wims1, wims2)[i % 2],
+                                              qclass=str(1000 + i), name="test")
+            WimsSheet.objects.create(wclass=wclass, lms_guid=str(i), qsheet="1")
+        
+        classes = list(scheduling.spread(WimsClass.objects.all(), "wims", "slot"))
+        positions = [p for p, _, _ in classes]
+        self.assertEqual(20, len(classes))
+        self.assertEqual(sorted(positions), positions)
+        for position, wims, wclass in classes:
+            self.assertEqual(wclass.wims, wims)
+            expected = (wclass.slot + scheduling.slot(wclass.wims.url)) % scheduling.SLOTS
+            self.assertEqual(expected, position)
+        
+        sheets = list(scheduling.spread(WimsSheet.objects.all(), "wclass__wims", "wclass__slot"))
+        self.assertEqual(positions, [p for p, _, _ in sheets])
+        
+        with override_settings(SCHEDULED_JOBS_CHUNK_SIZE=3):
+            chunked = list(scheduling.spread(WimsClass.objects.all(), "wims", "slot"))
+        self.assertEqual([c.pk for _, _, c in classes], [c.pk for _, _, c in chunked])
+        
+        start = {wims1.pk: positions[10], wims2.pk: positions[10]}
+        resumed = list(scheduling.spread(WimsClass.objects.all(), "wims", "slot", start))
+        self.assertEqual(positions[10:], [p for p, _, _ in resumed])
+    
+    
+    def test_spread_shift(self):
+        lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                 name="No WIMS", key="provider1", secret="secret1")
+        wims = WIMS.objects.create(url="https://wims1.upem.fr", name="One", ident="myself",
+                                   passwd="toto", rclass="myclass")
+        for i in range(20):
+            WimsClass.objects.create(lms=lms, lms_guid=str(i), wims=wims, qclass=str(1000 + i),
+                                     name="test")
+        
+        shift = scheduling.SLOTS // 2
+        classes = {c.pk: p for p, _, c in scheduling.spread(WimsClass.objects.all(), "wims", "slot")}
+        shifted = list(scheduling.spread(WimsClass.objects.all(), "wims", "slot", shift=shift))
+        self.assertEqual(20, len(shifted))
+        self.assertEqual(sorted(p for p, _, _ in shifted), [p for p, _, _ in shifted])
+        for position, _, wclass in shifted:
+            self.assertEqual((classes[wclass.pk] + shift) % scheduling.SLOTS, position)
+
+
+
+class JobRunTestCase(TestCase):
+    
+    @classmethod
+    def setUpTestData(cls):
+        lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                 name="No WIMS", key="provider1", secret="secret1")
+        cls.wims1 = WIMS.objects.create(url="https://wims1.upem.fr", name="One", ident="myself",
+                                        passwd="toto", rclass="myclass")
+        cls.wims2 = WIMS.objects.create(url="https://wims2.upem.fr", name="Two", ident="myself",
+                                        passwd="toto", rclass="myclass")
+        for i in range(20):
+            WimsClass.objects.create(lms=lms, lms_guid=str(i), wims=(cls.wims1, cls.wims2)[i % 2],
+                                     qclass=str(1000 + i), name="test")
+    
+    
+    def test_finished(self):
+        run = scheduling.JobRun("test")
+        self.assertEqual(20, len(list(run.items(WimsClass.objects.all(), "wims", "slot"))))
+        self.assertFalse(JobCheckpoint.objects.filter(job="test").exists())
+    
+    
+    def test_cancel_and_resume(self):
+        run = scheduling.JobRun("test")
+        processed = []
+        for _, wclass in run.items(WimsClass.objects.all(), "wims", "slot"):
+            processed.append(wclass.pk)
+            if len(processed) == 8:
+                scheduling.cancel("test")
+        self.assertEqual(8, len(processed))
+        self.assertEqual(2, JobCheckpoint.objects.filter(job="test").count())
+        
+        run = scheduling.JobRun("test")
+        resumed = [c.pk for _, c in run.items(WimsClass.objects.all(), "wims", "slot")]
+        # Processed items are not processed again
+        self.assertEqual(20, len(set(processed) | set(resumed)))
+        self.assertEqual(12, len(resumed))
+        self.assertFalse(JobCheckpoint.objects.filter(job="test").exists())
+    
+    
+    def test_shutdown(self):
+        scheduler = mock.Mock(running=True)
+        run = scheduling.JobRun("test")
+        processed = []
+        for _, wclass in run.items(WimsClass.objects.all(), "wims", "slot"):
+            processed.append(wclass.pk)
+            scheduling.shutdown(scheduler)
+        self.assertEqual(1, len(processed))
+        scheduler.shutdown.assert_called_once_with(wait=False)
+        self.assertEqual(2, JobCheckpoint.objects.filter(job="test").count())
+    
+    
+    def test_budget(self):
+        run = scheduling.JobRun("test", budget=0)
+        self.assertEqual([], list(run.items(WimsClass.objects.all(), "wims", "slot")))
+    
+    
+    def test_server_budget(self):
+        run = scheduling.JobRun("test", server_budget=0)
+        self.assertEqual([], list(run.items(WimsClass.objects.all(), "wims", "slot")))
+        self.assertEqual(2, JobCheckpoint.objects.filter(job="test").count())
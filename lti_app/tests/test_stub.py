@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+#  test_stub.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+from unittest import mock
+
+import requests
+import wimsapi
+from django.test import SimpleTestCase
+
+from lti_app.stub import StubWims, StubWimsServer
+from lti_app.tests.utils import StubWimsMixin
+
+
+URL = "http://stub.wims/wims.cgi"
+
+
+
+class StubWimsTestCase(StubWimsMixin, SimpleTestCase):
+    
+    create_servers = False
+    
+    
+    def test_class_round_trip(self):
+        wclass = wimsapi.Class("myclass", "A title", "UPEM", "test@email.com", "password",
+                               wimsapi.User("supervisor", "Supervisor", "", "password"))
+        wclass.save(URL, "myself", "toto")
+        wclass.name = "Another title"
+        wclass.save()
+        self.assertEqual("Another title", wimsapi.Class.get(URL, "myself", "toto", wclass.qclass,
+                                                            "myclass").name)
+        
+        user = wimsapi.User("jdoe", "Doe", "John", "password", "john@doe.com")
+        wclass.additem(user)
+        user.firstname = "Jane"
+        user.save()
+        self.assertEqual("Jane", wclass.getitem("jdoe", wimsapi.User).firstname)
+        wclass.delitem(user)
+        self.assertFalse(wclass.checkitem("jdoe", wimsapi.User))
+        
+        wclass.delete()
+        self.assertFalse(self.stub.classes)
+    
+    
+    def test_sheet_and_exam_round_trip(self):
+        qclass = self.stub.add_class()
+        wclass = wimsapi.Class.get(URL, "myself", "toto", qclass, "myclass")
+        
+        for item_class, mode in ((wimsapi.Sheet, "sheetmode"), (wimsapi.Exam, "exammode")):
+            item = item_class("Title", "Description")
+            wclass.additem(item)
+            setattr(item, mode, 1)
+            item.save()
+            self.assertEqual(["1"], [str(getattr(i, mode)) for i in wclass.listitem(item_class)])
+            wclass.delitem(item)
+            self.assertEqual([], wclass.listitem(item_class))
+    
+    
+    def test_populate(self):
+        qclasses = self.stub.populate(2, 3, sheets=2)
+        self.assertEqual(2, len(qclasses))
+        wclass = self.stub.classes[qclasses[1]]
+        self.assertEqual(4, len(wclass["users"]))
+        self.assertEqual(2, len(wclass["sheets"]))
+        self.assertEqual(1, len(wclass["exams"]))
+    
+    
+    def test_faults(self):
+        api = wimsapi.WimsAPI(URL, "myself", "toto")
+        self.stub.inject("timeout", job="checkident")
+        with self.assertRaises(requests.Timeout):
+            api.checkident()
+        self.assertTrue(api.checkident()[0])
+        
+        self.stub.inject("unreachable", count=2)
+        for _ in range(2):
+            with self.assertRaises(requests.ConnectionError):
+                api.checkident()
+        
+        self.stub.inject("error")
+        self.assertFalse(api.checkident()[0])
+        self.stub.inject("invalid")
+        with self.assertRaises(wimsapi.WimsAPIError):
+            api.checkident()
+        
+        self.stub.inject("error", count=None, rate=0.5)
+        failed = sum(not api.checkident()[0] for _ in range(200))
+        self.assertTrue(50 < failed < 150, failed)
+        
+        with self.assertRaises(ValueError):
+            self.stub.inject("unknown")
+    
+    
+    def test_latency(self):
+        self.stub.latency = {"checkident": 0.05}
+        with mock.patch("time.sleep") as sleep:
+            wimsapi.WimsAPI(URL, "myself", "toto").checkident()
+            wimsapi.WimsAPI(URL, "myself", "toto").checkclass(9001, "myclass")
+        sleep.assert_called_once_with(0.05)
+
+
+
+class StubWimsServerTestCase(SimpleTestCase):
+    
+    def test_server(self):
+        stub = StubWims()
+        qclass = stub.add_class()
+        with StubWimsServer(stub, timeout_delay=5) as server:
+            api = wimsapi.WimsAPI(server.url, "myself", "toto", timeout=0.2)
+            self.assertTrue(api.checkident()[0])
+            self.assertTrue(api.checkclass(qclass, "myclass")[0])
+            self.assertFalse(wimsapi.WimsAPI(server.url, "myself", "wrong").checkident()[0])
+            
+            stub.inject("timeout")
+            with self.assertRaises(requests.Timeout):
+                api.checkident()
+            stub.inject("unreachable")
+            with self.assertRaises(requests.ConnectionError):
+                api.checkident()
+            self.assertTrue(api.checkident()[0])
+        
+        self.assertEqual(5, stub.calls["checkident"])
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+#  test_surge.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from lti_app import probes, surge, tasks
+from lti_app.models import ExamSurge, WimsClass, WimsExam, WimsUser
+from lti_app.tests.utils import StubWimsMixin
+
+
+
+@override_settings(SURGE_WARMUP_LEAD=timedelta(minutes=10),
+                   SURGE_WARMUP_REFRESH=timedelta(minutes=5))
+class SurgeTestCase(StubWimsMixin, TestCase):
+    
+    def setUp(self):
+        super().setUp()
+        qclass = self.stub.add_class()
+        self.stub.add_exam(qclass)
+        self.stub.classes[qclass]["users"]["jdoe"] = {"lastname": "Doe", "firstname": "John"}
+        self.wclass = WimsClass.objects.create(lms=self.lms, lms_guid="77777", wims=self.wims,
+                                               qclass=qclass, name="A title")
+        WimsUser.objects.create(wclass=self.wclass, quser="supervisor")
+        WimsUser.objects.create(wclass=self.wclass, lms_guid="1", quser="jdoe")
+        WimsUser.objects.create(wclass=self.wclass, lms_guid="2", quser="deleted")
+        self.exam = WimsExam.objects.create(wclass=self.wclass, lms_guid="1", qexam="1")
+        self.now = timezone.now()
+    
+    
+    def add_surge(self, start: int, end: int, warmed: int = None) -> ExamSurge:
+        """Add a surge starting and ending <start> and <end> minutes from now."""
+        return ExamSurge.objects.create(
+            exam=self.exam, start=self.now + timedelta(minutes=start),
+            end=self.now + timedelta(minutes=end),
+            warmed=None if warmed is None else self.now + timedelta(minutes=warmed),
+        )
+    
+    
+    def test_due(self):
+        due = {
+            self.add_surge(5, 15),
+            self.add_surge(-5, 5),
+            self.add_surge(-5, 5, warmed=-6),
+        }
+        self.add_surge(15, 30)
+        self.add_surge(-30, -5)
+        self.add_surge(-5, 5, warmed=-1)
+        self.assertEqual(due, set(surge.due(self.now)))
+    
+    
+    def test_warm_up(self):
+        exam_surge = self.add_surge(5, 15)
+        self.assertEqual(2, surge.warm_up(exam_surge, self.now))
+        
+        qclass = self.wclass.qclass
+        self.assertTrue(surge.healthy(self.wims.pk, qclass, 1))
+        self.assertFalse(surge.healthy(self.wims.pk, qclass, 2))
+        self.assertEqual(qclass, surge.cached_class(self.wims, qclass).qclass)
+        self.assertEqual("1", str(surge.cached_exam(self.wims.pk, qclass, 1).qexam))
+        self.assertIsNone(surge.cached_exam(self.wims.pk, qclass, 2))
+        for key in (surge._key(self.wims.pk, "class", qclass),
+                    surge._key(self.wims.pk, "exam", qclass, 1)):
+            self.assertIsInstance(cache.get(key), dict)
+            self.assertNotIn("password", cache.get(key))
+        exam_surge.refresh_from_db()
+        self.assertEqual(self.now, exam_surge.warmed)
+        
+        self.stub.reset()
+        self.assertTrue(probes.user_exists(self.wims, qclass, "jdoe"))
+        self.assertEqual(0, sum(self.stub.calls.values()))
+    
+    
+    def test_warm_up_ended(self):
+        self.assertEqual(0, surge.warm_up(self.add_surge(-30, -5), self.now))
+        self.assertEqual(0, sum(self.stub.calls.values()))
+        self.assertFalse(surge.healthy(self.wims.pk, self.wclass.qclass, 1))
+    
+    
+    def test_warm_up_exams(self):
+        self.add_surge(5, 15)
+        self.add_surge(15, 30)
+        self.assertEqual(1, tasks.warm_up_exams())
+        self.assertEqual(0, tasks.warm_up_exams())
+    
+    
+    def test_warm_up_exams_error(self):
+        self.add_surge(5, 15)
+        self.stub.passwd = "wrong"
+        self.assertEqual(0, tasks.warm_up_exams())
+        self.assertFalse(surge.healthy(self.wims.pk, self.wclass.qclass, 1))
+    
+    
+    def test_admin_action(self):
+        self.client.force_login(
+            User.objects.create_superuser("admin", "admin@upem.fr", "password")
+        )
+        exam_surge = self.add_surge(60, 90)
+        response = self.client.post(reverse("admin:lti_app_examsurge_changelist"), {
+            "action":           "warm_up",
+            "_selected_action": [str(exam_surge.pk)],
+        })
+        self.assertEqual(302, response.status_code)
+        self.assertTrue(surge.healthy(self.wims.pk, self.wclass.qclass, 1))
@@ -7,7 +7,7 @@
 
 
 from lti_app import tasks
-from lti_app.models import GradeLinkExam, GradeLinkSheet, WimsClass
+from lti_app.models import GradeLinkExam, GradeLinkSheet, OutcomeService, WimsClass
 from lti_app.tests.utils import BaseGradeLinksViewTestCase
 
 
@@ -15,14 +15,14 @@ from lti_app.tests.utils import BaseGradeLinksViewTestCase
 class TestTasks(BaseGradeLinksViewTestCase):
     
     def test_send_back_all_sheets_grades(self):
-        GradeLinkSheet.objects.create(user=self.user, sourcedid="1", url=self.url_ok,
-                                      lms=self.lms1, activity=self.wsheet1)
+        GradeLinkSheet.objects.create(user=self.user, sourcedid="1", activity=self.wsheet1,
+                                      service=OutcomeService.get(self.lms1, self.url_ok))
         self.assertEqual(1, tasks.send_back_all_sheets_grades())
     
     
     def test_send_back_all_exams_grades(self):
-        GradeLinkExam.objects.create(user=self.user, sourcedid="1", url=self.url_ok,
-                                     lms=self.lms1, activity=self.wexam1)
+        GradeLinkExam.objects.create(user=self.user, sourcedid="1", activity=self.wexam1,
+                                     service=OutcomeService.get(self.lms1, self.url_ok))
         self.assertEqual(1, tasks.send_back_all_exams_grades())
     
     
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+#  test_tracing.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+
+import json
+import os
+import tempfile
+from typing import Callable
+from unittest import mock
+
+import requests
+import wimsapi
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from lti_app import metrics, tracing
+from lti_app.tests.utils import StubWimsMixin
+
+
+URL = "http://stub.wims/wims.cgi/"
+
+
+
+@override_settings(WIMS_TRACE_SAMPLE_RATE=1, WIMS_TRACE_SLOW_THRESHOLD=10)
+class TracingTestCase(StubWimsMixin, TestCase):
+    
+    create_servers = False
+    
+    
+    def stub_post(self) -> Callable:
+        return tracing.traced_post(self.stub)
+    
+    
+    def setUp(self):
+        metrics.reset()
+        tracing.reset()
+        self.addCleanup(metrics.reset)
+        self.addCleanup(tracing.reset)
+        
+        super().setUp()
+        self.stub.add_class("9001")
+        self.api = wimsapi.WimsAPI(URL, "myself", "toto")
+    
+    
+    def test_traces(self):
+        self.api.checkident()
+        self.api.getclass("9001", "myclass")
+        self.api.getclass("9999", "myclass")
+        
+        ok, error = tracing.traces(job="getclass")
+        self.assertEqual(("9001", "ok", None), (ok["qclass"], ok["outcome"], ok["message"]))
+        self.assertEqual(URL, ok["wims"])
+        self.assertGreater(ok["size"], 0)
+        self.assertEqual(("9999", "error"), (error["qclass"], error["outcome"]))
+        self.assertIn("not existing", error["message"])
+        
+        self.assertEqual(3, len(tracing.traces(wims=URL)))
+        self.assertEqual([error], tracing.traces(outcome="error"))
+        self.assertEqual(2, len(tracing.traces(slowest=2)))
+    
+    
+    def test_metrics(self):
+        self.api.checkident()
+        self.api.getclass("9999", "myclass")
+        key = ("lti_wims_call_seconds", (("job", "getclass"), ("outcome", "error"), ("wims", URL)))
+        self.assertEqual(1, sum(metrics.SAMPLES[key][0]))
+        self.assertGreater(
+            metrics.SAMPLES[("lti_wims_response_bytes_total", (("job", "checkident"), ("wims", URL)))],
+            0
+        )
+    
+    
+    @override_settings(WIMS_TRACE_SAMPLE_RATE=0)
+    def test_sampling(self):
+        self.api.checkident()
+        self.api.getclass("9999", "myclass")
+        self.assertEqual(["getclass"], [t["job"] for t in tracing.traces()])
+        
+        with override_settings(WIMS_TRACE_SLOW_THRESHOLD=0):
+            self.api.checkident()
+        self.assertEqual(["getclass", "checkident"], [t["job"] for t in tracing.traces()])
+    
+    
+    def test_timeout(self):
+        post = tracing.traced_post(mock.Mock(side_effect=requests.Timeout("timed out")))
+        with self.assertRaises(requests.Timeout):
+            post(URL, data={"job": "checkident"}, timeout=5)
+        trace = tracing.traces()[0]
+        self.assertEqual(("timeout", 5), (trace["outcome"], trace["timeout"]))
+    
+    
+    def test_trace_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "traces.ndjson")
+            with override_settings(WIMS_TRACE_FILE=path):
+                self.api.checkident()
+                self.api.checkident()
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+        self.assertEqual(["checkident", "checkident"], [t["job"] for t in lines])
+    
+    
+    def test_endpoint(self):
+        self.api.checkident()
+        self.api.getclass("9999", "myclass")
+        url = reverse("lti:wims_traces")
+        
+        response = self.client.get(url, {"outcome": "error"})
+        self.assertEqual("application/x-ndjson", response["Content-Type"])
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(["getclass"], [json.loads(line)["job"] for line in lines])
+        
+        self.assertEqual(400, self.client.get(url, {"slowest": "a"}).status_code)
+        self.assertEqual(403, self.client.get(url, REMOTE_ADDR="10.0.0.1").status_code)
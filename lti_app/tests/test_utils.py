@@ -22,6 +22,7 @@ from wimsapi import Class, Exam, Sheet, User, WimsAPI
 from lti_app import utils
 from lti_app.exceptions import BadRequestException
 from lti_app.models import LMS, WIMS, WimsClass, WimsUser
+from lti_app.tests.cassettes import CassetteMixin
 from lti_app.tests.utils import KEY, SECRET, WIMS_URL, TEST_SERVER
 from lti_app.utils import parse_parameters
 
@@ -328,7 +329,7 @@ class CheckParametersTestCase(TestCase):
 
 
 
-class GetOrCreateClassTestCase(TestCase):
+class GetOrCreateClassTestCase(CassetteMixin, TestCase):
     
     def tearDown(self):
         """Delete created class with known ID."""
@@ -680,7 +681,7 @@ class GetOrCreateClassTestCase(TestCase):
 
 
 
-class GetOrCreateUserTestCase(TestCase):
+class GetOrCreateUserTestCase(CassetteMixin, TestCase):
     
     def test_wims_username(self):
         self.assertEqual("jdoe", utils.wims_username("Jhon", "Doe"))
@@ -997,7 +998,7 @@ class GetOrCreateUserTestCase(TestCase):
 
 
 
-class GetSheetTestCase(TestCase):
+class GetSheetTestCase(CassetteMixin, TestCase):
     
     def test_get_sheet_ok(self):
         params = {
@@ -1044,7 +1045,7 @@ class GetSheetTestCase(TestCase):
 
 
 
-class GetExamTestCase(TestCase):
+class GetExamTestCase(CassetteMixin, TestCase):
     
     def test_get_exam_ok(self):
         params = {
@@ -1088,3 +1089,31 @@ class GetExamTestCase(TestCase):
         self.assertEqual(activity2.qexam, activity.qexam)
         self.assertEqual(activity2.wclass, activity.wclass)
         self.assertEqual(activity2.lms_guid, activity.lms_guid)
+
+
+
+class SyncExpirationTestCase(CassetteMixin, TestCase):
+    
+    def test_parse_expiration(self):
+        self.assertEqual(date(2021, 6, 30), utils.parse_expiration("20210630"))
+        self.assertIsNone(utils.parse_expiration("never"))
+    
+    
+    def test_sync_expiration(self):
+        lms = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                 name="Moodle UPEM", key="provider1", secret="secret1")
+        wims = WIMS.objects.create(url=WIMS_URL, name="WIMS UPEM", ident="myself", passwd="toto",
+                                   rclass="myclass")
+        wclass_db = WimsClass.objects.create(lms=lms, lms_guid="77777", wims=wims, qclass="1",
+                                             name="test1", expiration=date(2021, 6, 30))
+        wclass = Class("myclass", "A title", "UPEM", "test@email.com", "password",
+                       User("supervisor", "Supervisor", "", "password", "test@email.com"),
+                       expiration="20210630")
+        
+        with self.assertNumQueries(0):
+            utils.sync_expiration(wclass_db, wclass)
+        
+        wclass.expiration = "20220630"
+        with self.assertNumQueries(1):
+            utils.sync_expiration(wclass_db, wclass)
+        self.assertEqual(date(2022, 6, 30), WimsClass.objects.get(pk=wclass_db.pk).expiration)
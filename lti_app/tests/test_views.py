@@ -13,18 +13,19 @@ import oauthlib.oauth1.rfc5849.signature as oauth_signature
 from django.conf import settings
 from django.http import Http404
 from django.shortcuts import reverse
-from django.test import Client, RequestFactory, TestCase
+from django.test import Client, RequestFactory, TestCase, override_settings
 from wimsapi import Class, Exam, Sheet, User
 
 from lti_app import views
 from lti_app.enums import Role
 from lti_app.models import LMS, WIMS, WimsClass
+from lti_app.tests.cassettes import CassetteMixin
 from lti_app.tests.utils import (BaseLinksViewTestCase, KEY, SECRET, TEST_SERVER, WIMS_URL,
                                  untar_archive)
 
 
 
-class WimsClassTestCase(TestCase):
+class WimsClassTestCase(CassetteMixin, TestCase):
     
     def test_wims_class_ok(self):
         params = {
@@ -368,7 +369,7 @@ class WimsClassTestCase(TestCase):
 
 
 
-class WimsSheetTestCase(TestCase):
+class WimsSheetTestCase(CassetteMixin, TestCase):
     
     def test_wims_sheet_ok(self):
         params = {
@@ -869,7 +870,7 @@ class WimsSheetTestCase(TestCase):
 
 
 
-class WimsExamTestCase(TestCase):
+class WimsExamTestCase(CassetteMixin, TestCase):
     
     def test_wims_exam_ok(self):
         params = {
@@ -1441,6 +1442,73 @@ class ClassesTestCase(BaseLinksViewTestCase):
 
 
 
+@override_settings(CLASSES_PER_PAGE=2)
+class ClassesBrowserTestCase(TestCase):
+    
+    def setUp(self):
+        self.lms1 = LMS.objects.create(guid="elearning.upem.fr", url="https://elearning.u-pem.fr/",
+                                       name="Moodle UPEM", key="provider1", secret="secret1")
+        self.lms2 = LMS.objects.create(guid="elearning.test.fr", url="https://elearning.test.fr/",
+                                       name="Moodle Test", key="provider2", secret="secret2")
+        self.wims = WIMS.objects.create(url="http://stub.wims/wims.cgi", name="WIMS UPEM",
+                                        ident="myself", passwd="toto", rclass="myclass")
+        for i, name in enumerate(["Algebra", "analysis", "Geometry"], 1):
+            WimsClass.objects.create(lms=self.lms1 if i < 3 else self.lms2, lms_guid=str(i),
+                                     wims=self.wims, qclass=str(9000 + i), name=name)
+        self.url = reverse("lti:classes", args=[self.lms1.pk, self.wims.pk])
+    
+    
+    def test_classes_pages(self):
+        response = self.client.get(self.url)
+        self.assertEqual(["Algebra", "analysis"], [c.name for c in response.context["classes"]])
+        self.assertContains(response, "page=2")
+        
+        response = self.client.get(self.url, {"page": 2})
+        self.assertEqual(["Geometry"], [c.name for c in response.context["classes"]])
+        
+        response = self.client.get(self.url, {"page": "invalid"})
+        self.assertEqual(["Algebra", "analysis"], [c.name for c in response.context["classes"]])
+    
+    
+    def test_classes_search(self):
+        response = self.client.get(self.url, {"q": "AN"})
+        self.assertEqual(["analysis"], [c.name for c in response.context["classes"]])
+        
+        response = self.client.get(self.url, {"q": "9003"})
+        self.assertEqual(["Geometry"], [c.name for c in response.context["classes"]])
+        
+        response = self.client.get(self.url, {"q": "lgebra"})
+        self.assertContains(response, "No class matches this search.")
+    
+    
+    def test_classes_lms_filter(self):
+        response = self.client.get(self.url, {"lms": self.lms2.pk})
+        self.assertEqual(["Geometry"], [c.name for c in response.context["classes"]])
+        
+        response = self.client.get(self.url, {"lms": "invalid"})
+        self.assertEqual(2, len(response.context["classes"]))
+    
+    
+    def test_classes_conditional_get(self):
+        response = self.client.get(self.url)
+        self.assertIn("no-cache", response["Cache-Control"])
+        etag = response["ETag"]
+        
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+        self.assertEqual(304, response.status_code)
+        
+        WimsClass.objects.filter(name="Geometry").get().save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response["ETag"])
+        
+        WimsClass.objects.filter(name="Geometry").delete()
+        self.assertNotEqual(response["ETag"], self.client.get(self.url)["ETag"])
+
+
+
 class ActivitiesTestCase(BaseLinksViewTestCase):
     
     def test_activities(self):
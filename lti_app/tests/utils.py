@@ -8,19 +8,21 @@
 
 import os
 import subprocess
+from typing import Callable
+from unittest import mock
 
 from django.conf import settings
+from django.core.cache import cache
 from django.test import Client, LiveServerTestCase, TestCase
 from django.urls import reverse
 from wimsapi import Class, Exam, Sheet, User
 
 from lti_app.models import (LMS, WIMS, WimsClass, WimsExam,
                             WimsSheet, WimsUser)
+from lti_app.stub import StubWims
+from lti_app.tests.cassettes import CassetteMixin, WIMS_URL, replaying
 
 
-# URL to the WIMS server used for tests, the server must recognise ident 'myself' and passwd 'toto'
-WIMS_URL = os.getenv("WIMS_URL") or "http://localhost:7777/wims/wims.cgi"
-
 # Credentials of LMS and WIMS
 KEY = 'provider1'
 SECRET = 'secret1'
@@ -46,7 +48,12 @@ def command(cmd):
 
 def untar_archive():
     """Deploy the archive 'resources/6948902.tgz' into the WIMS class (assuming its running in a
-    container called 'wims') and return its qclass."""
+    container called 'wims') and return its qclass.
+    
+    Nothing is deployed when the calls to WIMS are replayed, see lti_app.tests.cassettes."""
+    if replaying():
+        return 6948902
+    
     archive = os.path.join(os.path.dirname(__file__), "resources/6948902.tgz")
     command("docker cp %s wims-minimal:/home/wims/log/classes/" % archive)
     command('docker exec wims-minimal bash -c '
@@ -65,7 +72,40 @@ urlconf = __import__(settings.ROOT_URLCONF, {}, {}, [''])
 
 
 
-class BaseLinksViewTestCase(TestCase):
+class StubWimsMixin:
+    """Mixin of test cases sending their calls to WIMS to a StubWims, available as self.stub, the
+    cache being cleared before each test.
+    
+    Unless create_servers is False, the LMS self.lms and the WIMS server self.wims of the stub are
+    created as well."""
+    
+    # Whether self.lms and self.wims are created, which requires a database.
+    create_servers = True
+    
+    
+    def stub_post(self) -> Callable:
+        """Returns the function replacing wimsapi.api.post, sending the calls to self.stub."""
+        return self.stub
+    
+    
+    def setUp(self) -> None:
+        super().setUp()
+        cache.clear()
+        self.stub = StubWims()
+        patcher = mock.patch("wimsapi.api.post", self.stub_post())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        
+        if self.create_servers:
+            self.lms = LMS.objects.create(guid="elearning.upem.fr",
+                                          url="https://elearning.u-pem.fr/", name="Moodle UPEM",
+                                          key=KEY, secret=SECRET)
+            self.wims = WIMS.objects.create(url="http://stub.wims/wims.cgi", name="WIMS UPEM",
+                                            ident="myself", passwd="toto", rclass="myclass")
+
+
+
+class BaseLinksViewTestCase(CassetteMixin, TestCase):
     
     @classmethod
     def setUpTestData(cls):
@@ -113,7 +153,7 @@ class BaseLinksViewTestCase(TestCase):
 
 
 
-class BaseGradeLinksViewTestCase(LiveServerTestCase):
+class BaseGradeLinksViewTestCase(CassetteMixin, LiveServerTestCase):
     
     def setUp(self):
         self.client = Client()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#
+#  tracing.py
+#
+#  Authors:
+#       - Coumes Quentin <coumes.quentin@gmail.com>
+#
+
+"""Trace the adm/raw calls sent to the WIMS servers.
+
+wimsapi.api.post is replaced when the application starts (see instrument()), so that every call
+is observed whatever the wimsapi object sending it. The duration, outcome and response size of
+each call are added to the metrics (see lti_app.metrics).
+
+A fraction settings.WIMS_TRACE_SAMPLE_RATE of the calls, along with every failed or slow call, is
+also kept as a trace in a buffer of the last settings.WIMS_TRACE_BUFFER_SIZE traces of the
+process. The buffer can be queried with traces() and dumped as NDJSON (see dump()). If
+settings.WIMS_TRACE_FILE is set, kept traces are also appended to this file."""
+
+import functools
+import json
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional
+
+import requests
+from django.conf import settings
+
+from lti_app import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Last traces kept by this process.
+BUFFER: Deque[Dict[str, Any]] = deque(maxlen=settings.WIMS_TRACE_BUFFER_SIZE)
+
+
+
+def _outcome(response: Any) -> Dict[str, Any]:
+    """Returns the outcome and the size of <response> to an adm/raw call, and the message of the
+    WIMS server if it returned an error."""
+    text = response.text or ""
+    try:
+        content = response.json()
+        status, message = content.get("status"), content.get("message")
+    except (ValueError, AttributeError):
+        status, _, message = text.partition("\n")
+        status = status.split(" ", 1)[0]
+    
+    return {
+        "outcome": "ok" if status == "OK" else "error",
+        "size":    len(response.content),
+        "message": None if status == "OK" else (message or "")[:200],
+    }
+
+
+
+def keep(trace: Dict[str, Any]) -> None:
+    """Keep <trace> in the buffer and, if set, in settings.WIMS_TRACE_FILE."""
+    BUFFER.append(trace)
+    if settings.WIMS_TRACE_FILE:
+        try:
+            with open(settings.WIMS_TRACE_FILE, "a") as f:
+                f.write(json.dumps(trace) + "\n")
+        except OSError:
+            logger.exception("Could not write the trace to '%s'" % settings.WIMS_TRACE_FILE)
+
+
+
+def traced_post(post: Callable) -> Callable:
+    """Returns <post> (wimsapi.api.post) tracing each adm/raw call.
+
+    The outcome of a call is 'ok' or 'error' according to the status of the response, 'timeout'
+    or 'unreachable' if the WIMS server could not be joined."""
+    
+    @functools.wraps(post)
+    def wrapper(url: str, **kwargs: Any) -> Any:
+        data = kwargs.get("data", {})
+        trace = {
+            "time":    time.time(),
+            "wims":    url,
+            "job":     data.get("job", ""),
+            "qclass":  data.get("qclass"),
+            "timeout": kwargs.get("timeout"),
+            "size":    0,
+            "message": None,
+        }
+        
+        start = time.perf_counter()
+        try:
+            response = post(url, **kwargs)
+            trace.update(_outcome(response))
+            return response
+        except requests.Timeout as e:
+            trace.update(outcome="timeout", message=str(e)[:200])
+            raise
+        except requests.RequestException as e:
+            trace.update(outcome="unreachable", message=str(e)[:200])
+            raise
+        finally:
+            trace.setdefault("outcome", "error")
+            trace["duration"] = time.perf_counter() - start
+            
+            metrics.observe("lti_wims_call_seconds", trace["duration"], wims=url,
+                            job=trace["job"], outcome=trace["outcome"])
+            metrics.inc("lti_wims_response_bytes_total", trace["size"], wims=url,
+                        job=trace["job"])
+            if (trace["outcome"] != "ok"
+                    or trace["duration"] >= settings.WIMS_TRACE_SLOW_THRESHOLD
+                    or random.random() < settings.WIMS_TRACE_SAMPLE_RATE):
+                keep(trace)
+    
+    wrapper.traced = True
+    return wrapper
+
+
+
+def instrument() -> None:
+    """Replace wimsapi.api.post so that every adm/raw call is traced, see traced_post()."""
+    import wimsapi.api
+    
+    if not getattr(wimsapi.api.post, "traced", False):
+        wimsapi.api.post = traced_post(wimsapi.api.post)
+
+
+
+def traces(wims: Optional[str] = None, job: Optional[str] = None, outcome: Optional[str] = None,
+           slowest: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Returns the traces of the buffer, optionally restricted to the calls to the WIMS server
+    <wims>, of the job <job> or with the outcome <outcome>.
+
+    Traces are ordered by time, or by decreasing duration if <slowest> is given, only the
+    <slowest> slowest being returned."""
+    selected = [
+        t for t in list(BUFFER)
+        if (wims is None or t["wims"] == wims) and (job is None or t["job"] == job)
+        and (outcome is None or t["outcome"] == outcome)
+    ]
+    if slowest is not None:
+        selected = sorted(selected, key=lambda t: t["duration"], reverse=True)[:slowest]
+    return selected
+
+
+
+def dump(selected: Iterable[Dict[str, Any]]) -> Iterator[str]:
+    """Yields the NDJSON lines of the traces <selected>."""
+    for trace in selected:
+        yield json.dumps(trace) + "\n"
+
+
+
+def reset() -> None:
+    """Forget the traces of this process."""
+    BUFFER.clear()
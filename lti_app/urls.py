@@ -8,7 +8,7 @@
 from django.conf import settings
 from django.urls import path
 
-from lti_app import views
+from lti_app import api, views
 from lti_app.tests import views as test_views
 
 
@@ -18,10 +18,19 @@ urlpatterns = [
     path('lti/C<int:wims_pk>/', views.wims_class, name="wims_class"),
     path('lti/C<int:wims_pk>/S<int:sheet_pk>/', views.wims_sheet, name="wims_sheet"),
     path('lti/C<int:wims_pk>/E<int:exam_pk>/', views.wims_exam, name="wims_exam"),
+    path('lti/C<int:wims_pk>/content-items/', views.content_items_selection,
+         name="content_items"),
     path('', views.lms, name="lms"),
     path('<int:lms_pk>/', views.wims, name="wims"),
     path('<int:lms_pk>/<int:wims_pk>/', views.classes, name="classes"),
     path('<int:lms_pk>/<int:wims_pk>/<int:wclass_pk>/', views.activities, name="sheets"),
+    path('api/lms/', api.lms, name="api_lms"),
+    path('api/lms/<int:lms_pk>/wims/', api.wims, name="api_wims"),
+    path('api/lms/<int:lms_pk>/wims/<int:wims_pk>/classes/', api.classes, name="api_classes"),
+    path('api/lms/<int:lms_pk>/wims/<int:wims_pk>/classes/<int:wclass_pk>/', api.activities,
+         name="api_activities"),
+    path('metrics/', views.metrics_view, name="metrics"),
+    path('metrics/wims-traces/', views.wims_traces, name="wims_traces"),
 ]
 
 if settings.TESTING:  # pragma: no cover
@@ -10,9 +10,9 @@ import logging
 import os
 import random
 import string
-from datetime import datetime
+from datetime import date, datetime
 from string import ascii_letters, digits
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, Optional, Tuple
 
 import oauth2
 import wimsapi
@@ -23,9 +23,11 @@ from django.http import HttpRequest
 from lti.contrib.django import DjangoToolProvider
 from wimsapi import Exam, Sheet
 
+from lti_app import probes, surge
 from lti_app.enums import Role
 from lti_app.exceptions import BadRequestException
-from lti_app.models import LMS, WIMS, WimsClass, WimsExam, WimsSheet, WimsUser
+from lti_app.models import (LMS, WIMS, WimsClass, WimsExam, WimsSheet, WimsUser, lookup,
+                            upsert)
 from lti_app.validator import CustomParameterValidator, RequestValidator, validate
 
 
@@ -41,17 +43,19 @@ def is_teacher(role: Role) -> bool:
 
 
 
-def is_valid_request(request: HttpRequest) -> bool:
-    """Check whether the request is valid and is accepted by oauth2.
+def is_valid_request(request: HttpRequest,
+                     message_types: Tuple[str, ...] = ('basic-lti-launch-request',)) -> bool:
+    """Check whether the request is valid and is accepted by oauth2, its 'lti_message_type'
+    having to be one of <message_types>.
 
     Raises:
         - api.exceptions.BadRequestException if the request is invalid.
         - django.core.exceptions.PermissionDenied if signature check failed."""
     parameters = parse_parameters(request.POST)
     
-    if parameters['lti_message_type'] != 'basic-lti-launch-request':
+    if parameters['lti_message_type'] not in message_types:
         raise BadRequestException("LTI request is invalid, parameter 'lti_message_type' "
-                                  "must be equal to 'basic-lti-launch-request'")
+                                  "must be equal to '%s'" % "' or '".join(message_types))
     
     try:
         tool_provider = DjangoToolProvider.from_django_request(request=request)
@@ -70,12 +74,16 @@ def is_valid_request(request: HttpRequest) -> bool:
 
 def check_parameters(param: Dict[str, Any]) -> None:
     """Check that mandatory parameters are present (either by LTI
-    specification or required by this app)
+    specification, depending on the type of message, or required by this app)
 
     Raises api.exceptions.BadRequestException if this is not the case."""
     
-    if not all([param[i] is not None for i in settings.LTI_MANDATORY]):
-        missing = [i for i in settings.LTI_MANDATORY if param[i] is None]
+    mandatory = settings.LTI_MANDATORY
+    if param['lti_message_type'] == 'ContentItemSelectionRequest':
+        mandatory = settings.LTI_CONTENT_ITEM_MANDATORY
+    
+    if not all([param[i] is not None for i in mandatory]):
+        missing = [i for i in mandatory if param[i] is None]
         raise BadRequestException("LTI request is invalid, missing parameter(s): "
                                   + str(missing))
     
@@ -101,6 +109,10 @@ def parse_parameters(p: Dict[str, Any]) -> Dict[str, Any]:
     
     return {
         'lti_version':                            p.get('lti_version'),
+        'accept_media_types':                     p.get('accept_media_types'),
+        'accept_multiple':                        p.get('accept_multiple'),
+        'accept_presentation_document_targets':   p.get('accept_presentation_document_targets'),
+        'content_item_return_url':                p.get('content_item_return_url'),
         'context_id':                             p.get('context_id'),
         'context_label':                          p.get('context_label'),
         'context_title':                          p.get('context_title'),
@@ -113,6 +125,7 @@ def parse_parameters(p: Dict[str, Any]) -> Dict[str, Any]:
         'custom_canvas_membership_roles':         p.get('custom_canvas_membership_roles', ''),
         'custom_canvas_user_id':                  p.get('custom_canvas_user_id'),
         'custom_canvas_user_login_id':            p.get('custom_canvas_user_login_id'),
+        'data':                                   p.get('data'),
         'launch_presentation_css_url':            p.get('launch_presentation_css_url'),
         'launch_presentation_document_target':    p.get('launch_presentation_document_target'),
         'launch_presentation_height':             p.get('launch_presentation_height'),
@@ -238,6 +251,26 @@ def create_class(wims_srv: WIMS, params: Dict[str, Any]) -> wimsapi.Class:
 
 
 
+def parse_expiration(expiration: str) -> Optional[date]:
+    """Returns the date corresponding to the expiration of a WIMS class ('YYYYMMDD'), None if it
+    cannot be parsed."""
+    try:
+        return datetime.strptime(str(expiration), "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+
+def sync_expiration(wclass_db: WimsClass, wclass: wimsapi.Class) -> None:
+    """Update the expiration date of <wclass_db> if it changed on the WIMS server (e.g. extended
+    by its supervisor), writing nothing otherwise."""
+    expiration = parse_expiration(wclass.expiration)
+    if expiration is not None and wclass_db.expiration != expiration:
+        WimsClass.objects.filter(pk=wclass_db.pk).update(expiration=expiration)
+        wclass_db.expiration = expiration
+
+
+
 def generate_mail(wclass_db: WimsClass, wclass: wimsapi.Class) -> Tuple[str, str]:
     """Returns the title and the body of the credentials mail corresponding to
     the language of the class."""
@@ -287,11 +320,12 @@ def get_or_create_class(lms: LMS, wims_srv: WIMS, wapi: wimsapi.WimsAPI,
     wclass an instance of wimsapi.Class."""
     try:
         wclass_db = WimsClass.objects.get(wims=wims_srv, lms=lms,
-                                          lms_guid=parameters['context_id'])
+                                          **lookup("lms_guid", parameters['context_id']))
         
         try:
             wclass = wimsapi.Class.get(wapi.url, wapi.ident, wapi.passwd, wclass_db.qclass,
                                        wims_srv.rclass)
+            sync_expiration(wclass_db, wclass)
         except wimsapi.WimsAPIError as e:
             if "not existing" in str(e):  # Class was deleted on the WIMS server
                 logger.info(("Deleting class (id : %d - wims id : %s - lms id : %s) as it was"
@@ -315,7 +349,8 @@ def get_or_create_class(lms: LMS, wims_srv: WIMS, wapi: wimsapi.WimsAPI,
         wclass.save(wapi.url, wapi.ident, wapi.passwd, timeout=settings.WIMSAPI_TIMEOUT)
         wclass_db = WimsClass.objects.create(
             lms=lms, lms_guid=parameters["context_id"],
-            wims=wims_srv, qclass=wclass.qclass, name=wclass.name
+            wims=wims_srv, qclass=wclass.qclass, name=wclass.name,
+            expiration=parse_expiration(wclass.expiration)
         )
         logger.info("New class created (id : %d - wims id : %s - lms id : %s)"
                     % (wclass_db.id, str(wclass.qclass), str(wclass_db.lms_guid)))
@@ -389,13 +424,46 @@ def create_user(parameters: Dict[str, Any]) -> wimsapi.User:
 
 
 
-def get_or_create_user(wclass_db: WimsClass, wclass: wimsapi.Class, parameters: Dict[str, Any]
-                       ) -> Tuple[WimsUser, wimsapi.User]:
+def add_user(wclass: wimsapi.Class, parameters: Dict[str, Any]) -> wimsapi.User:
+    """Create the user corresponding to the given LTI request's parameters on the WIMS server,
+    appending an integer to its quser (jdoe, jdoe1, jdoe2, ...) as long as it is already taken.
+
+    Raises:
+        - wimsapi.WimsAPIError if the WIMS' server denied a request.
+        - requests.RequestException if the WIMS server could not be joined.
+
+    Returns the created wimsapi.User."""
+    user = create_user(parameters)
+    
+    i = 0
+    while True:
+        try:
+            wclass.additem(user)
+            return user
+        except wimsapi.WimsAPIError as e:
+            # Raised if an user with the same quser already exists,
+            # in this case, keep trying by appending integer to quser (jdoe, jdoe1,
+            # jdoe2, ...), stopping after 100 tries.
+            
+            # Can also be raised if an error occurred while communicating with the
+            # WIMS server, hence the following test.
+            if "user already exists" not in str(e) or i >= 100:  # pragma: no cover
+                raise
+            user.quser = increment_wims_username(user.quser)
+            i += 1
+
+
+
+def get_or_create_user(wclass_db: WimsClass, wclass: wimsapi.Class, parameters: Dict[str, Any],
+                       fetch: bool = True) -> Tuple[WimsUser, Optional[wimsapi.User]]:
     """Get the WIMS' user database and wimsapi.User instances, create them if they does not
     exists.
 
     If at least one of the roles in the LTI request's parameters is in
     ROLES_ALLOWED_CREATE_WIMS_CLASS, the user will be connected as supervisor.
+    
+    If <fetch> is False, the existence of an already known user on the WIMS server is only
+    checked (see lti_app.probes) and None is returned instead of its wimsapi.User.
 
     Raises:
         - wimsapi.WimsAPIError if the WIMS' server denied a request.
@@ -406,29 +474,19 @@ def get_or_create_user(wclass_db: WimsClass, wclass: wimsapi.Class, parameters:
     try:
         role = Role.parse_role_lti(parameters["roles"])
         if is_teacher(role):
-            user_db = WimsUser.objects.get(lms_guid=None, wclass=wclass_db)
+            user_db = WimsUser.objects.get(wclass=wclass_db, **lookup("lms_guid", None))
+        else:
+            user_db = WimsUser.objects.get(wclass=wclass_db,
+                                           **lookup("lms_guid", parameters['user_id']))
+        if fetch:
+            user = wimsapi.User.get(wclass, user_db.quser)
+        elif probes.user_exists(wclass_db.wims, wclass_db.qclass, user_db.quser):
+            user = None
         else:
-            user_db = WimsUser.objects.get(lms_guid=parameters['user_id'], wclass=wclass_db)
-        user = wimsapi.User.get(wclass, user_db.quser)
+            raise wimsapi.AdmRawError("user %s not existing in class %s"
+                                      % (user_db.quser, wclass_db.qclass))
     except WimsUser.DoesNotExist:
-        user = create_user(parameters)
-        
-        i = 0
-        while True:
-            try:
-                wclass.additem(user)
-                break
-            except wimsapi.WimsAPIError as e:
-                # Raised if an user with the same quser already exists,
-                # in this case, keep trying by appending integer to quser (jdoe, jdoe1,
-                # jdoe2, ...), stopping after 100 tries.
-                
-                # Can also be raised if an error occurred while communicating with the
-                # WIMS server, hence the following test.
-                if "user already exists" not in str(e) or i >= 100:  # pragma: no cover
-                    raise
-                user.quser = increment_wims_username(user.quser)
-    
+        user = add_user(wclass, parameters)
         user_db = WimsUser.objects.create(
             lms_guid=parameters["user_id"], wclass=wclass_db, quser=user.quser
         )
@@ -452,15 +510,9 @@ def get_sheet(wclass_db: WimsClass, wclass: wimsapi.Class, qsheet: int, paramete
     sheet an instance of wimsapi.Sheet."""
     
     sheet = wclass.getitem(qsheet, Sheet)
-    try:
-        sheet_db = WimsSheet.objects.get(wclass=wclass_db, qsheet=str(qsheet))
-        sheet_db.lms_guid = parameters["resource_link_id"]
-        sheet_db.save()
-    except WimsSheet.DoesNotExist:
-        sheet_db = WimsSheet.objects.create(
-            lms_guid=parameters["resource_link_id"],
-            wclass=wclass_db, qsheet=str(qsheet)
-        )
+    sheet_db, created = upsert(WimsSheet, {"wclass": wclass_db, "qsheet": str(qsheet)},
+                               lookup("lms_guid", parameters["resource_link_id"]))
+    if created:
         logger.info("New sheet created (wims id: %s - lms id : %s) in class %d"
                     % (str(qsheet), str(sheet_db.lms_guid), wclass_db.id))
     
@@ -480,16 +532,12 @@ def get_exam(wclass_db: WimsClass, wclass: wimsapi.Class, qexam: int, parameters
     Returns a tuple (exam_db, exam) where exam_db is an instance of models.WimsExam and
     exam an instance of wimsapi.Exam."""
     
-    exam = wclass.getitem(qexam, Exam)
-    try:
-        exam_db = WimsExam.objects.get(wclass=wclass_db, qexam=str(qexam))
-        exam_db.lms_guid = parameters["resource_link_id"]
-        exam_db.save()
-    except WimsExam.DoesNotExist:
-        exam_db = WimsExam.objects.create(
-            lms_guid=parameters["resource_link_id"],
-            wclass=wclass_db, qexam=str(qexam)
-        )
+    exam = surge.cached_exam(wclass_db.wims_id, wclass_db.qclass, qexam)
+    if exam is None:
+        exam = wclass.getitem(qexam, Exam)
+    exam_db, created = upsert(WimsExam, {"wclass": wclass_db, "qexam": str(qexam)},
+                              lookup("lms_guid", parameters["resource_link_id"]))
+    if created:
         logger.info("New exam created (wims id: %s - lms id : %s) in class %d"
                     % (str(qexam), str(exam_db.lms_guid), wclass_db.id))
     
@@ -7,23 +7,34 @@
 #
 
 import logging
+from datetime import datetime
+from typing import Any, Dict, Optional
 
 import requests
 import wimsapi
 from django.conf import settings
 from django.contrib import messages
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db.models import Count, Max, Q
 from django.http import (Http404, HttpRequest, HttpResponse, HttpResponseBadRequest,
-                         HttpResponseForbidden, HttpResponseNotAllowed, HttpResponseNotFound)
+                         HttpResponseForbidden, HttpResponseNotAllowed, HttpResponseNotFound,
+                         StreamingHttpResponse)
 from django.shortcuts import redirect, render
 from django.urls import reverse
-from django.views.decorators.http import require_GET
+from django.utils.http import urlencode
+from django.views.decorators.cache import cache_control
+from django.views.decorators.clickjacking import xframe_options_exempt
+from django.views.decorators.http import condition, require_GET, require_POST
 
+from lti_app import catalog, content_items, metrics, surge, tracing
 from lti_app.enums import Role
 from lti_app.exceptions import BadRequestException
-from lti_app.models import GradeLinkExam, GradeLinkSheet, LMS, WIMS, WimsClass
+from lti_app.models import (GradeLinkExam, GradeLinkSheet, LMS, OutcomeService, WIMS, WimsClass,
+                            lookup, name_key, upsert)
 from lti_app.utils import (MODE, check_custom_parameters, check_parameters, get_exam,
                            get_or_create_class, get_or_create_user, get_sheet, is_teacher,
-                           is_valid_request, parse_parameters)
+                           is_valid_request, parse_parameters, sync_expiration)
 
 
 logger = logging.getLogger(__name__)
@@ -39,10 +50,12 @@ This is usually caused by one of the following reason:
 
 
 
+@metrics.launch("wims_class")
 def wims_class(request: HttpRequest, wims_pk: int) -> HttpResponse:
     """Redirect the client to the WIMS server corresponding to <pk>.
 
     Will retrieve/create the right WIMS' class/user according to informations in request.POST.
+    Content-Item selection requests are handled by select_content_items().
 
     Raises:
         - Http404 if no LMS corresponding to request.POST["tool_consumer_instance_guid"]
@@ -65,7 +78,8 @@ def wims_class(request: HttpRequest, wims_pk: int) -> HttpResponse:
         parameters = parse_parameters(request.POST)
         logger.info("Request received from '%s'" % request.META.get('HTTP_REFERER', "Unknown"))
         check_parameters(parameters)
-        is_valid_request(request)
+        is_valid_request(request, ('basic-lti-launch-request', content_items.SELECTION_REQUEST))
+        request.timing.lap("oauth")
     except BadRequestException as e:
         logger.info(str(e))
         return HttpResponseBadRequest(str(e))
@@ -78,10 +92,15 @@ def wims_class(request: HttpRequest, wims_pk: int) -> HttpResponse:
     
     # Retrieve the LMS
     try:
-        lms = LMS.objects.get(guid=parameters["tool_consumer_instance_guid"])
+        lms = LMS.objects.get(**lookup("guid", parameters["tool_consumer_instance_guid"]))
     except LMS.DoesNotExist:
         raise Http404("No LMS found with guid '%s'" % parameters["tool_consumer_instance_guid"])
     
+    request.timing.lap("lookup")
+    
+    if parameters["lti_message_type"] == content_items.SELECTION_REQUEST:
+        return select_content_items(request, lms, wims_srv, parameters)
+    
     wapi = wimsapi.WimsAPI(wims_srv.url, wims_srv.ident, wims_srv.passwd)
     
     try:
@@ -89,23 +108,27 @@ def wims_class(request: HttpRequest, wims_pk: int) -> HttpResponse:
         bol, response = wapi.checkident(verbose=True)
         if not bol:
             raise wimsapi.WimsAPIError(response['message'])
+        request.timing.lap("checkident")
         
         # Check whether the class already exists, creating it otherwise
         wclass_db, wclass = get_or_create_class(lms, wims_srv, wapi, parameters)
+        request.timing.lap("class")
         
         # Check whether the user already exists, creating it otherwise
-        user_db, user = get_or_create_user(wclass_db, wclass, parameters)
+        user_db, _ = get_or_create_user(wclass_db, wclass, parameters, fetch=False)
+        request.timing.lap("user")
         
         # Trying to authenticate the user on the WIMS server
-        bol, response = wapi.authuser(wclass.qclass, wclass.rclass, user.quser)
+        bol, response = wapi.authuser(wclass.qclass, wclass.rclass, user_db.quser)
         if not bol:  # pragma: no cover
             raise wimsapi.WimsAPIError(response['message'])
+        request.timing.lap("authuser")
         url = response["home_url"] + ("&lang=%s" % wclass.lang)
     
     except wimsapi.WimsAPIError as e:  # WIMS server responded with ERROR
         logger.info(str(e))
         return HttpResponse(str(e), status=502)
-
+    
     except BadRequestException as e:
         logger.info(str(e))
         return HttpResponseBadRequest(str(e))
@@ -118,6 +141,110 @@ def wims_class(request: HttpRequest, wims_pk: int) -> HttpResponse:
 
 
 
+@xframe_options_exempt
+def select_content_items(request: HttpRequest, lms: LMS, wims_srv: WIMS,
+                         parameters: Dict[str, Any]) -> HttpResponse:
+    """Display the sheets and exams of the class corresponding to the Content-Item selection
+    request <parameters>, creating the class if needed, so that the teacher selects those returned
+    to the LMS (see content_items_selection()).
+
+    Raises PermissionDenied if the roles in <parameters> are not one of
+    settings.ROLES_ALLOWED_CREATE_WIMS_CLASS.
+
+    Returns:
+        - HttpResponse(status=400) if the LMS does not accept LTI links.
+        - HttpResponse(status=502) if an error occured while communicating with the WIMS server.
+        - HttpResponse(status=504) if the WIMS server could not be joined."""
+    role = Role.parse_role_lti(parameters["roles"])
+    if not is_teacher(role):
+        raise PermissionDenied("You must have at least one of these roles to select sheets and "
+                               "exams: %s. Your roles: %s"
+                               % (str([r.value for r in settings.ROLES_ALLOWED_CREATE_WIMS_CLASS]),
+                                  str([r.value for r in role])))
+    
+    try:
+        content_items.check_request(parameters)
+        try:
+            wclass_db = WimsClass.objects.get(wims=wims_srv, lms=lms,
+                                              **lookup("lms_guid", parameters['context_id']))
+        except WimsClass.DoesNotExist:
+            wapi = wimsapi.WimsAPI(wims_srv.url, wims_srv.ident, wims_srv.passwd)
+            wclass_db, _ = get_or_create_class(lms, wims_srv, wapi, parameters)
+        activities = catalog.get(wims_srv, wclass_db.qclass)
+    
+    except BadRequestException as e:
+        logger.info(str(e))
+        return HttpResponseBadRequest(str(e))
+    
+    except wimsapi.WimsAPIError as e:  # WIMS server responded with ERROR
+        logger.info(str(e))
+        return HttpResponse(str(e), status=502)
+    
+    except requests.RequestException:
+        logger.exception("Could not join the WIMS server '%s'" % wims_srv.url)
+        return HttpResponse("Could not join the WIMS server '%s'" % wims_srv.url, status=504)
+    
+    return render(request, "lti_app/content_items.html", {
+        "WIMS":     wims_srv,
+        "class":    wclass_db,
+        "sheets":   activities["sheets"],
+        "exams":    activities["exams"],
+        "multiple": parameters["accept_multiple"] != "false",
+        "token":    content_items.dumps(wclass_db.pk, parameters),
+    })
+
+
+
+@require_POST
+@xframe_options_exempt
+def content_items_selection(request: HttpRequest, wims_pk: int) -> HttpResponse:
+    """Return the sheets and exams selected in the form displayed by select_content_items() to the
+    LMS, through a signed ContentItemSelection message automatically posted by the client.
+
+    Returns:
+        - HttpResponse(status=400) if the selection is invalid or expired.
+        - HttpResponse(status=502) if an error occured while communicating with the WIMS server.
+        - HttpResponse(status=504) if the WIMS server could not be joined."""
+    try:
+        selection = content_items.loads(request.POST.get("token", ""))
+    except BadRequestException as e:
+        logger.info(str(e))
+        return HttpResponseBadRequest(str(e))
+    
+    try:
+        wclass_db = WimsClass.objects.select_related("lms", "wims").get(
+            pk=selection["wclass"], wims_id=wims_pk
+        )
+    except WimsClass.DoesNotExist:
+        raise Http404("WimsClass of ID %d Was not found on the server." % selection["wclass"])
+    
+    try:
+        activities = catalog.get(wclass_db.wims, wclass_db.qclass)
+    except wimsapi.WimsAPIError as e:  # WIMS server responded with ERROR
+        logger.info(str(e))
+        return HttpResponse(str(e), status=502)
+    except requests.RequestException:
+        logger.exception("Could not join the WIMS server '%s'" % wclass_db.wims.url)
+        return HttpResponse("Could not join the WIMS server '%s'" % wclass_db.wims.url,
+                            status=504)
+    
+    selected = set(request.POST.getlist("items"))
+    items = [
+        dict(item, lti_url=request.build_absolute_uri(item["url"]))
+        for kind in ("sheet", "exam") for item in activities[kind + "s"]
+        if "%s:%s" % (kind, item["q" + kind]) in selected
+    ]
+    if not selection["multiple"]:
+        items = items[:1]
+    
+    return render(request, "lti_app/content_items_selection.html", {
+        "url":    selection["return_url"],
+        "params": content_items.response(wclass_db.lms, selection, items),
+    })
+
+
+
+@metrics.launch("wims_sheet")
 def wims_sheet(request: HttpRequest, wims_pk: int, sheet_pk: int) -> HttpResponse:
     """Redirect the client to the WIMS server corresponding to <wims_pk> and sheet <sheet_pk>.
 
@@ -145,6 +272,7 @@ def wims_sheet(request: HttpRequest, wims_pk: int, sheet_pk: int) -> HttpRespons
         logger.info("Request received from '%s'" % request.META.get('HTTP_REFERER', "Unknown"))
         check_parameters(parameters)
         is_valid_request(request)
+        request.timing.lap("oauth")
     except BadRequestException as e:
         logger.info(str(e))
         return HttpResponseBadRequest(str(e))
@@ -157,10 +285,12 @@ def wims_sheet(request: HttpRequest, wims_pk: int, sheet_pk: int) -> HttpRespons
     
     # Retrieve the LMS
     try:
-        lms = LMS.objects.get(guid=parameters["tool_consumer_instance_guid"])
+        lms = LMS.objects.get(**lookup("guid", parameters["tool_consumer_instance_guid"]))
     except LMS.DoesNotExist:
         raise Http404("No LMS found with guid '%s'" % parameters["tool_consumer_instance_guid"])
     
+    request.timing.lap("lookup")
+    
     wapi = wimsapi.WimsAPI(wims_srv.url, wims_srv.ident, wims_srv.passwd)
     
     try:
@@ -168,16 +298,18 @@ def wims_sheet(request: HttpRequest, wims_pk: int, sheet_pk: int) -> HttpRespons
         bol, response = wapi.checkident(verbose=True)
         if not bol:
             raise wimsapi.WimsAPIError(response['message'])
+        request.timing.lap("checkident")
         
         # Get the class
         wclass_db = WimsClass.objects.get(wims=wims_srv, lms=lms,
-                                          lms_guid=parameters['context_id'])
+                                          **lookup("lms_guid", parameters['context_id']))
         
         try:
             wclass = wimsapi.Class.get(
                 wims_srv.url, wims_srv.ident, wims_srv.passwd, wclass_db.qclass, wims_srv.rclass,
                 timeout=settings.WIMSAPI_TIMEOUT
             )
+            sync_expiration(wclass_db, wclass)
         except wimsapi.WimsAPIError as e:
             if "not existing" in str(e):  # Class was deleted on the WIMS server
                 qclass = wclass_db.qclass
@@ -194,35 +326,38 @@ def wims_sheet(request: HttpRequest, wims_pk: int, sheet_pk: int) -> HttpRespons
                 )
             raise  # Unknown error (pragma: no cover)
         
+        request.timing.lap("class")
+        
         # Check whether the user already exists, creating it otherwise
-        user_db, user = get_or_create_user(wclass_db, wclass, parameters)
+        user_db, _ = get_or_create_user(wclass_db, wclass, parameters, fetch=False)
+        request.timing.lap("user")
         
         # Check whether the sheet already exists, creating it otherwise
         sheet_db, sheet = get_sheet(wclass_db, wclass, sheet_pk, parameters)
+        request.timing.lap("getitem")
         if int(sheet.sheetmode) not in [1, 2]:  # not active or expired
             return HttpResponseForbidden("This WIMS sheet (%s) is currently unavailable (%s)"
                                          % (str(sheet.qsheet), MODE[int(sheet.sheetmode)]))
         
         # Storing the URL and ID to send the grade back to the LMS
-        try:
-            gl = GradeLinkSheet.objects.get(user=user_db, activity=sheet_db)
-            gl.sourcedid = parameters["lis_result_sourcedid"]
-            gl.url = parameters["lis_outcome_service_url"]
-            gl.save()
-        except GradeLinkSheet.DoesNotExist:
-            GradeLinkSheet.objects.create(user=user_db, activity=sheet_db, lms=lms,
-                                          sourcedid=parameters["lis_result_sourcedid"],
-                                          url=parameters["lis_outcome_service_url"])
+        service = OutcomeService.get(lms, parameters["lis_outcome_service_url"])
+        upsert(GradeLinkSheet, {"user": user_db, "activity": sheet_db}, {
+            "sourcedid":  parameters["lis_result_sourcedid"],
+            "service_id": service.pk,
+        })
+        request.timing.lap("grade_link")
         
         # If user is a teacher, send all grade back to the LMS
         role = Role.parse_role_lti(parameters["roles"])
         if is_teacher(role):
             GradeLinkSheet.send_back_all(sheet_db)
+            request.timing.lap("send_back_all")
         
         # Trying to authenticate the user on the WIMS server
-        bol, response = wapi.authuser(wclass.qclass, wclass.rclass, user.quser)
+        bol, response = wapi.authuser(wclass.qclass, wclass.rclass, user_db.quser)
         if not bol:  # pragma: no cover
             raise wimsapi.WimsAPIError(response['message'])
+        request.timing.lap("authuser")
         
         params = "&lang=%s&module=adm%%2Fsheet&sh=%s" % (wclass.lang, str(sheet.qsheet))
         url = response["home_url"] + params
@@ -243,6 +378,7 @@ def wims_sheet(request: HttpRequest, wims_pk: int, sheet_pk: int) -> HttpRespons
 
 
 
+@metrics.launch("wims_exam")
 def wims_exam(request: HttpRequest, wims_pk: int, exam_pk: int) -> HttpResponse:
     """Redirect the client to the WIMS server corresponding to <wims_pk> and exam <exam_pk>.
 
@@ -270,6 +406,7 @@ def wims_exam(request: HttpRequest, wims_pk: int, exam_pk: int) -> HttpResponse:
         logger.info("Request received from '%s'" % request.META.get('HTTP_REFERER', "Unknown"))
         check_parameters(parameters)
         is_valid_request(request)
+        request.timing.lap("oauth")
     except BadRequestException as e:
         logger.info(str(e))
         return HttpResponseBadRequest(str(e))
@@ -282,27 +419,39 @@ def wims_exam(request: HttpRequest, wims_pk: int, exam_pk: int) -> HttpResponse:
     
     # Retrieve the LMS
     try:
-        lms = LMS.objects.get(guid=parameters["tool_consumer_instance_guid"])
+        lms = LMS.objects.get(**lookup("guid", parameters["tool_consumer_instance_guid"]))
     except LMS.DoesNotExist:
         raise Http404("No LMS found with guid '%s'" % parameters["tool_consumer_instance_guid"])
     
+    request.timing.lap("lookup")
+    
     wapi = wimsapi.WimsAPI(wims_srv.url, wims_srv.ident, wims_srv.passwd)
     
     try:
-        # Check that the WIMS server is available
-        bol, response = wapi.checkident(verbose=True)
-        if not bol:
-            raise wimsapi.WimsAPIError(response['message'])
+        wclass_db = WimsClass.objects.filter(
+            wims=wims_srv, lms=lms, **lookup("lms_guid", parameters['context_id'])
+        ).first()
+        
+        # Check that the WIMS server is available, unless done by the warm-up of a surge of this
+        # exam
+        if wclass_db is None or not surge.healthy(wims_srv.pk, wclass_db.qclass, exam_pk):
+            bol, response = wapi.checkident(verbose=True)
+            if not bol:
+                raise wimsapi.WimsAPIError(response['message'])
+            request.timing.lap("checkident")
         
         # Get the class
-        wclass_db = WimsClass.objects.get(wims=wims_srv, lms=lms,
-                                          lms_guid=parameters['context_id'])
+        if wclass_db is None:
+            raise WimsClass.DoesNotExist("WimsClass matching query does not exist.")
         
         try:
-            wclass = wimsapi.Class.get(
-                wims_srv.url, wims_srv.ident, wims_srv.passwd, wclass_db.qclass, wims_srv.rclass,
-                timeout=settings.WIMSAPI_TIMEOUT
-            )
+            wclass = surge.cached_class(wims_srv, wclass_db.qclass)
+            if wclass is None:
+                wclass = wimsapi.Class.get(
+                    wims_srv.url, wims_srv.ident, wims_srv.passwd, wclass_db.qclass,
+                    wims_srv.rclass, timeout=settings.WIMSAPI_TIMEOUT
+                )
+                sync_expiration(wclass_db, wclass)
         except wimsapi.WimsAPIError as e:
             if "not existing" in str(e):  # Class was deleted on the WIMS server
                 qclass = wclass_db.qclass
@@ -319,35 +468,38 @@ def wims_exam(request: HttpRequest, wims_pk: int, exam_pk: int) -> HttpResponse:
                 )
             raise  # Unknown error (pragma: no cover)
         
+        request.timing.lap("class")
+        
         # Check whether the user already exists, creating it otherwise
-        user_db, user = get_or_create_user(wclass_db, wclass, parameters)
+        user_db, _ = get_or_create_user(wclass_db, wclass, parameters, fetch=False)
+        request.timing.lap("user")
         
         # Check whether the exam already exists, creating it otherwise
         exam_db, exam = get_exam(wclass_db, wclass, exam_pk, parameters)
+        request.timing.lap("getitem")
         if int(exam.exammode) not in [1, 2]:  # not active or expired
             return HttpResponseForbidden("This exam (%s) is currently unavailable (%s)"
                                          % (str(exam.qexam), MODE[int(exam.exammode)]))
         
         # Storing the URL and ID to send the grade back to the LMS
-        try:
-            gl = GradeLinkExam.objects.get(user=user_db, activity=exam_db)
-            gl.sourcedid = parameters["lis_result_sourcedid"]
-            gl.url = parameters["lis_outcome_service_url"]
-            gl.save()
-        except GradeLinkExam.DoesNotExist:
-            GradeLinkExam.objects.create(user=user_db, activity=exam_db, lms=lms,
-                                         sourcedid=parameters["lis_result_sourcedid"],
-                                         url=parameters["lis_outcome_service_url"])
+        service = OutcomeService.get(lms, parameters["lis_outcome_service_url"])
+        upsert(GradeLinkExam, {"user": user_db, "activity": exam_db}, {
+            "sourcedid":  parameters["lis_result_sourcedid"],
+            "service_id": service.pk,
+        })
+        request.timing.lap("grade_link")
         
         # If user is a teacher, send all grade back to the LMS
         role = Role.parse_role_lti(parameters["roles"])
         if is_teacher(role):
             GradeLinkExam.send_back_all(exam_db)
+            request.timing.lap("send_back_all")
         
         # Trying to authenticate the user on the WIMS server
-        bol, response = wapi.authuser(wclass.qclass, wclass.rclass, user.quser)
+        bol, response = wapi.authuser(wclass.qclass, wclass.rclass, user_db.quser)
         if not bol:  # pragma: no cover
             raise wimsapi.WimsAPIError(response['message'])
+        request.timing.lap("authuser")
         
         params = ("&lang=%s&module=adm%%2Fclass%%2Fexam&+job=student&+exam=%s"
                   % (wclass.lang, str(exam.qexam)))
@@ -388,13 +540,59 @@ def wims(request: HttpRequest, lms_pk: int) -> HttpResponse:
 
 
 
+def classes_version(request: HttpRequest, lms_pk: int, wims_pk: int) -> Dict[str, Any]:
+    """Returns the number of classes on the <wims_pk> server ('count') and the time of the latest
+    change of one of them ('modified'), computed once per request."""
+    if not hasattr(request, "classes_version"):
+        request.classes_version = WimsClass.objects.filter(wims_id=wims_pk).aggregate(
+            count=Count("pk"), modified=Max("modified")
+        )
+    return request.classes_version
+
+
+
+def classes_etag(request: HttpRequest, lms_pk: int, wims_pk: int) -> str:
+    """Returns the ETag of the list of the classes on the <wims_pk> server."""
+    version = classes_version(request, lms_pk, wims_pk)
+    modified = version["modified"].timestamp() if version["modified"] else 0
+    return "%d-%f" % (version["count"], modified)
+
+
+
+def classes_last_modified(request: HttpRequest, lms_pk: int, wims_pk: int) -> Optional[datetime]:
+    """Returns the time of the latest change of the classes on the <wims_pk> server."""
+    return classes_version(request, lms_pk, wims_pk)["modified"]
+
+
+
 @require_GET
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=classes_etag, last_modified_func=classes_last_modified)
 def classes(request: HttpRequest, lms_pk: int, wims_pk: int) -> HttpResponse:
-    """Display the list the WIMS classes on the <wims_pk> server."""
+    """Display a page of the list the WIMS classes on the <wims_pk> server, sorted by name.
+    
+    The query string may contain a search ('q', matching the start of the name of the classes
+    or their exact qclass), the pk of the LMS the classes must belong to ('lms') and the number of
+    the page ('page')."""
+    search = request.GET.get("q", "").strip()
+    lms_filter = request.GET.get("lms", "")
+    
+    queryset = WimsClass.objects.filter(wims_id=wims_pk)
+    if search:
+        queryset = queryset.filter(Q(name_key__startswith=name_key(search)) | Q(qclass=search))
+    if lms_filter.isdigit():
+        queryset = queryset.filter(lms_id=int(lms_filter))
+    queryset = queryset.only("pk", "name", "lms_guid", "qclass").order_by("name_key", "pk")
+    
+    page = Paginator(queryset, settings.CLASSES_PER_PAGE).get_page(request.GET.get("page"))
     return render(request, "lti_app/classes.html", {
-        "LMS":     LMS.objects.get(pk=lms_pk),
-        "WIMS":    WIMS.objects.get(pk=wims_pk),
-        "classes": WimsClass.objects.filter(wims__pk=wims_pk),
+        "LMS":        LMS.objects.get(pk=lms_pk),
+        "WIMS":       WIMS.objects.get(pk=wims_pk),
+        "LMSs":       LMS.objects.only("pk", "name").order_by("name"),
+        "classes":    page,
+        "search":     search,
+        "lms_filter": lms_filter,
+        "query":      urlencode({"q": search, "lms": lms_filter}),
     })
 
 
@@ -403,16 +601,13 @@ def classes(request: HttpRequest, lms_pk: int, wims_pk: int) -> HttpResponse:
 def activities(request: HttpRequest, lms_pk: int, wims_pk: int, wclass_pk: int) -> HttpResponse:
     """Display the list of WIMS worksheet and exam in <wclass_pk> WIMS class."""
     try:
-        class_srv = WimsClass.objects.get(pk=wclass_pk)
+        class_srv = WimsClass.objects.select_related("lms", "wims").get(pk=wclass_pk)
     except WimsClass.DoesNotExist:
         return HttpResponseNotFound("WimsClass of ID %d Was not found on the server." % wclass_pk)
     
     try:
         try:
-            wclass = wimsapi.Class.get(
-                class_srv.wims.url, class_srv.wims.ident, class_srv.wims.passwd, class_srv.qclass,
-                class_srv.wims.rclass, timeout=settings.WIMSAPI_TIMEOUT
-            )
+            activities = catalog.get(class_srv.wims, class_srv.qclass)
         except wimsapi.WimsAPIError as e:
             # Delete the class if it does not exists on the server anymore
             if "class %s not existing" % str(class_srv.qclass) in str(e):
@@ -424,20 +619,6 @@ def activities(request: HttpRequest, lms_pk: int, wims_pk: int, wclass_pk: int)
                 )
                 class_srv.delete()
             raise  # WIMS server responded with ERROR (pragma: no cover)
-        sheets = wclass.listitem(wimsapi.Sheet)
-        
-        for s in sheets:
-            s.lti_url = request.build_absolute_uri(
-                reverse("lti:wims_sheet", args=[wims_pk, s.qsheet])
-            )
-            s.sheetmode = MODE[int(s.sheetmode)]
-        
-        exams = wclass.listitem(wimsapi.Exam)
-        for e in exams:
-            e.lti_url = request.build_absolute_uri(
-                reverse("lti:wims_exam", args=[wims_pk, e.qexam])
-            )
-            e.exammode = MODE[int(e.exammode)]
     
     except wimsapi.InvalidResponseError as e:  # WIMS server responded with ERROR (pragma: no cover)
         logger.info(str(e), str(e.response))
@@ -453,12 +634,57 @@ def activities(request: HttpRequest, lms_pk: int, wims_pk: int, wclass_pk: int)
     
     else:  # No exception occured
         return render(request, "lti_app/activities.html", {
-            "LMS":    LMS.objects.get(pk=lms_pk),
-            "WIMS":   WIMS.objects.get(pk=wims_pk),
-            "class":  WimsClass.objects.get(pk=wclass_pk),
-            "sheets": sheets,
-            "exams":  exams,
+            "LMS":    class_srv.lms,
+            "WIMS":   class_srv.wims,
+            "class":  class_srv,
+            "sheets": [
+                dict(s, lti_url=request.build_absolute_uri(s["url"]))
+                for s in activities["sheets"]
+            ],
+            "exams":  [
+                dict(e, lti_url=request.build_absolute_uri(e["url"]))
+                for e in activities["exams"]
+            ],
         })
     
     # An exception occured
     return redirect('lti:classes', lms_pk=lms_pk, wims_pk=wims_pk)  # pragma: no cover
+
+
+
+def check_metrics_access(request: HttpRequest) -> None:
+    """Raises PermissionDenied if the client's address is not in settings.METRICS_ALLOWED_IPS."""
+    if request.META.get("REMOTE_ADDR") not in settings.METRICS_ALLOWED_IPS:
+        raise PermissionDenied("Metrics can only be read from %s"
+                               % ", ".join(settings.METRICS_ALLOWED_IPS))
+
+
+
+@require_GET
+def metrics_view(request: HttpRequest) -> HttpResponse:
+    """Display the metrics of every worker in the Prometheus text format, see lti_app.metrics.
+    
+    Raises PermissionDenied if the client's address is not in settings.METRICS_ALLOWED_IPS."""
+    check_metrics_access(request)
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+
+@require_GET
+def wims_traces(request: HttpRequest) -> StreamingHttpResponse:
+    """Stream the traces of the adm/raw calls kept by the worker answering the request as NDJSON,
+    see lti_app.tracing.
+    
+    Traces can be filtered with the 'wims', 'job' and 'outcome' GET parameters, and restricted to
+    the N slowest ones with 'slowest=N'.
+    
+    Raises PermissionDenied if the client's address is not in settings.METRICS_ALLOWED_IPS."""
+    check_metrics_access(request)
+    try:
+        slowest = int(request.GET["slowest"]) if "slowest" in request.GET else None
+    except ValueError:
+        return HttpResponseBadRequest("Parameter 'slowest' must be an integer")
+    
+    selected = tracing.traces(request.GET.get("wims"), request.GET.get("job"),
+                              request.GET.get("outcome"), slowest)
+    return StreamingHttpResponse(tracing.dump(selected), content_type="application/x-ndjson")
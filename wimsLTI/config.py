@@ -72,22 +72,46 @@ SEND_GRADE_BACK_CRON_TRIGGER = CronTrigger(
     hour="7, 19",
     minute="0",
     second="0",
+    jitter=60,
 )
 
 # The CronTrigger triggering the job checking that for every class registered on wims-lti, the
 # corresponding class exists on its WIMS server, deleting the instance on wims-lti if not, see
 # # https://apscheduler.readthedocs.io/en/latest/modules/triggers/cron.html for more information.
+# Should not fire while the job sending grades back is still running (see SCHEDULED_JOBS_WINDOW).
 CHECK_CLASSES_EXISTS_CRON_TRIGGER = CronTrigger(
     year="*",
     month="*",
     day="*",
     week="*",
     day_of_week="*",
-    hour="7, 19",
+    hour="6, 18",
     minute="0",
     second="0",
+    jitter=60,
 )
 
+# Database used by wims-lti. SQLite (the default, see settings.py) is fine for small instances, a
+# PostgreSQL server is recommended as soon as many launches may happen concurrently. Connections are
+# kept open for CONN_MAX_AGE seconds, and checked at the start of each request (see
+# DATABASE_HEALTH_CHECKS in settings.py). Requires 'psycopg2' ('pip3 install psycopg2-binary').
+# Use './manage.py benchmark_db' to compare the throughput of both configurations.
+# See https://docs.djangoproject.com/en/3.1/ref/settings/#databases
+# DATABASES = {
+#     'default': {
+#         'ENGINE':       'django.db.backends.postgresql',
+#         'NAME':         'wimslti',
+#         'USER':         'wimslti',
+#         'PASSWORD':     '',
+#         'HOST':         'localhost',
+#         'PORT':         '5432',
+#         'CONN_MAX_AGE': 600,
+#         'OPTIONS':      {
+#             'connect_timeout': 5,
+#         },
+#     }
+# }
+
 # Time before requests sent to a WIMS server from wims-lti time out. Should be increased
 # if some WIMS server contains a lot of classes / users.
 WIMSAPI_TIMEOUT = 1
@@ -21,6 +21,7 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 
 import os
 import sys
+from datetime import timedelta
 
 from apscheduler.triggers.cron import CronTrigger
 from django.contrib.messages import constants as messages
@@ -83,13 +84,31 @@ WSGI_APPLICATION = 'wimsLTI.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
+#
+# Connections are kept open for CONN_MAX_AGE seconds instead of being reopened on each request.
+# See wimsLTI/config.py for an example of a production configuration using PostgreSQL.
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME':   os.path.join(BASE_DIR, 'db.sqlite3'),
+        'ENGINE':       'django.db.backends.sqlite3',
+        'NAME':         os.path.join(BASE_DIR, 'db.sqlite3'),
+        'CONN_MAX_AGE': 60,
     }
 }
 
+# PRAGMA applied to every new SQLite connection (see lti_app/db.py). WAL journaling lets launches
+# read while another one writes, busy_timeout (in milliseconds) makes concurrent writers wait for
+# the lock instead of failing with "database is locked", and synchronous=NORMAL is safe in WAL
+# mode while avoiding a fsync on every commit.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'busy_timeout': 5000,
+    'synchronous':  'NORMAL',
+}
+
+# Whether persistent database connections are checked at the start of each request, unusable ones
+# being closed and reopened instead of failing the request (see lti_app/db.py).
+DATABASE_HEALTH_CHECKS = True
+
 # Logging informations
 LOGGING = {
     'version':                  1,
@@ -153,6 +172,18 @@ LTI_MANDATORY = [
     'oauth_nonce',
     'oauth_signature',
 ]
+LTI_CONTENT_ITEM_MANDATORY = [
+    'lti_message_type',
+    'lti_version',
+    'content_item_return_url',
+    'accept_media_types',
+    'accept_presentation_document_targets',
+    'oauth_consumer_key',
+    'oauth_signature_method',
+    'oauth_timestamp',
+    'oauth_nonce',
+    'oauth_signature',
+]
 WIMSLTI_MANDATORY = [
     'context_id',
     'context_title',
@@ -213,25 +244,173 @@ SEND_GRADE_BACK_CRON_TRIGGER = CronTrigger(
     hour="7, 19",
     minute="0",
     second="0",
+    jitter=60,
 )
 
 # The CronTrigger triggering the job checking that for every class registered on wims-lti, the
 # corresponding class exists on its WIMS server, deleting the instance on wims-lti if not, see
 # # https://apscheduler.readthedocs.io/en/latest/modules/triggers/cron.html for more information.
+# Should not fire while the job sending grades back is still running (see SCHEDULED_JOBS_WINDOW).
 CHECK_CLASSES_EXISTS_CRON_TRIGGER = CronTrigger(
     year="*",
     month="*",
     day="*",
     week="*",
     day_of_week="*",
-    hour="7, 19",
+    hour="6, 18",
     minute="0",
     second="0",
+    jitter=60,
 )
 
+# The CronTrigger triggering the job probing the version and supported adm/raw jobs of the WIMS
+# servers whose capabilities are older than WIMS_CAPABILITIES_TTL, see
+# https://apscheduler.readthedocs.io/en/latest/modules/triggers/cron.html for more information.
+REFRESH_CAPABILITIES_CRON_TRIGGER = CronTrigger(
+    year="*",
+    month="*",
+    day="*",
+    week="*",
+    day_of_week="*",
+    hour="*",
+    minute="30",
+    second="0",
+    jitter=60,
+)
+
+# Time after which the capabilities of a WIMS server are probed again.
+WIMS_CAPABILITIES_TTL = timedelta(days=1)
+
+# Time after which the capabilities of a WIMS server are probed again when its last probe failed.
+WIMS_CAPABILITIES_RETRY = timedelta(hours=1)
+
+# The CronTrigger triggering the job archiving and deleting the classes expired for longer than
+# CLASS_RETENTION, see
+# https://apscheduler.readthedocs.io/en/latest/modules/triggers/cron.html for more information.
+ARCHIVE_EXPIRED_CLASSES_CRON_TRIGGER = CronTrigger(
+    year="*",
+    month="*",
+    day="*",
+    week="*",
+    day_of_week="*",
+    hour="3",
+    minute="0",
+    second="0",
+    jitter=60,
+)
+
+# The CronTrigger triggering the job warming up the exams whose surge starts within
+# SURGE_WARMUP_LEAD, see lti_app/surge.py and
+# https://apscheduler.readthedocs.io/en/latest/modules/triggers/cron.html for more information.
+WARM_UP_EXAMS_CRON_TRIGGER = CronTrigger(
+    year="*",
+    month="*",
+    day="*",
+    week="*",
+    day_of_week="*",
+    hour="*",
+    minute="*",
+    second="0",
+)
+
+# Time before the start of an exam surge at which its warm-up begins, and time after which the
+# warm-up is repeated until the end of the surge.
+SURGE_WARMUP_LEAD = timedelta(minutes=10)
+SURGE_WARMUP_REFRESH = timedelta(minutes=5)
+
+# Number of users whose existence is checked at the same time during the warm-up of an exam.
+SURGE_WARMUP_CONCURRENCY = 8
+
+# Time during which a class is kept after its expiration date on its WIMS server, see
+# lti_app/retention.py.
+CLASS_RETENTION = timedelta(days=180)
+
+# Directory where expired classes are archived (as gzipped JSON lines) before being deleted. Set
+# to None to delete them without archiving.
+ARCHIVE_ROOT = os.path.join(BASE_DIR, "archives")
+
+# Duration (in seconds) over which each scheduled job spreads its work. Every WIMS server is given
+# an offset and every class a slot in this window, both derived from a hash, and jobs process
+# them in this order, pacing themselves to end within the window instead of sending every
+# request at once.
+SCHEDULED_JOBS_WINDOW = 60 * 45
+
+# Maximum duration (in seconds) of a run of a scheduled job. Once exceeded, the job stops after its
+# current item and saves the position it reached on each WIMS server, the next run resuming from
+# there. Should be greater than SCHEDULED_JOBS_WINDOW.
+SCHEDULED_JOBS_TIME_BUDGET = 60 * 55
+
+# Maximum duration (in seconds) a run of a scheduled job can spend on a single WIMS server, the
+# remaining items of this server being left for the next run. Prevents a slow or hung server from
+# stalling the job for every other server.
+SCHEDULED_JOBS_SERVER_TIME_BUDGET = 60 * 15
+
+# Number of rows fetched at once from the database by the scheduled jobs, bounding their memory
+# usage regardless of the size of the tables.
+SCHEDULED_JOBS_CHUNK_SIZE = 500
+
+# Number of rows above which the admin estimates the size of a table from the statistics of the
+# database instead of counting its rows, see lti_app/admin.py.
+ADMIN_ESTIMATED_COUNT_THRESHOLD = 100000
+
+# Time (in seconds) during which a positive answer of a WIMS server about the existence of a class,
+# user, sheet or exam is cached, see lti_app/probes.py.
+WIMS_PROBE_CACHE_TTL = 60
+
+# Number of classes displayed per page when browsing the classes of a WIMS server.
+CLASSES_PER_PAGE = 50
+
+# Time (in seconds) a teacher has to select the sheets and exams returned to the LMS after a
+# Content-Item selection request, see lti_app/content_items.py.
+CONTENT_ITEM_SELECTION_MAX_AGE = 60 * 60
+
+# Maximum number of rows per page of the JSON API, and time (in seconds) during which its responses
+# may be reused by clients without revalidation, see lti_app/api.py.
+API_PAGE_SIZE = 100
+API_MAX_AGE = 60
+
+# Time (in seconds) during which the catalog of the sheets and exams of a class is cached, and age
+# after which it is refreshed in the background while still being served, see lti_app/catalog.py.
+CATALOG_CACHE_TTL = 60 * 60 * 24
+CATALOG_STALE_AFTER = 60
+
+# Number of requests sent at the same time to a WIMS server when fetching the catalog of a class.
+CATALOG_CONCURRENCY = 8
+
+# Number of students of a roster whose WIMS accounts are created at the same time, and number of
+# students provisioned per batch, see lti_app/roster.py.
+ROSTER_CONCURRENCY = 8
+ROSTER_BATCH_SIZE = 100
+
+# Directory where each process writes its metrics at most every METRICS_FLUSH_INTERVAL seconds, the
+# metrics endpoint summing the files of every worker, see lti_app/metrics.py. Must be shared by
+# every worker of a deployment. If None, the endpoint only reports the metrics of the process
+# answering the request.
+METRICS_DIR = None
+METRICS_FLUSH_INTERVAL = 5
+
+# Addresses allowed to read the metrics endpoint.
+METRICS_ALLOWED_IPS = ["127.0.0.1", "::1"]
+
+# Fraction of the adm/raw calls kept as traces, calls that failed or took longer than
+# WIMS_TRACE_SLOW_THRESHOLD seconds always being kept, number of traces kept by each process, and
+# file to which kept traces are also appended as NDJSON (if not None), see lti_app/tracing.py.
+WIMS_TRACE_SAMPLE_RATE = 0.01
+WIMS_TRACE_SLOW_THRESHOLD = 1
+WIMS_TRACE_BUFFER_SIZE = 1000
+WIMS_TRACE_FILE = None
+
+# Whether the responses of the launch views describe the time spent in each of their stages in a
+# Server-Timing header, and duration (in seconds) above which a launch and its stages are logged.
+LAUNCH_SERVER_TIMING = True
+LAUNCH_SLOW_THRESHOLD = 2
+
 # Time before requests sent to a WIMS server from wims-lti time out. Should be increased
 # if some WIMS server contains a lot of classes / users.
 WIMSAPI_TIMEOUT = 5
 
+# Time before requests sending grades back to a LMS time out.
+OUTCOME_SERVICE_TIMEOUT = 5
+
 # Allow the file 'wimsLTI/config.py' to override these settings.
 from wimsLTI.config import *  # noqa: E402 F401 F403